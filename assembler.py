@@ -0,0 +1,210 @@
+from processor import (OP_LUI, OP_AUIPC, OP_JAL, OP_JALR, OP_BRANCH, OP_IMM, OP_OP, OP_SYSTEM, OP_LOAD, OP_STORE,
+                       BRANCH_FUNCT3_BEQ, BRANCH_FUNCT3_BNE, BRANCH_FUNCT3_BLT, BRANCH_FUNCT3_BGE, IMM_FUNCT3_ADDI,
+                       IMM_FUNCT3_SLLI, IMM_FUNCT3_ORI, OP_FUNCT7_STANDARD, OP_FUNCT7_ALTERNATE, OP_FUNC7_MULDIV,
+                       OP_FUNCT3_ADD, OP_FUNCT3_XOR, OP_FUNCT3_MUL, OP_FUNCT3_DIV, OP_FUNCT3_REM, LOAD_FUNCT3_LW,
+                       LOAD_FUNCT3_LBU, STORE_FUNCT3_SW, STORE_FUNCT3_SB, JALR_FUNCT3,
+                       SYSTEM_FUNCT3_PRIV, SYSTEM_FUNCT12_ECALL, SYSTEM_FUNCT12_MRET, SYSTEM_FUNCT12_SRET,
+                       SYSTEM_FUNCT12_WFI, SYSTEM_FUNCT7_SFENCE_VMA, SYSTEM_FUNCT3_CSRRW, SYSTEM_FUNCT3_CSRRS,
+                       OP_AMO, AMO_FUNCT3_W, AMO_FUNCT5_LR, AMO_FUNCT5_SC, AMO_FUNCT5_SWAP, AMO_FUNCT5_ADD,
+                       OP_MISC_MEM, MISC_MEM_FUNCT3_FENCE, MISC_MEM_FUNCT3_FENCE_I, bit_mask_prefix)
+from memory import Memory
+
+# Encoders of the RISC-V instruction formats, used to build small guest programs for benchmarks
+# and examples. Registers are given by number and immediates as signed python integers.
+
+
+def r_type(opcode, funct3, funct7, rd, rs1, rs2):
+    return opcode | (rd << 7) | (funct3 << 12) | (rs1 << 15) | (rs2 << 20) | (funct7 << 25)
+
+
+def i_type(opcode, funct3, rd, rs1, imm):
+    return opcode | (rd << 7) | (funct3 << 12) | (rs1 << 15) | ((imm & bit_mask_prefix(12)) << 20)
+
+
+def s_type(opcode, funct3, rs1, rs2, imm):
+    imm &= bit_mask_prefix(12)
+    return (opcode | ((imm & bit_mask_prefix(5)) << 7) | (funct3 << 12) | (rs1 << 15) | (rs2 << 20)
+            | ((imm >> 5) << 25))
+
+
+def b_type(funct3, rs1, rs2, offset):  # The offset is in bytes, relative to the branch
+    offset &= bit_mask_prefix(13)
+    return (OP_BRANCH | (((offset >> 11) & 1) << 7) | (((offset >> 1) & bit_mask_prefix(4)) << 8) | (funct3 << 12)
+            | (rs1 << 15) | (rs2 << 20) | (((offset >> 5) & bit_mask_prefix(6)) << 25) | (((offset >> 12) & 1) << 31))
+
+
+def u_type(opcode, rd, imm):  # imm holds the upper 20 bits
+    return opcode | (rd << 7) | ((imm & bit_mask_prefix(20)) << 12)
+
+
+def j_type(rd, offset):  # The offset is in bytes, relative to the jump
+    offset &= bit_mask_prefix(21)
+    return (OP_JAL | (rd << 7) | (((offset >> 12) & bit_mask_prefix(8)) << 12) | (((offset >> 11) & 1) << 20)
+            | (((offset >> 1) & bit_mask_prefix(10)) << 21) | (((offset >> 20) & 1) << 31))
+
+
+def lui(rd, imm):
+    return u_type(OP_LUI, rd, imm)
+
+
+def auipc(rd, imm):
+    return u_type(OP_AUIPC, rd, imm)
+
+
+def jal(rd, offset):
+    return j_type(rd, offset)
+
+
+def jalr(rd, rs1, imm):
+    return i_type(OP_JALR, JALR_FUNCT3, rd, rs1, imm)
+
+
+def beq(rs1, rs2, offset):
+    return b_type(BRANCH_FUNCT3_BEQ, rs1, rs2, offset)
+
+
+def bne(rs1, rs2, offset):
+    return b_type(BRANCH_FUNCT3_BNE, rs1, rs2, offset)
+
+
+def blt(rs1, rs2, offset):
+    return b_type(BRANCH_FUNCT3_BLT, rs1, rs2, offset)
+
+
+def bge(rs1, rs2, offset):
+    return b_type(BRANCH_FUNCT3_BGE, rs1, rs2, offset)
+
+
+def addi(rd, rs1, imm):
+    return i_type(OP_IMM, IMM_FUNCT3_ADDI, rd, rs1, imm)
+
+
+def ori(rd, rs1, imm):
+    return i_type(OP_IMM, IMM_FUNCT3_ORI, rd, rs1, imm)
+
+
+def slli(rd, rs1, shamt):
+    return i_type(OP_IMM, IMM_FUNCT3_SLLI, rd, rs1, shamt)
+
+
+def add(rd, rs1, rs2):
+    return r_type(OP_OP, OP_FUNCT3_ADD, OP_FUNCT7_STANDARD, rd, rs1, rs2)
+
+
+def sub(rd, rs1, rs2):
+    return r_type(OP_OP, OP_FUNCT3_ADD, OP_FUNCT7_ALTERNATE, rd, rs1, rs2)
+
+
+def xor(rd, rs1, rs2):
+    return r_type(OP_OP, OP_FUNCT3_XOR, OP_FUNCT7_STANDARD, rd, rs1, rs2)
+
+
+def mul(rd, rs1, rs2):
+    return r_type(OP_OP, OP_FUNCT3_MUL, OP_FUNC7_MULDIV, rd, rs1, rs2)
+
+
+def div(rd, rs1, rs2):
+    return r_type(OP_OP, OP_FUNCT3_DIV, OP_FUNC7_MULDIV, rd, rs1, rs2)
+
+
+def rem(rd, rs1, rs2):
+    return r_type(OP_OP, OP_FUNCT3_REM, OP_FUNC7_MULDIV, rd, rs1, rs2)
+
+
+def lw(rd, rs1, imm):
+    return i_type(OP_LOAD, LOAD_FUNCT3_LW, rd, rs1, imm)
+
+
+def sw(rs2, rs1, imm):  # Stores rs2 at rs1 + imm, in the operand order of the assembler
+    return s_type(OP_STORE, STORE_FUNCT3_SW, rs1, rs2, imm)
+
+
+def lbu(rd, rs1, imm):
+    return i_type(OP_LOAD, LOAD_FUNCT3_LBU, rd, rs1, imm)
+
+
+def sb(rs2, rs1, imm):
+    return s_type(OP_STORE, STORE_FUNCT3_SB, rs1, rs2, imm)
+
+
+def ecall():
+    return i_type(OP_SYSTEM, SYSTEM_FUNCT3_PRIV, 0, 0, SYSTEM_FUNCT12_ECALL)
+
+
+def mret():
+    return i_type(OP_SYSTEM, SYSTEM_FUNCT3_PRIV, 0, 0, SYSTEM_FUNCT12_MRET)
+
+
+def sret():
+    return i_type(OP_SYSTEM, SYSTEM_FUNCT3_PRIV, 0, 0, SYSTEM_FUNCT12_SRET)
+
+
+def wfi():
+    return i_type(OP_SYSTEM, SYSTEM_FUNCT3_PRIV, 0, 0, SYSTEM_FUNCT12_WFI)
+
+
+def sfence_vma():
+    return r_type(OP_SYSTEM, SYSTEM_FUNCT3_PRIV, SYSTEM_FUNCT7_SFENCE_VMA, 0, 0, 0)
+
+
+def fence():  # Orders every earlier access before every later one
+    return i_type(OP_MISC_MEM, MISC_MEM_FUNCT3_FENCE, 0, 0, 0xff)
+
+
+def fence_i():
+    return i_type(OP_MISC_MEM, MISC_MEM_FUNCT3_FENCE_I, 0, 0, 0)
+
+
+def csrrw(rd, csr, rs1):
+    return i_type(OP_SYSTEM, SYSTEM_FUNCT3_CSRRW, rd, rs1, csr)
+
+
+def csrw(csr, rs1):  # Writes a CSR
+    return csrrw(0, csr, rs1)
+
+
+def csrrs(rd, csr, rs1):
+    return i_type(OP_SYSTEM, SYSTEM_FUNCT3_CSRRS, rd, rs1, csr)
+
+
+def csrr(rd, csr):  # Reads a CSR
+    return csrrs(rd, csr, 0)
+
+
+def amo(funct5, rd, rs1, rs2):  # The address is held in rs1, without an offset
+    return r_type(OP_AMO, AMO_FUNCT3_W, funct5 << 2, rd, rs1, rs2)
+
+
+def lr_w(rd, rs1):
+    return amo(AMO_FUNCT5_LR, rd, rs1, 0)
+
+
+def sc_w(rd, rs1, rs2):
+    return amo(AMO_FUNCT5_SC, rd, rs1, rs2)
+
+
+def amoswap_w(rd, rs1, rs2):
+    return amo(AMO_FUNCT5_SWAP, rd, rs1, rs2)
+
+
+def amoadd_w(rd, rs1, rs2):
+    return amo(AMO_FUNCT5_ADD, rd, rs1, rs2)
+
+
+def load_immediate(rd, value):  # Returns the LUI and ADDI pair that loads a 32-bit constant
+    lower = value & bit_mask_prefix(12)
+    if lower & 0x800:  # ADDI sign-extends its immediate, so compensate in the upper part
+        lower -= 1 << 12
+    upper = ((value - lower) >> 12) & bit_mask_prefix(20)
+    return [lui(rd, upper), addi(rd, rd, lower)]
+
+
+def exit_program():  # Returns the code that passes a riscv-tests test, a0 = 1 with a7 left at zero by the program
+    return [addi(10, 0, 1), ecall()]
+
+
+def assemble(words, address):  # Returns a memory holding the given instructions, starting at the given address
+    memory = Memory(address)
+    for index, word in enumerate(words):
+        memory.write_word(word, address + 4 * index)
+    return memory
@@ -0,0 +1,365 @@
+import numpy as np
+
+from processor import Processor, SYSTEM_FUNCT12_ECALL, bit_mask_prefix
+from memory import PAGE_BITS, PAGE_SIZE
+from system import SYSCALL_EXIT
+
+# The state of each lane
+LANE_RUNNING = 0
+LANE_EXITED = 1  # The guest called exit, like System.call with a0 == 1 or the exit system call with status 0
+LANE_FAILED = 2  # The guest made an unknown system call or exited with a nonzero status, a0 holds the code
+LANE_FAULT = 3  # The lane accessed memory outside of its window or executed an unsupported instruction
+
+MASK = bit_mask_prefix(32)
+
+
+class BatchException(Exception):  # Throw when a batch cannot be built from the given memory
+    pass
+
+
+# Runs the same program on many harts ("lanes") in lockstep. The lanes only differ in their initial
+# registers and memory, which is useful for parameter sweeps and input fuzzing.
+# The register files are held in an (N, 32) uint32 array and the memories in an (N, size) uint8 array
+# covering the window [base, base + size) of the address space. Each step executes one instruction
+# on every running lane: the lanes are grouped by pc and each group executes its instruction with
+# vectorized operations, so lanes whose branches diverged are executed as separate groups until they meet again.
+# The guest code is assumed to be the same for all the lanes and must not modify itself.
+class BatchMachine:
+
+    def __init__(self, memory, lanes, size=None, stack_size=64 * 1024):
+        if not memory.pages:
+            raise BatchException("The memory holds no program")
+
+        first = min(memory.pages)
+        last = max(memory.pages)
+        self.base = first << PAGE_BITS
+        if size is None:  # Cover the program and leave some room after it for the stack and data
+            size = ((last - first + 1) << PAGE_BITS) + stack_size
+        self.size = size
+
+        self.lanes = lanes
+        self.registers = np.zeros((lanes, 32), dtype=np.uint32)  # x0 to x31 of every lane
+        self.pc = np.full(lanes, memory.start, dtype=np.uint32)
+        self.state = np.full(lanes, LANE_RUNNING, dtype=np.int8)
+        self.exit_code = np.zeros(lanes, dtype=np.uint32)  # a0 at the ecall that stopped the lane
+        self.retired = np.zeros(lanes, dtype=np.int64)  # instructions executed by each lane
+        self.fault_reason = {}  # why each faulted lane stopped, by lane
+
+        # Every lane starts from a copy of the program memory
+        image = np.zeros(size, dtype=np.uint8)
+        for number, page in memory.pages.items():
+            offset = (number << PAGE_BITS) - self.base
+            if 0 <= offset < size:
+                chunk = min(PAGE_SIZE, size - offset)
+                image[offset:offset + chunk] = np.frombuffer(page.data, dtype=np.uint8)[:chunk]
+        self.memory = np.repeat(image[np.newaxis, :], lanes, axis=0)
+
+        self.cpu = Processor()  # Only used to decode the instructions
+        self.decode_cache = {}
+
+    def fault(self, lanes, reason):  # Stops the given lanes with a fault
+        self.state[lanes] = LANE_FAULT
+        for lane in lanes:
+            self.fault_reason[int(lane)] = reason
+
+    # Returns the lanes whose accesses fall inside the memory window, their memory offsets and the mask
+    # of those lanes among the given ones. The other lanes are stopped with a fault.
+    def translate(self, lanes, addresses, size):
+        offsets = addresses - np.uint32(self.base)  # Wraps around for the addresses below the window
+        valid = offsets <= np.uint32(self.size - size)
+        if not valid.all():
+            bad = lanes[~valid]
+            self.fault(bad, f"Memory access outside of the batch window at pc {hex(int(self.pc[bad[0]]))}")
+            lanes = lanes[valid]
+            offsets = offsets[valid]
+        return lanes, offsets.astype(np.int64), valid
+
+    def load(self, lanes, addresses, size):  # Loads little-endian values of the given size, returns lanes and values
+        lanes, offsets, _ = self.translate(lanes, addresses, size)
+        values = np.zeros(len(lanes), dtype=np.uint32)
+        for byte in range(size):
+            values |= self.memory[lanes, offsets + byte].astype(np.uint32) << np.uint32(8 * byte)
+        return lanes, values
+
+    def store(self, lanes, addresses, values, size):  # Stores the lower size bytes of the values, returns the lanes
+        lanes, offsets, valid = self.translate(lanes, addresses, size)
+        values = values[valid]
+        for byte in range(size):
+            self.memory[lanes, offsets + byte] = (values >> np.uint32(8 * byte)).astype(np.uint8)
+        return lanes
+
+    def decode(self, lane, pc):  # Decodes the instruction at pc, reading it from the memory of the given lane
+        decoded = self.decode_cache.get(pc)
+        if decoded is None:
+            offset = pc - self.base
+            if not 0 <= offset <= self.size - 4:
+                return None
+            word = int.from_bytes(self.memory[lane, offset:offset + 4].tobytes(), "little")
+            decoded = self.cpu.decode(word)
+            self.decode_cache[pc] = decoded
+        return decoded
+
+    def groups(self):  # Returns the running lanes grouped by their pc
+        running = np.flatnonzero(self.state == LANE_RUNNING)
+        if len(running) == 0:
+            return []
+
+        pcs = self.pc[running]
+        if (pcs == pcs[0]).all():  # The common case, every lane is at the same instruction
+            return [(int(pcs[0]), running)]
+
+        order = np.argsort(pcs, kind="stable")
+        unique, starts = np.unique(pcs[order], return_index=True)
+        return [(int(pc), lanes) for pc, lanes in zip(unique, np.split(running[order], starts[1:]))]
+
+    def step(self):  # Executes one instruction on every running lane, returns False once no lane is running
+        groups = self.groups()
+        for pc, lanes in groups:
+            try:
+                decoded = self.decode(int(lanes[0]), pc)
+            except NotImplementedError as error:
+                self.fault(lanes, str(error))
+                continue
+            if decoded is None:
+                self.fault(lanes, f"The pc {hex(pc)} is outside of the batch window")
+                continue
+
+            handler = handlers.get(decoded.execute)
+            if handler is None:
+                self.fault(lanes, f"Cannot execute in batch mode: {decoded}")
+                continue
+
+            self.retired[lanes] += 1
+            handler(self, lanes, decoded)
+            self.registers[lanes, 0] = 0  # The x0 register is hardwired to zero
+
+        return len(groups) > 0
+
+    def run(self, max_steps=None):  # Runs until every lane stopped or max_steps steps were executed
+        steps = 0
+        while max_steps is None or steps < max_steps:
+            if not self.step():
+                break
+            steps += 1
+        return steps
+
+    def next_pc(self, lanes):
+        self.pc[lanes] += np.uint32(4)
+
+
+# The vectorized handlers of the instructions, keyed by the interpreter handler of the instruction.
+# Each one executes a decoded instruction on the given lanes. The registers are uint32, so additions,
+# subtractions and left shifts wrap around like the 32-bit registers of the cpu.
+
+def batch_empty(machine, lanes, decoded):  # There is no instruction at this address, skip over it
+    machine.next_pc(lanes)
+
+
+def batch_fence(machine, lanes, decoded):  # The lanes run one instruction at a time, in program order
+    machine.next_pc(lanes)
+
+
+def register_operation(operation):  # Returns a handler that writes operation(machine, lanes, decoded) into rd
+    def batch_operation(machine, lanes, decoded):
+        result = operation(machine.registers, lanes, decoded)
+        if decoded.rd != 0:
+            machine.registers[lanes, decoded.rd] = result
+        machine.next_pc(lanes)
+
+    return batch_operation
+
+
+def rs1(registers, lanes, decoded):
+    return registers[lanes, decoded.rs1]
+
+
+def rs2(registers, lanes, decoded):
+    return registers[lanes, decoded.rs2]
+
+
+def signed(values):  # Reinterprets uint32 values as int32
+    return values.view(np.int32)
+
+
+def imm(decoded):  # The sign-extended immediate as a uint32
+    return np.uint32(decoded.imm & MASK)
+
+
+def shamt(decoded):
+    return np.uint32(decoded.imm & bit_mask_prefix(5))
+
+
+def shift_amount(registers, lanes, decoded):  # The lower 5 bits of rs2
+    return rs2(registers, lanes, decoded) & np.uint32(31)
+
+
+def remainder(registers, lanes, decoded):  # Signed remainder, taking the sign of the dividend
+    dividend = signed(rs1(registers, lanes, decoded)).astype(np.int64)
+    divisor = signed(rs2(registers, lanes, decoded)).astype(np.int64)
+    safe = np.where(divisor == 0, 1, divisor)
+    result = np.where(divisor == 0, dividend, np.fmod(dividend, safe))
+    return (result & MASK).astype(np.uint32)
+
+
+def multiply_high(a, b):  # The upper 32 bits of the int64 products, the operands fit in 32 bits
+    return ((a * b) >> 32).astype(np.uint32)
+
+
+def division(registers, lanes, decoded):  # Signed division, rounding towards zero, dividing by zero gives -1
+    dividend = signed(rs1(registers, lanes, decoded)).astype(np.int64)
+    divisor = signed(rs2(registers, lanes, decoded)).astype(np.int64)
+    safe = np.where(divisor == 0, 1, divisor)
+    quotient = np.abs(dividend) // np.abs(safe) * np.sign(dividend) * np.sign(safe)
+    result = np.where(divisor == 0, -1, quotient)
+    return (result & MASK).astype(np.uint32)
+
+
+def unsigned_division(registers, lanes, decoded):  # Dividing by zero sets all the bits
+    dividend = rs1(registers, lanes, decoded)
+    divisor = rs2(registers, lanes, decoded)
+    safe = np.where(divisor == 0, np.uint32(1), divisor)
+    return np.where(divisor == 0, np.uint32(MASK), dividend // safe).astype(np.uint32)
+
+
+def unsigned_remainder(registers, lanes, decoded):  # The remainder of a division by zero is the dividend
+    dividend = rs1(registers, lanes, decoded)
+    divisor = rs2(registers, lanes, decoded)
+    safe = np.where(divisor == 0, np.uint32(1), divisor)
+    return np.where(divisor == 0, dividend, dividend % safe).astype(np.uint32)
+
+
+def batch_auipc(machine, lanes, decoded):
+    if decoded.rd != 0:
+        machine.registers[lanes, decoded.rd] = machine.pc[lanes] + imm(decoded)
+    machine.next_pc(lanes)
+
+
+def batch_jal(machine, lanes, decoded):
+    return_address = machine.pc[lanes] + np.uint32(4)
+    machine.pc[lanes] += imm(decoded)
+    if decoded.rd != 0:
+        machine.registers[lanes, decoded.rd] = return_address
+
+
+def batch_jalr(machine, lanes, decoded):
+    return_address = machine.pc[lanes] + np.uint32(4)
+    machine.pc[lanes] = (machine.registers[lanes, decoded.rs1] + imm(decoded)) & np.uint32(MASK - 1)
+    if decoded.rd != 0:
+        machine.registers[lanes, decoded.rd] = return_address
+
+
+def branch(condition):  # Returns a handler that jumps on the lanes where condition(a, b) holds
+    def batch_branch(machine, lanes, decoded):
+        a = machine.registers[lanes, decoded.rs1]
+        b = machine.registers[lanes, decoded.rs2]
+        jump = condition(a, b)
+        pc = machine.pc[lanes]
+        machine.pc[lanes] = np.where(jump, pc + imm(decoded), pc + np.uint32(4))
+
+    return batch_branch
+
+
+def load(size, signed_bits=None):  # Returns the handler of a load of the given size
+    def batch_load(machine, lanes, decoded):
+        addresses = machine.registers[lanes, decoded.rs1] + imm(decoded)
+        lanes, values = machine.load(lanes, addresses, size)
+        if signed_bits is not None:  # Sign-extend the loaded value
+            sign = np.uint32(1 << (signed_bits - 1))
+            values = (values ^ sign) - sign
+        if decoded.rd != 0:
+            machine.registers[lanes, decoded.rd] = values
+        machine.next_pc(lanes)
+
+    return batch_load
+
+
+def store(size):  # Returns the handler of a store of the given size
+    def batch_store(machine, lanes, decoded):
+        addresses = machine.registers[lanes, decoded.rs1] + imm(decoded)
+        lanes = machine.store(lanes, addresses, machine.registers[lanes, decoded.rs2], size)
+        machine.next_pc(lanes)
+
+    return batch_store
+
+
+# Executes a system call. Only the exit of the riscv-tests programs and the exit system call are known,
+# the lanes making other system calls fail.
+def batch_system(machine, lanes, decoded):
+    if decoded.imm & bit_mask_prefix(12) != SYSTEM_FUNCT12_ECALL:
+        machine.fault(lanes, f"Cannot execute in batch mode: {decoded}")
+        return
+
+    a0 = machine.registers[lanes, 10]
+    a7 = machine.registers[lanes, 17]
+    exited = ((a7 == 0) & (a0 == 1)) | ((a7 == SYSCALL_EXIT) & (a0 == 0))
+    machine.exit_code[lanes] = a0
+    machine.state[lanes] = np.where(exited, LANE_EXITED, LANE_FAILED).astype(np.int8)
+    machine.next_pc(lanes)
+
+
+handlers = {
+    Processor.execute_empty: batch_empty,
+    Processor.execute_fence: batch_fence,
+    Processor.execute_lui: register_operation(lambda registers, lanes, decoded: imm(decoded)),
+    Processor.execute_auipc: batch_auipc,
+    Processor.execute_jal: batch_jal,
+    Processor.execute_jalr: batch_jalr,
+
+    Processor.execute_beq: branch(lambda a, b: a == b),
+    Processor.execute_bne: branch(lambda a, b: a != b),
+    Processor.execute_blt: branch(lambda a, b: signed(a) < signed(b)),
+    Processor.execute_bge: branch(lambda a, b: signed(a) >= signed(b)),
+    Processor.execute_bltu: branch(lambda a, b: a < b),
+    Processor.execute_bgeu: branch(lambda a, b: a >= b),
+
+    Processor.execute_addi: register_operation(lambda r, lanes, d: rs1(r, lanes, d) + imm(d)),
+    Processor.execute_slti: register_operation(
+        lambda r, lanes, d: (signed(rs1(r, lanes, d)) < np.int32(d.imm)).astype(np.uint32)),
+    Processor.execute_sltiu: register_operation(lambda r, lanes, d: (rs1(r, lanes, d) < imm(d)).astype(np.uint32)),
+    Processor.execute_xori: register_operation(lambda r, lanes, d: rs1(r, lanes, d) ^ imm(d)),
+    Processor.execute_ori: register_operation(lambda r, lanes, d: rs1(r, lanes, d) | imm(d)),
+    Processor.execute_andi: register_operation(lambda r, lanes, d: rs1(r, lanes, d) & imm(d)),
+    Processor.execute_slli: register_operation(lambda r, lanes, d: rs1(r, lanes, d) << shamt(d)),
+    Processor.execute_srli: register_operation(lambda r, lanes, d: rs1(r, lanes, d) >> shamt(d)),
+    Processor.execute_srai: register_operation(
+        lambda r, lanes, d: (signed(rs1(r, lanes, d)) >> shamt(d).astype(np.int32)).view(np.uint32)),
+
+    Processor.execute_add: register_operation(lambda r, lanes, d: rs1(r, lanes, d) + rs2(r, lanes, d)),
+    Processor.execute_sub: register_operation(lambda r, lanes, d: rs1(r, lanes, d) - rs2(r, lanes, d)),
+    Processor.execute_sll: register_operation(lambda r, lanes, d: rs1(r, lanes, d) << shift_amount(r, lanes, d)),
+    Processor.execute_slt: register_operation(
+        lambda r, lanes, d: (signed(rs1(r, lanes, d)) < signed(rs2(r, lanes, d))).astype(np.uint32)),
+    Processor.execute_sltu: register_operation(
+        lambda r, lanes, d: (rs1(r, lanes, d) < rs2(r, lanes, d)).astype(np.uint32)),
+    Processor.execute_xor: register_operation(lambda r, lanes, d: rs1(r, lanes, d) ^ rs2(r, lanes, d)),
+    Processor.execute_srl: register_operation(lambda r, lanes, d: rs1(r, lanes, d) >> shift_amount(r, lanes, d)),
+    Processor.execute_sra: register_operation(
+        lambda r, lanes, d: (signed(rs1(r, lanes, d)) >> shift_amount(r, lanes, d).astype(np.int32)).view(np.uint32)),
+    Processor.execute_or: register_operation(lambda r, lanes, d: rs1(r, lanes, d) | rs2(r, lanes, d)),
+    Processor.execute_and: register_operation(lambda r, lanes, d: rs1(r, lanes, d) & rs2(r, lanes, d)),
+    Processor.execute_mul: register_operation(lambda r, lanes, d: rs1(r, lanes, d) * rs2(r, lanes, d)),
+    Processor.execute_mulh: register_operation(
+        lambda r, lanes, d: multiply_high(signed(rs1(r, lanes, d)).astype(np.int64),
+                                          signed(rs2(r, lanes, d)).astype(np.int64))),
+    Processor.execute_mulhsu: register_operation(
+        lambda r, lanes, d: multiply_high(signed(rs1(r, lanes, d)).astype(np.int64),
+                                          rs2(r, lanes, d).astype(np.int64))),
+    Processor.execute_mulhu: register_operation(
+        lambda r, lanes, d: multiply_high(rs1(r, lanes, d).astype(np.uint64), rs2(r, lanes, d).astype(np.uint64))),
+    Processor.execute_div: register_operation(division),
+    Processor.execute_divu: register_operation(unsigned_division),
+    Processor.execute_rem: register_operation(remainder),
+    Processor.execute_remu: register_operation(unsigned_remainder),
+
+    Processor.execute_system: batch_system,
+
+    Processor.execute_lb: load(1, 8),
+    Processor.execute_lh: load(2, 16),
+    Processor.execute_lw: load(4),
+    Processor.execute_lbu: load(1),
+    Processor.execute_lhu: load(2),
+
+    Processor.execute_sb: store(1),
+    Processor.execute_sh: store(2),
+    Processor.execute_sw: store(4),
+}
@@ -0,0 +1,194 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+from processor import Processor
+from translator import Translator
+from system import System
+import assembler
+import image
+import runner
+
+ENGINES = ["interpreter", "translator"]
+
+# The synthetic workloads are placed at the usual start address, their data in a separate region
+CODE_ADDRESS = 0x80000000
+DATA_ADDRESS = 0x80100000
+
+
+def addi_bne_loop(iterations):  # A tight counting loop, one ADDI and one BNE per iteration
+    return (assembler.load_immediate(2, iterations) +
+            [assembler.addi(1, 0, 0),
+             assembler.addi(1, 1, 1),
+             assembler.bne(1, 2, -4)] +
+            assembler.exit_program())
+
+
+def memory_sweep(size, passes):  # Stores and loads back every word of a buffer of the given size, several times
+    return (assembler.load_immediate(5, DATA_ADDRESS) +
+            assembler.load_immediate(6, DATA_ADDRESS + size) +
+            [assembler.addi(8, 0, passes),
+             assembler.addi(9, 0, 0),
+             assembler.addi(7, 5, 0),  # outer: start from the beginning of the buffer
+             assembler.sw(7, 7, 0),  # inner: store the address into the buffer and load it back
+             assembler.lw(11, 7, 0),
+             assembler.addi(7, 7, 4),
+             assembler.bne(7, 6, -12),
+             assembler.addi(9, 9, 1),
+             assembler.bne(9, 8, -24)] +
+            assembler.exit_program())
+
+
+def rem_loop(iterations):  # Computes the remainder of a constant by every number up to iterations
+    return (assembler.load_immediate(2, iterations) +
+            assembler.load_immediate(3, 12345677) +
+            [assembler.addi(1, 0, 0),
+             assembler.addi(1, 1, 1),
+             assembler.rem(4, 3, 1),
+             assembler.xor(5, 5, 4),
+             assembler.bne(1, 2, -12)] +
+            assembler.exit_program())
+
+
+def workloads(scale):  # The synthetic long-running guests, by name
+    return {
+        "addi_bne_loop": addi_bne_loop(200000 * scale),
+        "memory_sweep": memory_sweep(16 * 1024, 16 * scale),
+        "rem_loop": rem_loop(50000 * scale),
+    }
+
+
+# The microbenchmarked instructions, grouped like the execute_imm, execute_op, execute_load,
+# execute_store and execute_branch handlers of the original interpreter
+micro_groups = {
+    "execute_imm": {"addi": assembler.addi(1, 2, 5), "ori": assembler.ori(1, 2, -3), "slli": assembler.slli(1, 2, 3)},
+    "execute_op": {"add": assembler.add(1, 2, 3), "xor": assembler.xor(1, 2, 3), "mul": assembler.mul(1, 2, 3),
+                   "div": assembler.div(1, 2, 3), "rem": assembler.rem(1, 2, 3)},
+    "execute_load": {"lw": assembler.lw(1, 4, 8)},
+    "execute_store": {"sw": assembler.sw(2, 4, 8)},
+    "execute_branch": {"beq": assembler.beq(2, 3, 16), "bne": assembler.bne(2, 3, 16)},
+}
+
+
+def measure(memory, engine):  # Runs a guest to the end and returns the executed instructions and the seconds taken
+    system = System(memory)
+
+    cpu = Processor(system=system)
+    cpu.pc = memory.start
+    translator = Translator(cpu) if engine == "translator" else None
+
+    executed = 0
+    begin = time.perf_counter()
+    while not system.terminate:
+        executed += runner.run_slice(cpu, translator, runner.SLICE_SIZE)
+    return executed, time.perf_counter() - begin
+
+
+def best_mips(load_memory, engine, repeat):  # Returns the best instructions per second over several runs, in MIPS
+    best = 0.0
+    for _ in range(repeat):
+        executed, seconds = measure(load_memory(), engine)
+        best = max(best, executed / seconds / 1e6)
+    return best
+
+
+def time_handler(decoded, repeat):  # Returns the nanoseconds taken by a single execution of a decoded instruction
+    memory = assembler.assemble([], DATA_ADDRESS)
+    cpu = Processor(system=System(memory))
+    cpu.registers[2] = 1234567
+    cpu.registers[3] = 89
+    cpu.registers[4] = DATA_ADDRESS
+
+    execute = decoded.execute
+    begin = time.perf_counter()
+    for _ in range(repeat):
+        execute(cpu, decoded)
+    return (time.perf_counter() - begin) / repeat * 1e9
+
+
+def metric(value, unit, higher_is_better):
+    return {"value": value, "unit": unit, "higher_is_better": higher_is_better}
+
+
+# Runs the whole suite and returns the metrics by name
+def run_benchmarks(engines=ENGINES, repeat=3, scale=1, micro_repeat=200000, paths=None, progress=print):
+    results = {}
+
+    for path in sorted(paths if paths is not None else glob.glob("tests/*.mc")):
+        name = os.path.splitext(os.path.basename(path))[0]
+        for engine in engines:
+            mips = best_mips(lambda: image.load(path), engine, repeat)
+            results[f"program/{name}/{engine}"] = metric(mips, "MIPS", True)
+            progress(f"program/{name}/{engine}: {mips:.3f} MIPS")
+
+    for name, words in workloads(scale).items():
+        for engine in engines:
+            mips = best_mips(lambda: assembler.assemble(words, CODE_ADDRESS), engine, repeat)
+            results[f"workload/{name}/{engine}"] = metric(mips, "MIPS", True)
+            progress(f"workload/{name}/{engine}: {mips:.3f} MIPS")
+
+    decoder = Processor()
+    for group, instructions in micro_groups.items():
+        total = 0.0
+        for name, word in instructions.items():
+            nanoseconds = min(time_handler(decoder.decode(word), micro_repeat) for _ in range(repeat))
+            results[f"micro/{group}/{name}"] = metric(nanoseconds, "ns", False)
+            progress(f"micro/{group}/{name}: {nanoseconds:.1f} ns")
+            total += nanoseconds
+        results[f"micro/{group}"] = metric(total / len(instructions), "ns", False)
+
+    return results
+
+
+# Compares the results with a baseline and returns the metrics that got worse by more than the threshold
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, current in sorted(results.items()):
+        previous = baseline.get(name)
+        if previous is None or previous["value"] <= 0:
+            continue
+
+        change = current["value"] / previous["value"] - 1
+        if not current["higher_is_better"]:
+            change = -change  # a positive change is always an improvement
+
+        print(f"{name:45} {previous['value']:12.3f} -> {current['value']:12.3f} {current['unit']:5} {change:+8.1%}")
+        if change < -threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main(arguments=None):
+    arguments_parser = argparse.ArgumentParser(description="Measures the speed of the emulator")
+    arguments_parser.add_argument("--engine", choices=ENGINES + ["both"], default="both")
+    arguments_parser.add_argument("--repeat", type=int, default=3, help="runs of each benchmark, the best one is kept")
+    arguments_parser.add_argument("--scale", type=int, default=1, help="multiplies the length of the workloads")
+    arguments_parser.add_argument("--save", help="write the results as a JSON baseline to this file")
+    arguments_parser.add_argument("--compare", help="compare the results with the JSON baseline in this file")
+    arguments_parser.add_argument("--threshold", type=float, default=0.10,
+                                  help="relative slowdown reported as a regression")
+    arguments = arguments_parser.parse_args(arguments)
+
+    engines = ENGINES if arguments.engine == "both" else [arguments.engine]
+    results = run_benchmarks(engines, arguments.repeat, arguments.scale)
+
+    if arguments.save:
+        with open(arguments.save, "w") as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+
+    if arguments.compare:
+        with open(arguments.compare) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, arguments.threshold)
+        if regressions:
+            print(f"{len(regressions)} regressions above {arguments.threshold:.0%}: {', '.join(regressions)}")
+            return 1
+        print("No regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
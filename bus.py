@@ -0,0 +1,61 @@
+import bisect
+
+
+class BusException(Exception):  # Throw when a device is mapped over the range of another device
+    pass
+
+
+class TimeBehind(Exception):  # Raised by a device access while the time of the scheduler is behind the cpu
+    pass
+
+
+# The devices mapped into the address space of a memory, as ranges sorted by their start address.
+# The memory only hands the bus the accesses to the pages holding a device, the pages of RAM never reach it.
+# An access looks at the range of the previous one first, so the accesses to the same device skip the bisect,
+# and the bytes of a device page outside every range read as zero and ignore the writes.
+# The run loop of the cpu only brings the time of its scheduler up to date between slices. While a slice runs,
+# current is False and an access raises TimeBehind before it reaches the device, see Processor.run.
+class Bus:
+    def __init__(self):
+        self.starts = []  # The start addresses of the ranges, sorted
+        self.ranges = []  # The ranges as (start, end, device), in the order of starts
+        self.last = (0, 0, None)  # The range of the last access
+        self.current = True  # The devices see the time of the cpu
+
+    def attach(self, address, size, device):  # Maps the registers of a device over size bytes at the address
+        index = bisect.bisect_right(self.starts, address)
+        if index and self.ranges[index - 1][1] > address or \
+                index < len(self.starts) and self.starts[index] < address + size:
+            raise BusException(f"The device at {hex(address)} overlaps another device")
+        self.starts.insert(index, address)
+        self.ranges.insert(index, (address, address + size, device))
+
+    def find(self, address):  # Returns the range holding the address, or None
+        index = bisect.bisect_right(self.starts, address) - 1
+        if index < 0 or address >= self.ranges[index][1]:
+            return None
+        self.last = self.ranges[index]
+        return self.last
+
+    # The devices are called with the offset of the access in their range and its size in bytes
+    def read(self, address, size):
+        if not self.current:
+            raise TimeBehind()
+        start, end, device = self.last
+        if not start <= address < end:
+            found = self.find(address)
+            if found is None:
+                return 0
+            start, end, device = found
+        return device.read(address - start, size)
+
+    def write(self, address, size, value):
+        if not self.current:
+            raise TimeBehind()
+        start, end, device = self.last
+        if not start <= address < end:
+            found = self.find(address)
+            if found is None:
+                return
+            start, end, device = found
+        device.write(address - start, size, value)
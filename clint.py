@@ -0,0 +1,87 @@
+from processor import CSR_MIP, MIP_MSIP, MIP_MTIP
+
+# The address of the CLINT in the memory of the guest, and the offsets of its registers
+CLINT_BASE = 0x2000000
+CLINT_SIZE = 0x10000
+CLINT_MSIP = 0x0
+CLINT_MTIMECMP = 0x4000
+CLINT_MTIME = 0xbff8
+
+# The longest run of instructions between two updates of the time of the scheduler
+TIME_RESOLUTION = 1000
+
+REGISTER_MASK = (1 << 64) - 1
+
+
+def read_part(value, offset, size):  # Returns size bytes of a 64-bit register, starting at the given byte
+    return (value >> (8 * offset)) & ((1 << (8 * size)) - 1)
+
+
+def write_part(value, offset, size, data):  # Returns the 64-bit register with size of its bytes replaced by data
+    mask = ((1 << (8 * size)) - 1) << (8 * offset)
+    return (value & ~mask) | ((data << (8 * offset)) & mask)
+
+
+# The core local interruptor of a hart: the machine timer and the software interrupt. mtime counts the time of the
+# scheduler of the cpu, one tick per instruction. Instead of comparing mtime with mtimecmp on every instruction,
+# the CLINT schedules an event for the time mtimecmp is reached, and the event raises the timer interrupt.
+class Clint:
+    def __init__(self, cpu, base=CLINT_BASE):
+        self.cpu = cpu
+        self.mtimecmp = REGISTER_MASK  # The timer interrupt is pending once mtime reaches mtimecmp
+        self.offset = 0  # mtime minus the time of the scheduler, changed by the writes to mtime
+        self.event = None  # The scheduled expiry of the timer
+
+        cpu.scheduler.resolution = min(cpu.scheduler.resolution, TIME_RESOLUTION)
+        cpu.system.memory.map_device(base, CLINT_SIZE, self)
+
+    def mtime(self):
+        return (self.cpu.scheduler.now + self.offset) & REGISTER_MASK
+
+    def read(self, offset, size):
+        if offset == CLINT_MSIP:
+            return 1 if self.cpu.csrs[CSR_MIP] & MIP_MSIP else 0
+        if CLINT_MTIMECMP <= offset < CLINT_MTIMECMP + 8:
+            return read_part(self.mtimecmp, offset - CLINT_MTIMECMP, size)
+        if CLINT_MTIME <= offset < CLINT_MTIME + 8:
+            return read_part(self.mtime(), offset - CLINT_MTIME, size)
+        return 0
+
+    # The run loop of the cpu brings the time up to date before an access reaches a device, so a software interrupt
+    # raised by a store is taken before the next instruction, and so is a timer interrupt once mtimecmp is reached
+    def write(self, offset, size, value):
+        csrs = self.cpu.csrs
+        if offset == CLINT_MSIP:
+            csrs[CSR_MIP] = csrs[CSR_MIP] | MIP_MSIP if value & 1 else csrs[CSR_MIP] & ~MIP_MSIP
+        elif CLINT_MTIMECMP <= offset < CLINT_MTIMECMP + 8:
+            self.mtimecmp = write_part(self.mtimecmp, offset - CLINT_MTIMECMP, size, value)
+            self.update_timer()
+        elif CLINT_MTIME <= offset < CLINT_MTIME + 8:
+            mtime = write_part(self.mtime(), offset - CLINT_MTIME, size, value)
+            self.offset = mtime - self.cpu.scheduler.now
+            self.update_timer()
+
+    def state(self):  # The registers of the CLINT, for the snapshots
+        return {"mtimecmp": self.mtimecmp, "offset": self.offset}
+
+    def load_state(self, state):
+        self.mtimecmp = state["mtimecmp"]
+        self.offset = state["offset"]
+        self.update_timer()
+
+    def update_timer(self):  # Raises the timer interrupt if mtimecmp is reached, or schedules the time it will be
+        scheduler = self.cpu.scheduler
+        if self.event is not None:
+            scheduler.cancel(self.event)
+            self.event = None
+
+        remaining = self.mtimecmp - self.mtime()
+        if remaining <= 0:
+            self.cpu.csrs[CSR_MIP] |= MIP_MTIP
+        else:
+            self.cpu.csrs[CSR_MIP] &= ~MIP_MTIP
+            self.event = scheduler.schedule(scheduler.now + remaining, self.expire)
+
+    def expire(self):
+        self.event = None
+        self.cpu.csrs[CSR_MIP] |= MIP_MTIP
@@ -0,0 +1,74 @@
+import mmap
+import os
+import struct
+
+from memory import Memory, PAGE_SIZE, OFFSET_MASK
+
+ELF_MAGIC = b"\x7fELF"
+ELFCLASS32 = 1
+ELFDATA2LSB = 1  # little-endian
+EM_RISCV = 243
+PT_LOAD = 1
+
+ZERO_PAGE_BYTES = bytes(PAGE_SIZE)  # The source of the zeroed part of the segments
+
+# e_ident, e_type, e_machine, e_version, e_entry, e_phoff, e_shoff, e_flags, e_ehsize, e_phentsize, e_phnum
+header_format = struct.Struct("<16sHHIIIIIHHH")
+
+# p_type, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz, p_flags, p_align
+program_header_format = struct.Struct("<IIIIIIII")
+
+
+class ElfException(Exception):  # Throw when a file is not a 32-bit little-endian RISC-V executable, or is truncated
+    pass
+
+
+def is_elf(filename):
+    with open(filename, "rb") as file:
+        return file.read(len(ELF_MAGIC)) == ELF_MAGIC
+
+
+# Loads the PT_LOAD segments of a RISC-V ELF32 executable into a new memory and starts the execution
+# at its entry point. The file is mapped, so the segments are copied straight from the page cache.
+# Each segment is placed at its virtual address, as the programs are linked to run there, and the part of it
+# past its file size is zeroed explicitly, so it clears the bytes an earlier segment wrote there and its pages
+# belong to the program. The headers and the segments must lie inside the file.
+def load(filename):
+    with open(filename, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        if size < header_format.size:
+            raise ElfException(f"Truncated ELF file: {filename}")
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    with data:
+        header = header_format.unpack_from(data, 0)
+        ident, _, machine, _, entry, phoff, _, _, _, phentsize, phnum = header
+        if ident[:4] != ELF_MAGIC or ident[4] != ELFCLASS32 or ident[5] != ELFDATA2LSB:
+            raise ElfException(f"Not a 32-bit little-endian ELF file: {filename}")
+        if machine != EM_RISCV:
+            raise ElfException(f"Not a RISC-V executable: {filename}")
+        if phnum and (phentsize < program_header_format.size or phoff + phnum * phentsize > size):
+            raise ElfException(f"Truncated ELF program headers: {filename}")
+
+        memory = Memory(entry)
+        with memoryview(data) as view:
+            for index in range(phnum):
+                segment = program_header_format.unpack_from(data, phoff + index * phentsize)
+                kind, offset, address, _, file_size, memory_size = segment[:6]
+                if kind != PT_LOAD:
+                    continue
+                if offset + file_size > size or file_size > memory_size:
+                    raise ElfException(f"Truncated ELF segment at {hex(address)}: {filename}")
+                if file_size:
+                    memory.write_bytes(address, view[offset:offset + file_size])
+                zero_fill(memory, address + file_size, memory_size - file_size)
+
+    return memory
+
+
+def zero_fill(memory, address, size):  # Zeroes size bytes of the memory, a page at a time
+    while size > 0:
+        chunk = min(size, PAGE_SIZE - (address & OFFSET_MASK))
+        memory.write_bytes(address, ZERO_PAGE_BYTES[:chunk])
+        address += chunk
+        size -= chunk
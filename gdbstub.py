@@ -0,0 +1,338 @@
+import argparse
+import select
+import socket
+import sys
+
+from memory import PAGE_BITS
+from mmu import Trap as GuestTrap
+from processor import Processor, Instruction, OP_EMPTY, STOP_EXIT, STOP_FAULT
+from system import System
+import image
+
+# The guest runs in slices of this many instructions, the stub looks for an interrupt from GDB between them
+SLICE_SIZE = 100000
+
+# The signals of the stop replies
+SIGINT = 2
+SIGTRAP = 5
+SIGSEGV = 11
+
+# The kinds of watchpoints, by the type of their Z packet
+WATCH_WRITE = 2
+WATCH_READ = 3
+WATCH_ACCESS = 4
+watch_names = {WATCH_WRITE: "watch", WATCH_READ: "rwatch", WATCH_ACCESS: "awatch"}
+
+REGISTER_NAMES = ["zero", "ra", "sp", "gp", "tp", "t0", "t1", "t2", "fp", "s1", "a0", "a1", "a2", "a3", "a4", "a5",
+                  "a6", "a7", "s2", "s3", "s4", "s5", "s6", "s7", "s8", "s9", "s10", "s11", "t3", "t4", "t5", "t6"]
+PC_REGISTER = 32
+
+TARGET_XML = ('<?xml version="1.0"?><!DOCTYPE target SYSTEM "gdb-target.dtd"><target version="1.0">'
+              '<architecture>riscv:rv32</architecture><feature name="org.gnu.gdb.riscv.cpu">'
+              + "".join(f'<reg name="{name}" bitsize="32" type="int" regnum="{number}"/>'
+                        for number, name in enumerate(REGISTER_NAMES))
+              + f'<reg name="pc" bitsize="32" type="code_ptr" regnum="{PC_REGISTER}"/></feature></target>')
+
+
+class Trap(Exception):  # Raised by the trap instructions the stub puts in the decode cache
+    pass
+
+
+def execute_trap(cpu, decoded):
+    raise Trap(cpu.pc)
+
+
+def checksum(data):
+    return f"{sum(data) & 0xff:02x}".encode()
+
+
+def hex_word(value):  # GDB reads the registers in the byte order of the target
+    return value.to_bytes(4, "little").hex()
+
+
+# A GDB Remote Serial Protocol server for a cpu running on the interpreter.
+# A breakpoint replaces the decoded instruction of its address by a trap, so the run loop executes as usual
+# and only stops when it reaches the trap. A watchpoint marks its pages: while watchpoints are set,
+# the memory accesses go through a wrapper that checks the pages missing the access caches of the memory,
+# and the watched pages are never cached. A hit lets the access complete and puts a one-shot trap
+# after the instruction, so the guest stops once the instruction is over.
+class GDBStub:
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.memory = cpu.system.memory
+        self.breakpoints = set()
+        self.watchpoints = {}  # The watched ranges of each watched page, as (start, end, kind)
+        self.one_shot = set()  # The traps put after the instructions that hit a watchpoint
+        self.hit = None  # The kind and address of the last watchpoint hit
+        self.connection = None
+        self.acknowledge = True
+
+        self.memory.code_listeners.append(self.code_stored)
+
+    # Breakpoints
+
+    def plant(self, address):
+        self.cpu.unfuse((address,))  # A pair fused with the instruction at the address would run over the trap
+        self.memory.decode_cache[address] = Instruction(execute_trap, OP_EMPTY)
+
+    def remove_trap(self, address):
+        if address not in self.breakpoints and address not in self.one_shot:
+            self.memory.decode_cache.pop(address, None)
+
+    # A store dropped decoded instructions, they may have been traps. The store drops the words it overlaps and
+    # the word before them, which may be fused with them, see Memory.invalidate, so every trap of those words is
+    # planted again. When every decoded instruction is dropped, the memory may also have changed its class, as the
+    # cpu turned paging on or off, so the watched accesses are wrapped again around the accesses of the new class.
+    def code_stored(self, address):
+        traps = self.breakpoints | self.one_shot
+        if address is None:
+            if self.watchpoints:
+                self.watch_memory()
+            for trap in traps:
+                self.plant(trap)
+            return
+        word = address & ~3
+        for trap in ((word - 4) & 0xffffffff, word, (word + 4) & 0xffffffff):  # A store reaches the next word at most
+            if trap in traps:
+                self.plant(trap)
+
+    # Watchpoints
+
+    def add_watchpoint(self, kind, address, length):
+        if not self.watchpoints:
+            self.watch_memory()
+        for number in range(address >> PAGE_BITS, ((address + length - 1) >> PAGE_BITS) + 1):
+            self.watchpoints.setdefault(number, []).append((address, address + length, kind))
+        self.memory.read_number = self.memory.write_number = -1  # The watched pages must miss the caches
+
+    def remove_watchpoint(self, kind, address, length):
+        for number in range(address >> PAGE_BITS, ((address + length - 1) >> PAGE_BITS) + 1):
+            ranges = self.watchpoints.get(number, [])
+            if (address, address + length, kind) in ranges:
+                ranges.remove((address, address + length, kind))
+            if not ranges:
+                self.watchpoints.pop(number, None)
+        if not self.watchpoints:
+            for name in ("read_word", "read_halfword", "read_byte", "write_word", "write_halfword", "write_byte"):
+                vars(self.memory).pop(name, None)
+
+    def watch_memory(self):  # Routes the accesses of the memory through the watchpoint checks
+        for name, size, write in (("read_word", 4, False), ("read_halfword", 2, False), ("read_byte", 1, False),
+                                  ("write_word", 4, True), ("write_halfword", 2, True), ("write_byte", 1, True)):
+            setattr(self.memory, name, self.watched_access(getattr(type(self.memory), name), size, write))
+
+    def watched_access(self, access, size, write):
+        memory = self.memory
+        watchpoints = self.watchpoints
+
+        def watched(*arguments):
+            address = arguments[-1]
+            number = address >> PAGE_BITS
+            if number == (memory.write_number if write else memory.read_number) or number not in watchpoints:
+                return access(memory, *arguments)
+
+            result = access(memory, *arguments)
+            memory.read_number = memory.write_number = -1
+            for start, end, kind in watchpoints[number]:
+                if start < address + size and address < end and kind in (
+                        (WATCH_WRITE, WATCH_ACCESS) if write else (WATCH_READ, WATCH_ACCESS)):
+                    self.hit = (kind, address)
+                    following = (self.cpu.pc + 4) & 0xffffffff
+                    self.one_shot.add(following)
+                    self.plant(following)
+                    break
+            return result
+
+        return watched
+
+    # Execution
+
+    def step(self):  # Executes the instruction at pc, even when a trap replaces it
+        cpu = self.cpu
+        decoded = cpu.decode(self.memory.fetch_word(cpu.pc))
+        decoded.execute(cpu, decoded)
+        cpu.registers[0] = 0
+
+    def stop_reply(self, signal=SIGTRAP):
+        for address in list(self.one_shot):
+            self.one_shot.discard(address)
+            self.remove_trap(address)
+
+        if self.hit is not None:
+            kind, address = self.hit
+            self.hit = None
+            return f"T{SIGTRAP:02x}{watch_names[kind]}:{address:x};"
+        return f"S{signal:02x}"
+
+    # Runs the guest until it stops, and returns the stop reply. A trap of the first instruction is delivered
+    # to the guest as the run loop does, the stub only reports the faults of the emulator.
+    def resume(self, single_step):
+        system = self.cpu.system
+        try:
+            self.step()  # The first instruction may be hidden by a trap
+        except GuestTrap as trap:
+            if not self.cpu.enter_trap(trap):
+                return self.stop_reply(SIGSEGV)
+        except Exception:
+            return self.stop_reply(SIGSEGV)
+        if system.terminate:
+            return f"W{system.exit_code & 0xff:02x}"
+        if single_step or self.hit is not None:
+            return self.stop_reply()
+
+        while True:
+            stop = self.cpu.run(SLICE_SIZE)
+            if stop.reason == STOP_EXIT:
+                return f"W{system.exit_code & 0xff:02x}"
+            if stop.reason == STOP_FAULT:
+                return self.stop_reply(SIGTRAP if isinstance(stop.error, Trap) else SIGSEGV)
+            if select.select([self.connection], [], [], 0)[0]:
+                if self.connection.recv(1) == b"\x03":
+                    return self.stop_reply(SIGINT)
+
+    # Protocol
+
+    def send(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.connection.sendall(b"$" + data + b"#" + checksum(data))
+
+    def receive(self):  # Returns the next packet, or None when GDB is gone
+        buffer = b""
+        while True:
+            byte = self.connection.recv(1)
+            if not byte:
+                return None
+            if byte == b"\x03":
+                return b"\x03"
+            if byte != b"$":
+                continue
+
+            buffer = b""
+            while (byte := self.connection.recv(1)) != b"#":
+                if not byte:
+                    return None
+                buffer += byte
+            self.connection.recv(2)  # The checksum, TCP already checks the data
+            if self.acknowledge:
+                self.connection.sendall(b"+")
+            return buffer
+
+    def handle(self, packet):  # Returns the reply to a packet
+        cpu = self.cpu
+        command, data = chr(packet[0]), packet[1:].decode()
+
+        if packet == b"\x03" or command == "?":
+            return self.stop_reply(SIGINT if packet == b"\x03" else SIGTRAP)
+        if command == "g":
+            return "".join(hex_word(value) for value in cpu.registers) + hex_word(cpu.pc)
+        if command == "G":
+            values = [int.from_bytes(bytes.fromhex(data[i:i + 8]), "little") for i in range(0, len(data), 8)]
+            cpu.registers[1:32] = values[1:32]
+            cpu.pc = values[PC_REGISTER]
+            return "OK"
+        if command == "p":
+            number = int(data, 16)
+            if number > PC_REGISTER:
+                return "E01"
+            return hex_word(cpu.pc if number == PC_REGISTER else cpu.registers[number])
+        if command == "P":
+            number, value = data.split("=")
+            number, value = int(number, 16), int.from_bytes(bytes.fromhex(value), "little")
+            if number == PC_REGISTER:
+                cpu.pc = value
+            elif 0 < number < PC_REGISTER:
+                cpu.registers[number] = value
+            return "OK"
+        if command == "m":  # The addresses are translated while paging is on, an unmapped page is an error
+            address, length = (int(field, 16) for field in data.split(","))
+            try:
+                return self.memory.read_bytes(address, length).hex()
+            except GuestTrap:
+                return "E14"
+        if command == "M":
+            location, content = data.split(":")
+            address = int(location.split(",")[0], 16)
+            try:
+                self.memory.write_bytes(address, bytes.fromhex(content))
+            except GuestTrap:
+                return "E14"
+            return "OK"
+        if command in "cs":
+            if data:
+                cpu.pc = int(data, 16)
+            return self.resume(command == "s")
+        if command in "Zz":
+            kind, address, length = (int(field, 16) for field in data.split(","))
+            if kind in (0, 1):  # Software and hardware breakpoints are both traps
+                if command == "Z":
+                    self.breakpoints.add(address)
+                    self.plant(address)
+                else:
+                    self.breakpoints.discard(address)
+                    self.remove_trap(address)
+            elif kind in watch_names:
+                if command == "Z":
+                    self.add_watchpoint(kind, address, length)
+                else:
+                    self.remove_watchpoint(kind, address, length)
+            else:
+                return ""
+            return "OK"
+        if command == "q":
+            if data.startswith("Supported"):
+                return "PacketSize=4000;qXfer:features:read+;QStartNoAckMode+"
+            if data.startswith("Xfer:features:read:target.xml:"):
+                offset, length = (int(field, 16) for field in data.split(":")[-1].split(","))
+                chunk = TARGET_XML[offset:offset + length]
+                return ("m" if offset + length < len(TARGET_XML) else "l") + chunk
+            if data == "Attached":
+                return "1"
+            if data == "fThreadInfo":
+                return "m1"
+            if data == "sThreadInfo":
+                return "l"
+            if data == "C":
+                return "QC1"
+            return ""
+        if packet == b"QStartNoAckMode":
+            self.send("OK")
+            self.acknowledge = False
+            return None
+        if command == "H":
+            return "OK"
+        if command in "Dk":
+            return "OK"
+        return ""  # Unsupported packets get an empty reply
+
+    def serve(self, port, host="127.0.0.1"):  # Waits for GDB on a TCP port and serves it until it detaches
+        with socket.create_server((host, port)) as server:
+            self.connection, _ = server.accept()
+
+        with self.connection:
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            while (packet := self.receive()) is not None and packet:
+                reply = self.handle(packet)
+                if reply is not None:
+                    self.send(reply)
+                if chr(packet[0]) in "Dk" or reply and reply[0] == "W":
+                    break
+
+
+def main(arguments=None):
+    arguments_parser = argparse.ArgumentParser(description="Runs a program under the control of GDB")
+    arguments_parser.add_argument("program", help="a memory dump or an ELF executable")
+    arguments_parser.add_argument("--port", type=int, default=1234)
+    arguments = arguments_parser.parse_args(arguments)
+
+    memory = image.load(arguments.program)
+    cpu = Processor(system=System(memory))
+    cpu.pc = memory.start
+
+    print(f"Waiting for GDB on port {arguments.port}: target remote :{arguments.port}")
+    GDBStub(cpu).serve(arguments.port)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,143 @@
+import hashlib
+import mmap
+import os
+import struct
+
+from memory import Memory, PAGE_BITS, PAGE_SIZE
+from symbols import SymbolTable
+import elf
+import parser
+
+# A compiled memory image is a header, a table of segments, the symbol table and the raw bytes of the segments.
+# The segments are made of whole pages and start at page-aligned file offsets, so each page
+# of the image can be mapped straight into the memory.
+IMAGE_MAGIC = b"RVIM"
+IMAGE_VERSION = 2
+
+# magic, version, number of segments, entry point, sha256 of the source file, number of symbols
+header_format = struct.Struct("<4sHHI32sI")
+
+# base address, length in bytes, file offset
+segment_format = struct.Struct("<III")
+
+# address, length of the name in bytes, followed by the UTF-8 name
+symbol_format = struct.Struct("<IH")
+
+HASH_CHUNK_SIZE = 1024 * 1024  # The source file is hashed in chunks of this many bytes
+
+
+class ImageException(Exception):  # Throw when a compiled image is invalid or out of date
+    pass
+
+
+def image_path(filename):  # The compiled image is written next to its source file
+    return os.path.splitext(filename)[0] + ".img"
+
+
+def source_hash(filename):  # Returns the content hash of the source file, read in chunks
+    digest = hashlib.sha256()
+    with open(filename, "rb") as file:
+        while chunk := file.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def align_page(n):  # Rounds n up to a multiple of the page size
+    return (n + PAGE_SIZE - 1) & ~(PAGE_SIZE - 1)
+
+
+def get_segments(memory):  # Groups the allocated pages of the memory into runs of consecutive pages
+    segments = []
+    for number in sorted(memory.pages):
+        if segments and segments[-1][1] == number:
+            segments[-1][1] = number + 1
+        else:
+            segments.append([number, number + 1])
+    return segments
+
+
+def write_image(filename, memory, digest):  # Writes the pages of the memory into a compiled image
+    segments = get_segments(memory)
+    symbols = bytearray()
+    for address, name in memory.symbols:
+        name = name.encode()
+        symbols += symbol_format.pack(address, len(name)) + name
+    offset = align_page(header_format.size + segment_format.size * len(segments) + len(symbols))
+
+    header = bytearray(header_format.pack(IMAGE_MAGIC, IMAGE_VERSION, len(segments), memory.start, digest,
+                                          len(memory.symbols)))
+    for first, last in segments:
+        length = (last - first) * PAGE_SIZE
+        header += segment_format.pack(first << PAGE_BITS, length, offset)
+        offset += length
+    header += symbols
+
+    # Write to a temporary file first, so other processes never see a half written image
+    temporary = f"{filename}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as file:
+        file.write(header)
+        file.write(bytes(align_page(len(header)) - len(header)))
+        for first, last in segments:
+            for number in range(first, last):
+                file.write(memory.pages[number].data)
+    os.replace(temporary, filename)
+
+
+# Maps a compiled image into a new memory. The file is mapped copy-on-write, so the pages are
+# only read from disk when they are touched and the writes of the guest never reach the file.
+# The file must end with its last segment, a truncated or padded image is rejected before any page is mapped.
+def read_image(filename, digest=None):
+    with open(filename, "rb") as file:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    magic, version, count, entry, image_digest, symbol_count = header_format.unpack_from(data, 0)
+    if magic != IMAGE_MAGIC or version != IMAGE_VERSION:
+        raise ImageException(f"Not a compiled image: {filename}")
+    if digest is not None and image_digest != digest:
+        raise ImageException(f"The compiled image is out of date: {filename}")
+
+    segments = [segment_format.unpack_from(data, header_format.size + index * segment_format.size)
+                for index in range(count)]
+    if segments and max(offset + length for _, length, offset in segments) != len(data):
+        raise ImageException(f"The size of the compiled image does not match its segments: {filename}")
+
+    memory = Memory(entry)
+    view = memoryview(data)
+    for address, length, offset in segments:
+        for page in range(0, length, PAGE_SIZE):
+            memory.map_page((address + page) >> PAGE_BITS, view[offset + page:offset + page + PAGE_SIZE])
+
+    symbols = []
+    position = header_format.size + count * segment_format.size
+    for _ in range(symbol_count):
+        address, length = symbol_format.unpack_from(data, position)
+        position += symbol_format.size
+        symbols.append((address, bytes(data[position:position + length]).decode()))
+        position += length
+    memory.symbols = SymbolTable(symbols)
+    return memory
+
+
+# Loads a program. ELF executables are loaded directly, memory dumps go through their compiled image
+# when it is up to date. Otherwise the dump is parsed and the image is compiled again for the next runs,
+# unless cache is false.
+def load(filename, cache=True):
+    if elf.is_elf(filename):
+        return elf.load(filename)
+
+    digest = source_hash(filename)
+    compiled = image_path(filename)
+
+    try:
+        return read_image(compiled, digest)
+    except (OSError, ValueError, struct.error, ImageException):
+        pass  # There is no usable image, parse the dump
+
+    memory = parser.parse(filename)
+    if not cache:
+        return memory
+    try:
+        write_image(compiled, memory, digest)
+    except OSError:
+        pass  # The image is only a cache, running from the parsed dump still works
+    return memory
@@ -0,0 +1,60 @@
+import json
+from collections import Counter
+
+from memory import PAGE_BITS
+from processor import OP_BRANCH, OP_LOAD, OP_STORE, OP_EMPTY, ignore_overflow
+
+
+# Counts what a guest does while it runs: the retired instructions by opcode and funct3, the outcome
+# of every branch, the loads and stores of every page and how often each address was executed.
+# It is attached to a cpu with cpu.attach(counters), a cpu without it runs the plain cycle.
+class Counters:
+    def __init__(self):
+        self.retired = Counter()  # By (opcode, funct3)
+        self.handlers = Counter()  # By handler name, which tells apart the instructions sharing a funct3
+        self.branches = {}  # [taken, not taken] by the address of the branch
+        self.loads = Counter()  # By page number
+        self.stores = Counter()
+        self.pcs = Counter()  # By the address of the instruction
+
+    def before(self, cpu, decoded):  # Memory accesses are counted before rd is written, it may be rs1
+        opcode = decoded.opcode
+        if opcode == OP_LOAD or opcode == OP_STORE:
+            address = ignore_overflow(cpu.registers[decoded.rs1] + decoded.imm, cpu.architecture)
+            counter = self.loads if opcode == OP_LOAD else self.stores
+            counter[address >> PAGE_BITS] += 1
+
+    def after(self, cpu, pc, decoded):
+        opcode = decoded.opcode
+        if opcode == OP_EMPTY:
+            return  # Skipping over an empty word does not retire an instruction
+
+        self.retired[opcode, decoded.funct3] += 1
+        self.handlers[decoded.execute.__name__] += 1
+        self.pcs[pc] += 1
+
+        if opcode == OP_BRANCH:
+            outcome = self.branches.get(pc)
+            if outcome is None:
+                outcome = self.branches[pc] = [0, 0]
+            outcome[cpu.pc == pc + cpu.instruction_size] += 1  # A branch that falls through is not taken
+
+    def total(self):  # The number of retired instructions
+        return sum(self.retired.values())
+
+    def to_dict(self):  # The counters as plain data, addresses are written in hexadecimal
+        return {
+            "retired": self.total(),
+            "instructions": [{"opcode": opcode, "funct3": funct3, "count": count}
+                             for (opcode, funct3), count in sorted(self.retired.items())],
+            "handlers": dict(self.handlers.most_common()),
+            "branches": {hex(pc): {"taken": taken, "not_taken": not_taken}
+                         for pc, (taken, not_taken) in sorted(self.branches.items())},
+            "loads": {hex(number << PAGE_BITS): count for number, count in sorted(self.loads.items())},
+            "stores": {hex(number << PAGE_BITS): count for number, count in sorted(self.stores.items())},
+            "pcs": {hex(pc): count for pc, count in sorted(self.pcs.items())},
+        }
+
+    def write_json(self, filename):
+        with open(filename, "w") as file:
+            json.dump(self.to_dict(), file, indent=2)
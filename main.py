@@ -1,31 +1,41 @@
-from processor import Processor
-from system import system, SystemException
-import parser
+import sys
 
+from processor import Processor, STOP_FAULT
+from translator import Translator
+from system import System, SystemException
+import image
 
-def execute_test(filename):
+
+# The engine is selected by the first command line argument: "interpreter" (the default) or "translator"
+def execute_test(filename, engine="interpreter"):
     print(f"Execute test : {filename}")
-    memory = parser.parse(filename)
+    memory = image.load(filename)
     start_location = memory.start
 
-    system.memory = memory
-    system.terminate = False
+    system = System(memory)
     # system.debug = True - uncomment this line to debug the registers to stdout
 
     print(f"Start location: {hex(start_location)}")
-    cpu = Processor()
+    cpu = Processor(system=system)
     cpu.pc = start_location
 
     try:
-        while not system.terminate:
-            cpu.cycle()
+        if engine == "translator":
+            Translator(cpu).run()
+        else:
+            stop = cpu.run()
+            if stop.reason == STOP_FAULT:
+                raise stop.error
     except SystemException:
-        print(f"Test failed: {filename}")
+        passed = False
     else:
-        print(f"Test passed: {filename}")
+        passed = system.exit_code == 0  # The programs using the Linux system calls fail with a nonzero status
+
+    print(f"Test {'passed' if passed else 'failed'}: {filename}")
 
 
 to_test = ["tests/rv32ui-v-addi.mc", "tests/rv32ui-v-beq.mc", "tests/rv32ui-v-lw.mc", "tests/rv32ui-v-srl.mc",
            "tests/rv32ui-v-sw.mc", "tests/rv32ui-v-xor.mc", "tests/rv32um-v-rem.mc"]
+engine = sys.argv[1] if len(sys.argv) > 1 else "interpreter"
 for test in to_test:
-    execute_test(test)
+    execute_test(test, engine)
@@ -1,33 +1,375 @@
+import bisect
+import errno
+import struct
+import sys
+
+from bus import Bus
+from symbols import SymbolTable
+PAGE_BITS = 12
+PAGE_SIZE = 1 << PAGE_BITS  # 4 KiB pages
+OFFSET_MASK = PAGE_SIZE - 1  # Masks the offset of an address inside its page
+
+# Words and halfwords are accessed through memoryview casts, which use the byte order of the host.
+# RISC-V is little-endian, so the host has to be little-endian as well.
+if sys.byteorder != "little":
+    raise ImportError("The emulator memory needs a little-endian host")
+
+unpack_word = struct.Struct("<I").unpack_from  # Used for the accesses that are not naturally aligned
+unpack_halfword = struct.Struct("<H").unpack_from
+
+
+# A page of memory, with word and halfword views of its bytes. A shared page is held by a snapshot
+# and possibly by several memories, it is never written and is copied by the first memory that writes to it.
+class Page:
+    __slots__ = ("data", "words", "halfwords", "shared")
+
+    def __init__(self, data, shared=False):
+        self.data = data
+        view = memoryview(data)
+        self.words = view.cast("I")
+        self.halfwords = view.cast("H")
+        self.shared = shared
+
+
+# Read-only page returned for the pages that were never written, so reading memory does not allocate it
+ZERO_PAGE = Page(bytes(PAGE_SIZE), True)
+
+
+class DeviceAccess:  # The accesses of one size to a device page, turned into reads and writes on the bus
+    __slots__ = ("bus", "base", "size")
+
+    def __init__(self, bus, base, size):
+        self.bus = bus
+        self.base = base  # The address of the page
+        self.size = size
+
+    def __getitem__(self, index):
+        return self.bus.read(self.base + index * self.size, self.size)
+
+    def __setitem__(self, index, value):
+        self.bus.write(self.base + index * self.size, self.size, value)
+
+
+# A page holding memory-mapped devices. The memory accesses index its data, halfwords and words like the ones
+# of a page of RAM, so only the accesses that reach a device page pay for the bus. The misaligned accesses and
+# the ranges of bytes reach the devices one byte at a time, through read and write.
+class DevicePage:
+    __slots__ = ("data", "words", "halfwords", "shared")
+
+    def __init__(self, bus, base):
+        self.data = DeviceAccess(bus, base, 1)
+        self.halfwords = DeviceAccess(bus, base, 2)
+        self.words = DeviceAccess(bus, base, 4)
+        self.shared = False
+
+    def read(self, offset, size):  # Returns size bytes from the offset in the page
+        data = self.data
+        return bytes(data[index] & 0xff for index in range(offset, offset + size))
+
+    def write(self, offset, data):  # Writes the given bytes at the offset in the page
+        for index, value in enumerate(data, offset):
+            self.data[index] = value
+
+
+# The memory is split into 4 KiB pages, allocated the first time they are written.
+# It covers the full 32-bit address space, but only the pages a program touches use host memory.
 class Memory:
-    def __init__(self, size, start):
-        self.size = size  # The number of bytes in memory
-        self.start = start  # The start address is subtracted from each address
-        self.data = bytearray(size)  # The actual data
+    def __init__(self, start=0):
+        self.start = start  # The address where the execution starts
+        self.pages = {}  # The allocated pages, by page number
 
-    def write_word(self, data, address):  # Writes a 32-bit word to the given address
-        address -= self.start
-        byte_1 = data & 0xff
-        data >>= 8
+        self.read_number = -1  # The number of the last page read from
+        self.read_page = ZERO_PAGE
+        self.write_number = -1  # The number of the last page written to, it is always allocated
+        self.write_page = None
+
+        self.decode_cache = {}  # Decoded instructions by address, filled by the cpu and invalidated by stores
+        self.code_listeners = []  # Called with the address of every store that overwrites a decoded instruction,
+        # or with None when every decoded instruction is dropped, see flush_code
+
+        # The runs of zero words the cpu skipped over, the end of each run by its start address.
+        # The runs of a page are dropped when the page is written, see zero_run_end.
+        self.zero_runs = {}
+
+        self.dirty_pages = set()  # The numbers of the pages allocated or copied by a write, see restore_pages
+        self.device_pages = {}  # The pages holding memory-mapped devices, by page number, see map_device
+        self.bus = Bus()  # The devices of the device pages
+        self.symbols = SymbolTable()  # The labels of the program, kept by the loaders that know them
+
+    def get_page(self, number):  # Returns the page for reading, untouched pages read as zero
+        page = self.pages.get(number)
+        if page is None:
+            page = self.device_pages.get(number, ZERO_PAGE)
+        self.read_number = number
+        self.read_page = page
+        return page
+
+    # Returns the page for writing, allocating it on the first touch and copying it if it is shared
+    def allocate_page(self, number):
+        if self.zero_runs:
+            self.drop_zero_runs(number)
+
+        page = self.pages.get(number)
+        if page is None and self.device_pages:
+            page = self.device_pages.get(number)
+        if page is None or page.shared:
+            page = Page(bytearray(page.data) if page is not None else bytearray(PAGE_SIZE))
+            self.pages[number] = page
+            self.dirty_pages.add(number)
+            if self.read_number == number:  # The read cache may still hold the zero page
+                self.read_page = page
+
+        self.write_number = number
+        self.write_page = page
+        return page
+
+    def map_page(self, number, data):  # Uses the given writable buffer of PAGE_SIZE bytes as a page
+        self.drop_zero_runs(number)
+        self.pages[number] = Page(data)
+        self.read_number = -1
+        self.write_number = -1
+
+    # Maps the registers of a device over the given range, several devices may share a page. The device is called
+    # with the offset and the size of each access, as device.read(offset, size) and device.write(offset, size, value).
+    # Its state() returns its state as plain data and load_state(state) puts it back, for the snapshots.
+    def map_device(self, address, size, device):
+        self.bus.attach(address, size, device)
+        for number in range(address >> PAGE_BITS, ((address + size - 1) >> PAGE_BITS) + 1):
+            if number not in self.device_pages:
+                self.device_pages[number] = DevicePage(self.bus, number << PAGE_BITS)
+        self.read_number = -1
+        self.write_number = -1
+
+    # Returns the address the cpu reaches by skipping over the zero words starting at the given address,
+    # the first word that is not zero. The run is kept in an index, so skipping it again takes a single
+    # lookup. Writes into a page always go through allocate_page while a run covers it, and drop the run.
+    def zero_run_end(self, address):
+        end = self.zero_runs.get(address)
+        if end is None:
+            end = self.find_nonzero(address)
+            self.zero_runs[address] = end
+            if address >> PAGE_BITS <= self.write_number <= (end - 1) >> PAGE_BITS:
+                self.write_number = -1
+                self.write_page = None
+        return end & 0xffffffff
 
-        byte_2 = data & 0xff
-        data >>= 8
+    # Scans the memory for the first word that is not zero, in steps of 4 bytes from the given address.
+    # Only the bytes of the allocated pages are scanned. Past the end of the address space the scan
+    # stops, at the first address after the wrap-around.
+    def find_nonzero(self, address):
+        current = address
+        numbers = None
+        while current < 1 << 32:
+            number = current >> PAGE_BITS
+            page = self.pages.get(number)
+            if page is None:
+                if numbers is None:
+                    numbers = sorted(self.pages)
+                index = bisect.bisect_right(numbers, number)
+                if index == len(numbers):
+                    break
+                current = numbers[index] << PAGE_BITS
+                continue
 
-        byte_3 = data & 0xff
-        data >>= 8
+            rest = bytes(page.data[current & OFFSET_MASK:])
+            zeros = len(rest) - len(rest.lstrip(b"\0"))
+            if zeros < len(rest):
+                return address + ((current + zeros - address) & ~3)  # The word holding the non-zero byte
+            current = (number + 1) << PAGE_BITS
 
-        byte_4 = data & 0xff
-        data >>= 8
+        return address + (((1 << 32) - address + 3) & ~3)
 
-        self.data[address] = byte_1
-        self.data[address + 1] = byte_2
-        self.data[address + 2] = byte_3
-        self.data[address + 3] = byte_4
+    def drop_zero_runs(self, number):  # Drops the runs of zero words that cover the given page
+        first = number << PAGE_BITS
+        last = first + PAGE_SIZE
+        for start, end in list(self.zero_runs.items()):
+            if start < last and first < end:
+                del self.zero_runs[start]
+
+    # Marks every page as shared and returns them. The memory keeps using the pages, but copies
+    # each of them before its next write, so the returned pages keep their current contents.
+    def share_pages(self):
+        for page in self.pages.values():
+            page.shared = True
+        self.write_number = -1  # The next write has to go through allocate_page
+        self.write_page = None
+        self.dirty_pages.clear()
+        return dict(self.pages)
+
+    # Puts back the given shared pages, usually the ones returned by share_pages, in place of the pages written
+    # since. Only the written pages are visited, so the cost follows what the guest touched. The decoded
+    # instructions are kept, except the ones whose word changed.
+    def restore_pages(self, pages):
+        for number in self.dirty_pages:
+            page = self.pages.pop(number)
+            shared = pages.get(number)
+            if shared is not None:
+                self.pages[number] = shared
+            self.drop_zero_runs(number)
+
+            original = shared or ZERO_PAGE
+            if self.decode_cache and page.data != original.data:
+                first = number << PAGE_BITS
+                for index, word in enumerate(page.words):
+                    if word != original.words[index] and first + 4 * index in self.decode_cache:
+                        self.invalidate(first + 4 * index, 4)
+
+        self.dirty_pages.clear()
+        self.read_number = self.write_number = -1
+        self.read_page = ZERO_PAGE
+        self.write_page = None
+
+    # Drops every decoded instruction, when the addresses may now map to other code. The listeners are called
+    # with None as the address.
+    def flush_code(self):
+        self.decode_cache.clear()
+        for listener in self.code_listeners:
+            listener(None)
+
+    def invalidate(self, address, size):  # Drops the decoded instructions overlapped by a store
+        first = self.decode_cache.pop(address & ~3, None)
+        second = self.decode_cache.pop((address + size - 1) & ~3, None)
+        if first is not None or second is not None:
+            self.decode_cache.pop(((address & ~3) - 4) & 0xffffffff, None)  # It may be fused with the dropped one
+            for listener in self.code_listeners:
+                listener(address)
 
     def read_word(self, address):  # Reads a 32-bit word from the given address
-        address -= self.start
-        byte_1 = self.data[address]
-        byte_2 = self.data[address + 1]
-        byte_3 = self.data[address + 2]
-        byte_4 = self.data[address + 3]
+        number = address >> PAGE_BITS
+        page = self.read_page if number == self.read_number else self.get_page(number)
+        offset = address & OFFSET_MASK
+
+        if not offset & 3:
+            return page.words[offset >> 2]
+        if offset <= PAGE_SIZE - 4 and page.__class__ is not DevicePage:
+            return unpack_word(page.data, offset)[0]
+        return int.from_bytes(self.read_bytes(address, 4), "little")  # The word crosses into the next page
+
+    fetch_word = read_word  # Reads an instruction, the virtual memory checks it against the execute permission
+
+    def translate(self, address, access):  # Returns the physical address of an address, the same one without paging
+        return address
+
+    def read_halfword(self, address):  # Reads a 16-bit halfword from the given address
+        number = address >> PAGE_BITS
+        page = self.read_page if number == self.read_number else self.get_page(number)
+        offset = address & OFFSET_MASK
+
+        if not offset & 1:
+            return page.halfwords[offset >> 1]
+        if offset <= PAGE_SIZE - 2 and page.__class__ is not DevicePage:
+            return unpack_halfword(page.data, offset)[0]
+        return int.from_bytes(self.read_bytes(address, 2), "little")
+
+    def read_byte(self, address):  # Reads a byte from the given address
+        number = address >> PAGE_BITS
+        page = self.read_page if number == self.read_number else self.get_page(number)
+        return page.data[address & OFFSET_MASK]
+
+    def write_word(self, data, address):  # Writes a 32-bit word to the given address
+        if self.decode_cache:
+            self.invalidate(address, 4)
+
+        number = address >> PAGE_BITS
+        page = self.write_page if number == self.write_number else self.allocate_page(number)
+        offset = address & OFFSET_MASK
+
+        if not offset & 3:
+            page.words[offset >> 2] = data & 0xffffffff
+        else:
+            self.write_bytes(address, (data & 0xffffffff).to_bytes(4, "little"))
+
+    def write_halfword(self, data, address):  # Writes a 16-bit halfword to the given address
+        if self.decode_cache:
+            self.invalidate(address, 2)
+
+        number = address >> PAGE_BITS
+        page = self.write_page if number == self.write_number else self.allocate_page(number)
+        offset = address & OFFSET_MASK
+
+        if not offset & 1:
+            page.halfwords[offset >> 1] = data & 0xffff
+        else:
+            self.write_bytes(address, (data & 0xffff).to_bytes(2, "little"))
+
+    def write_byte(self, data, address):  # Writes a byte to the given address
+        if self.decode_cache:
+            self.invalidate(address, 1)
+
+        number = address >> PAGE_BITS
+        page = self.write_page if number == self.write_number else self.allocate_page(number)
+        page.data[address & OFFSET_MASK] = data & 0xff
+
+    def read_bytes(self, address, size):  # Reads size bytes starting at the given address, one page at a time
+        result = bytearray()
+        while size > 0:
+            offset = address & OFFSET_MASK
+            chunk = min(size, PAGE_SIZE - offset)
+            page = self.byte_page(address >> PAGE_BITS)
+            if page.__class__ is DevicePage:
+                result += page.read(offset, chunk)
+            else:
+                result += page.data[offset:offset + chunk]
+
+            address = (address + chunk) & 0xffffffff
+            size -= chunk
+        return result
+
+    def write_bytes(self, address, data):  # Writes the given bytes starting at the given address, one page at a time
+        data = memoryview(data).cast("B")
+        if self.decode_cache:
+            for word in range(address & ~3, address + len(data), 4):
+                self.invalidate(word, 1)
+
+        while data:
+            offset = address & OFFSET_MASK
+            chunk = min(len(data), PAGE_SIZE - offset)
+            page = self.allocate_page(address >> PAGE_BITS)
+            if page.__class__ is DevicePage:
+                page.write(offset, data[:chunk])
+            else:
+                page.data[offset:offset + chunk] = data[:chunk]
+
+            address = (address + chunk) & 0xffffffff
+            data = data[chunk:]
+
+    def byte_page(self, number):  # Returns the page for reading a range of bytes, without touching the read cache
+        page = self.pages.get(number)
+        if page is None:
+            page = self.device_pages.get(number, ZERO_PAGE)
+        return page
+
+    # Yields the size bytes starting at the given address as read-only views of the pages, one per page,
+    # so the host can write the guest memory to a file without copying it. The bytes of a device page
+    # are read from the bus into a copy.
+    def views(self, address, size):
+        while size > 0:
+            offset = address & OFFSET_MASK
+            chunk = min(size, PAGE_SIZE - offset)
+            page = self.byte_page(address >> PAGE_BITS)
+            if page.__class__ is DevicePage:
+                yield memoryview(page.read(offset, chunk))
+            else:
+                yield memoryview(page.data)[offset:offset + chunk].toreadonly()
+
+            address = (address + chunk) & 0xffffffff
+            size -= chunk
+
+    # Yields the size bytes starting at the given address as writable views of the pages, one per page,
+    # so the host can read a file straight into the guest memory. A device page has no bytes to view,
+    # reaching one raises EFAULT as the kernel does for a bad buffer.
+    def writable_views(self, address, size):
+        if self.decode_cache:
+            for word in range(address & ~3, address + size, 4):
+                self.invalidate(word, 1)
+
+        while size > 0:
+            offset = address & OFFSET_MASK
+            chunk = min(size, PAGE_SIZE - offset)
+            page = self.allocate_page(address >> PAGE_BITS)
+            if page.__class__ is DevicePage:
+                raise OSError(errno.EFAULT, "Bad address")
+            yield memoryview(page.data)[offset:offset + chunk]
 
-        return byte_1 | (byte_2 << 8) | (byte_3 << 16) | (byte_4 << 24)
+            address = (address + chunk) & 0xffffffff
+            size -= chunk
@@ -0,0 +1,246 @@
+from memory import Memory, PAGE_BITS, PAGE_SIZE, OFFSET_MASK
+
+# The privilege modes of the cpu
+PRIVILEGE_USER = 0
+PRIVILEGE_SUPERVISOR = 1
+PRIVILEGE_MACHINE = 3
+
+# The exception causes of the page faults, as written into mcause or scause
+CAUSE_FETCH_PAGE_FAULT = 12
+CAUSE_LOAD_PAGE_FAULT = 13
+CAUSE_STORE_PAGE_FAULT = 15
+
+# The fields of satp and of an Sv32 page table entry
+SATP_MODE_SV32 = 1 << 31
+SATP_PPN_MASK = (1 << 22) - 1
+PTE_V = 1 << 0
+PTE_R = 1 << 1
+PTE_W = 1 << 2
+PTE_X = 1 << 3
+PTE_U = 1 << 4
+PTE_A = 1 << 6
+PTE_D = 1 << 7
+
+# The bits of mstatus that change the permission checks
+MSTATUS_SUM = 1 << 18  # Supervisor mode can access the user pages
+MSTATUS_MXR = 1 << 19  # The executable pages can be read
+
+# The kinds of access, each one has its own TLB
+ACCESS_READ = 0
+ACCESS_WRITE = 1
+ACCESS_FETCH = 2
+
+access_causes = {ACCESS_READ: CAUSE_LOAD_PAGE_FAULT, ACCESS_WRITE: CAUSE_STORE_PAGE_FAULT,
+                 ACCESS_FETCH: CAUSE_FETCH_PAGE_FAULT}
+
+
+class Trap(Exception):  # A synchronous exception of the guest, the cpu delivers it to the trap handler of the guest
+    def __init__(self, cause, value=0):
+        super().__init__(f"Trap {cause} at {hex(value)}")
+        self.cause = cause
+        self.value = value  # The faulting address of a page fault, written into mtval or stval
+
+
+class PageFault(Trap):  # Raised by a translation without a valid page table entry or without the permission
+    pass
+
+
+# The memory seen by a cpu running with Sv32 paging. The cpu turns its memory into a virtual memory while paging
+# is on, so the bare-metal memory accesses never pay for the translation. The class is laid over the class the
+# memory had, see virtual_class, and the translated accesses reach the physical memory through it, so a memory
+# that takes locks on its stores keeps taking them. The cpu puts the class back when paging is turned off.
+# The accesses look up the physical page number in the TLB of their kind of access, and walk the page table on a
+# miss. An entry is only added to a TLB when the page table allows the access, so a TLB hit needs no permission
+# check. The TLBs are flushed by configure, on every change of satp, of the privilege mode or of mstatus, and by
+# SFENCE.VMA. The decoded instructions are keyed by virtual address, so the execute permission is checked when an
+# instruction is first decoded and the decode cache is dropped whenever the address space may change.
+class VirtualMemory(Memory):
+    physical_class = Memory  # The class of the memory without paging
+
+    def configure(self, satp, privilege, mstatus):
+        self.root = (satp & SATP_PPN_MASK) << PAGE_BITS  # The address of the first level page table
+        self.privilege = privilege
+        self.status = mstatus
+        self.flush()
+
+    def flush(self):
+        self.read_tlb = {}
+        self.write_tlb = {}
+        self.fetch_tlb = {}
+
+    def walk(self, address, access):  # Returns the physical page number of an address and adds it to the TLB
+        table = self.root
+        shift = 22  # The first level entry maps 4 MiB, the second level one 4 KiB
+        while True:
+            entry_address = table + ((address >> shift) & 0x3ff) * 4
+            entry = super().read_word(entry_address)
+            if not entry & PTE_V or entry & (PTE_R | PTE_W) == PTE_W:
+                raise PageFault(access_causes[access], address)
+            if entry & (PTE_R | PTE_X):
+                break
+            if shift == PAGE_BITS:
+                raise PageFault(access_causes[access], address)  # There is no leaf at the last level
+            table = (entry >> 10) << PAGE_BITS
+            shift = PAGE_BITS
+
+        number = entry >> 10
+        if shift != PAGE_BITS:  # A superpage, its physical page number must be aligned
+            if number & 0x3ff:
+                raise PageFault(access_causes[access], address)
+            number |= (address >> PAGE_BITS) & 0x3ff
+
+        if not self.permitted(entry, access):
+            raise PageFault(access_causes[access], address)
+
+        updated = entry | PTE_A | (PTE_D if access == ACCESS_WRITE else 0)
+        if updated != entry:
+            super().write_word(updated, entry_address)
+
+        [self.read_tlb, self.write_tlb, self.fetch_tlb][access][address >> PAGE_BITS] = number
+        return number
+
+    def permitted(self, entry, access):
+        if self.privilege == PRIVILEGE_USER:
+            if not entry & PTE_U:
+                return False
+        elif entry & PTE_U and (access == ACCESS_FETCH or not self.status & MSTATUS_SUM):
+            return False
+
+        if access == ACCESS_READ:
+            return bool(entry & PTE_R or (self.status & MSTATUS_MXR and entry & PTE_X))
+        if access == ACCESS_WRITE:
+            return bool(entry & PTE_W)
+        return bool(entry & PTE_X)
+
+    def translate(self, address, access):  # Returns the physical address of a virtual address
+        number = [self.read_tlb, self.write_tlb, self.fetch_tlb][access].get(address >> PAGE_BITS)
+        if number is None:
+            number = self.walk(address, access)
+        return (number << PAGE_BITS) | (address & OFFSET_MASK)
+
+    def fetch_word(self, address):
+        number = self.fetch_tlb.get(address >> PAGE_BITS)
+        if number is None:
+            number = self.walk(address, ACCESS_FETCH)
+        return super().read_word((number << PAGE_BITS) | (address & OFFSET_MASK))
+
+    def read_word(self, address):
+        number = self.read_tlb.get(address >> PAGE_BITS)
+        if number is None:
+            number = self.walk(address, ACCESS_READ)
+        offset = address & OFFSET_MASK
+        if offset & 3:
+            return int.from_bytes(self.read_bytes(address, 4), "little")
+
+        page = self.read_page if number == self.read_number else self.get_page(number)
+        return page.words[offset >> 2]
+
+    def read_halfword(self, address):
+        number = self.read_tlb.get(address >> PAGE_BITS)
+        if number is None:
+            number = self.walk(address, ACCESS_READ)
+        offset = address & OFFSET_MASK
+        if offset & 1:
+            return int.from_bytes(self.read_bytes(address, 2), "little")
+
+        page = self.read_page if number == self.read_number else self.get_page(number)
+        return page.halfwords[offset >> 1]
+
+    def read_byte(self, address):
+        number = self.read_tlb.get(address >> PAGE_BITS)
+        if number is None:
+            number = self.walk(address, ACCESS_READ)
+
+        page = self.read_page if number == self.read_number else self.get_page(number)
+        return page.data[address & OFFSET_MASK]
+
+    # The stores drop the decoded instructions by virtual address, then store to the physical address through
+    # the class of the memory without paging
+    def write_word(self, data, address):
+        if address & 3:
+            self.write_bytes(address, (data & 0xffffffff).to_bytes(4, "little"))
+            return
+        if self.decode_cache:
+            self.invalidate(address, 4)
+
+        number = self.write_tlb.get(address >> PAGE_BITS)
+        if number is None:
+            number = self.walk(address, ACCESS_WRITE)
+        super().write_word(data, (number << PAGE_BITS) | (address & OFFSET_MASK))
+
+    def write_halfword(self, data, address):
+        if address & 1:
+            self.write_bytes(address, (data & 0xffff).to_bytes(2, "little"))
+            return
+        if self.decode_cache:
+            self.invalidate(address, 2)
+
+        number = self.write_tlb.get(address >> PAGE_BITS)
+        if number is None:
+            number = self.walk(address, ACCESS_WRITE)
+        super().write_halfword(data, (number << PAGE_BITS) | (address & OFFSET_MASK))
+
+    def write_byte(self, data, address):
+        if self.decode_cache:
+            self.invalidate(address, 1)
+
+        number = self.write_tlb.get(address >> PAGE_BITS)
+        if number is None:
+            number = self.walk(address, ACCESS_WRITE)
+        super().write_byte(data, (number << PAGE_BITS) | (address & OFFSET_MASK))
+
+    def chunks(self, address, size, access):  # Yields the physical address and size of each page of a range
+        while size > 0:
+            chunk = min(size, PAGE_SIZE - (address & OFFSET_MASK))
+            yield self.translate(address, access), chunk
+            address = (address + chunk) & 0xffffffff
+            size -= chunk
+
+    def read_bytes(self, address, size):
+        result = bytearray()
+        for physical, chunk in self.chunks(address, size, ACCESS_READ):
+            result += super().read_bytes(physical, chunk)
+        return result
+
+    def write_bytes(self, address, data):
+        data = memoryview(data).cast("B")
+        if self.decode_cache:
+            for word in range(address & ~3, address + len(data), 4):
+                self.invalidate(word, 1)
+
+        for physical, chunk in self.chunks(address, len(data), ACCESS_WRITE):
+            super().write_bytes(physical, data[:chunk])
+            data = data[chunk:]
+
+    def views(self, address, size):
+        for physical, chunk in self.chunks(address, size, ACCESS_READ):
+            yield from super().views(physical, chunk)
+
+    def writable_views(self, address, size):
+        if self.decode_cache:
+            for word in range(address & ~3, address + size, 4):
+                self.invalidate(word, 1)
+
+        for physical, chunk in self.chunks(address, size, ACCESS_WRITE):
+            yield from super().writable_views(physical, chunk)
+
+    def zero_run_end(self, address):  # The runs of zero words are followed inside the current page only
+        physical = self.translate(address, ACCESS_FETCH)
+        end = super().zero_run_end(physical)
+        page_end = (physical | OFFSET_MASK) + 1
+        return (address + min(end, page_end) - physical) & 0xffffffff
+
+
+virtual_classes = {Memory: VirtualMemory}  # The virtual memory class laid over each memory class
+
+
+def virtual_class(cls):  # Returns the class a memory of the given class takes while paging is on
+    virtual = virtual_classes.get(cls)
+    if virtual is None:
+        virtual = type(f"Virtual{cls.__name__}", (VirtualMemory, cls), {"physical_class": cls})
+        virtual_classes[cls] = virtual
+    return virtual
+
+
+def physical_class(memory):  # Returns the class of the memory without paging
+    return memory.physical_class if isinstance(memory, VirtualMemory) else type(memory)
@@ -1,27 +1,56 @@
 from memory import Memory
+from symbols import SymbolTable
 
+# The contiguous bytes of a dump are collected into chunks of at most this size before they are
+# copied into memory, so parsing uses a constant amount of memory besides the guest memory itself
+CHUNK_SIZE = 1 << 16
 
-def parse(filename):  # Parse the instructions from the given file and return a memory object
-    instructions = []
+
+# Yields the (address, value, size in bytes) entries of a dump, one line at a time. The symbol labels,
+# such as "80000000 <_start>:", are appended to symbols as (address, name) when a list is given.
+def read_dump(file, symbols=None):
+    for line in file:
+        line = line.replace(":", " ")
+        tokens = line.split()
+
+        try:
+            address = int(tokens[0], 16)
+            value = int(tokens[1], 16)
+        except (ValueError, IndexError):  # Section headers, symbol labels and empty lines
+            if symbols is not None and len(tokens) == 2 and tokens[1][0] == "<" and tokens[1][-1] == ">":
+                try:
+                    symbols.append((int(tokens[0], 16), tokens[1][1:-1]))
+                except ValueError:
+                    pass
+            continue
+
+        yield address, value, len(tokens[1]) // 2  # Data sections are dumped in halfwords as well as in words
+
+
+# Parse the instructions from the given file and return a memory object. The entries may come in any order
+# and from any number of sections, the execution starts at the address of the first entry.
+# The symbol labels of the dump become the symbol table of the memory.
+def parse(filename):
+    to_return = None
+    chunk = bytearray()
+    chunk_address = 0
+    symbols = []
 
     with open(filename, "r") as file:
-        for line in file:
-            line = line.replace(":", " ")
-            tokens = line.split()
-
-            try:
-                address = int(tokens[0], 16)
-                value = int(tokens[1], 16)
-                instructions.append((address, value))
-            except ValueError:
-                pass
-
-    begin = instructions[0][0]  # The starting address of the memory
-    end = instructions[len(instructions) - 1][0]  # The end address of the memory
-    size = end - begin + 16  # Compute the total size of the memory
-
-    to_return = Memory(size, begin)
-    for instruction in instructions:
-        address, data = instruction
-        to_return.write_word(data, address)
+        for address, value, size in read_dump(file, symbols):
+            if to_return is None:
+                to_return = Memory(address)
+
+            if address != chunk_address + len(chunk) or len(chunk) >= CHUNK_SIZE:  # Start a new chunk
+                to_return.write_bytes(chunk_address, chunk)
+                chunk = bytearray()
+                chunk_address = address
+
+            chunk += value.to_bytes(size, "little")
+
+    if to_return is None:
+        raise ValueError(f"There is no program in: {filename}")
+
+    to_return.write_bytes(chunk_address, chunk)
+    to_return.symbols = SymbolTable(symbols)
     return to_return
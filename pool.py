@@ -0,0 +1,108 @@
+import argparse
+import sys
+import time
+
+from memory import Memory
+from processor import Processor, StopReason, STOP_EXIT, STOP_BUDGET, STOP_FAULT
+from translator import Translator
+from system import System
+import image
+
+
+class PoolException(Exception):  # Throw when a machine is asked for while every machine of the pool is in use
+    pass
+
+
+# A cpu, its system and its memory, built once and reset in place between runs. The memory starts from
+# the pages of the pristine image, shared copy-on-write, so a reset only puts back the pages the run wrote.
+# The decoded instructions and the translated blocks survive the resets.
+class Machine:
+    def __init__(self, start, pages, engine="interpreter", streams=None):
+        self.start = start
+        self.pages = pages  # The pages of the pristine image, by page number
+
+        self.memory = Memory(start)
+        self.memory.pages = dict(pages)
+        self.system = System(self.memory, streams)
+        self.cpu = Processor(system=self.system)
+        self.cpu.pc = start
+        self.translator = Translator(self.cpu) if engine == "translator" else None
+
+    def run(self, max_steps=None):  # Runs the guest like Processor.run, with the engine of the machine
+        if self.translator is None:
+            return self.cpu.run(max_steps)
+
+        try:
+            executed = self.translator.run(max_steps)
+        except Exception as error:
+            return StopReason(STOP_FAULT, self.cpu.pc, 0, error)
+        return StopReason(STOP_EXIT if self.system.terminate else STOP_BUDGET, self.cpu.pc, executed)
+
+    def reset(self):  # Returns the number of pages put back
+        dirty = len(self.memory.dirty_pages)
+        self.memory.restore_pages(self.pages)
+        self.system.reset(self.memory)
+        self.cpu.reset(self.start)
+        return dirty
+
+
+# Machines built from a single image, handed out by acquire and reset by release. Each run pays for
+# the pages it wrote instead of loading the image and building a machine.
+class MachinePool:
+    def __init__(self, memory, size, engine="interpreter", streams=None):
+        pages = memory.share_pages()
+        self.machines = [Machine(memory.start, pages, engine, streams) for _ in range(size)]
+        self.free = list(self.machines)
+
+        self.runs = 0  # The runs released back to the pool
+        self.reset_pages = 0  # The pages put back by the resets
+        self.begin = time.perf_counter()
+
+    def acquire(self):
+        if not self.free:
+            raise PoolException(f"The {len(self.machines)} machines of the pool are in use")
+        return self.free.pop()
+
+    def release(self, machine):  # Resets the machine and gives it back to the pool
+        self.reset_pages += machine.reset()
+        self.runs += 1
+        self.free.append(machine)
+
+    def run(self, max_steps=None, setup=None):  # Runs the image once, after calling setup with the machine
+        machine = self.acquire()
+        try:
+            if setup is not None:
+                setup(machine)
+            return machine.run(max_steps)
+        finally:
+            self.release(machine)
+
+    def stats(self):
+        seconds = time.perf_counter() - self.begin
+        return {"runs": self.runs, "seconds": seconds, "runs_per_second": self.runs / seconds if seconds > 0 else 0.0,
+                "reset_pages_per_run": self.reset_pages / self.runs if self.runs else 0.0}
+
+
+def main(arguments=None):
+    arguments_parser = argparse.ArgumentParser(description="Runs an image many times on a pool of machines")
+    arguments_parser.add_argument("program", help="a memory dump or an ELF executable")
+    arguments_parser.add_argument("--runs", type=int, default=1000)
+    arguments_parser.add_argument("--engine", choices=["interpreter", "translator"], default="interpreter")
+    arguments_parser.add_argument("--max-steps", type=int, default=None, help="instruction budget of each run")
+    arguments = arguments_parser.parse_args(arguments)
+
+    pool = MachinePool(image.load(arguments.program), 1, arguments.engine)
+    reasons = {}
+    for _ in range(arguments.runs):
+        stop = pool.run(arguments.max_steps)
+        reasons[stop.reason] = reasons.get(stop.reason, 0) + 1
+
+    stats = pool.stats()
+    print(f"{stats['runs']} runs in {stats['seconds']:.2f} seconds, {stats['runs_per_second']:.1f} runs per second, "
+          f"{stats['reset_pages_per_run']:.1f} pages reset per run")
+    print(", ".join(f"{count} {reason}" for reason, count in sorted(reasons.items())))
+    return 0 if set(reasons) == {STOP_EXIT} else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
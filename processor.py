@@ -1,6 +1,13 @@
-import math
+import contextlib
+import operator
+import sys
 
-from system import system
+from bus import TimeBehind
+from memory import OFFSET_MASK
+from mmu import (VirtualMemory, Trap, virtual_class, ACCESS_READ, PRIVILEGE_USER, PRIVILEGE_SUPERVISOR,
+                 PRIVILEGE_MACHINE, SATP_MODE_SV32, MSTATUS_SUM, MSTATUS_MXR)
+from scheduler import Scheduler
+from system import system as default_system
 
 # LUI instruction opcode
 OP_LUI = 0b0110111
@@ -13,40 +20,161 @@ OP_JAL = 0b1101111
 
 # JALR instruction opcode
 OP_JALR = 0b1100111
+JALR_FUNCT3 = 0b000
 
 # BRANCH instruction opcode
 OP_BRANCH = 0b1100011
 BRANCH_FUNCT3_BEQ = 0b000
 BRANCH_FUNCT3_BNE = 0b001
+BRANCH_FUNCT3_BLT = 0b100
+BRANCH_FUNCT3_BGE = 0b101
+BRANCH_FUNCT3_BLTU = 0b110
+BRANCH_FUNCT3_BGEU = 0b111
 
 # IMM instruction opcode
 OP_IMM = 0b0010011
 IMM_FUNCT3_ADDI = 0
 IMM_FUNCT3_SLTI = 0b010
 IMM_FUNCT3_SLTIU = 0b011
-IMM_FUNCT3_SLLI = 0b001
+IMM_FUNCT3_XORI = 0b100
 IMM_FUNCT3_ORI = 0b110
+IMM_FUNCT3_ANDI = 0b111
+IMM_FUNCT3_SLLI = 0b001
+IMM_FUNCT3_SRLI = 0b101  # SRLI and SRAI share funct3, they are told apart by the upper 7 bits of the immediate
+IMM_FUNCT7_SRLI = 0b0000000
+IMM_FUNCT7_SRAI = 0b0100000
 
 # OP instruction opcode - integer register-register operations
 OP_OP = 0b0110011
 OP_FUNCT7_STANDARD = 0b0000000  # Standard operations
-OP_FUNCT3_SRL = 0b101
+OP_FUNCT7_ALTERNATE = 0b0100000  # SUB and SRA
+OP_FUNCT3_ADD = 0b000
+OP_FUNCT3_SLL = 0b001
+OP_FUNCT3_SLT = 0b010
+OP_FUNCT3_SLTU = 0b011
 OP_FUNCT3_XOR = 0b100
-OP_FUNC7_MULDIV = 0b0000001  # Multiply and divide operations
+OP_FUNCT3_SRL = 0b101
+OP_FUNCT3_OR = 0b110
+OP_FUNCT3_AND = 0b111
+OP_FUNC7_MULDIV = 0b0000001  # Multiply and divide operations, the M extension
+OP_FUNCT3_MUL = 0b000
+OP_FUNCT3_MULH = 0b001
+OP_FUNCT3_MULHSU = 0b010
+OP_FUNCT3_MULHU = 0b011
+OP_FUNCT3_DIV = 0b100
+OP_FUNCT3_DIVU = 0b101
 OP_FUNCT3_REM = 0b110
+OP_FUNCT3_REMU = 0b111
 
 # SYSTEM instruction opcode
 OP_SYSTEM = 0b1110011
+SYSTEM_FUNCT3_PRIV = 0b000  # ECALL, EBREAK and the other privileged instructions, told apart by funct12
 SYSTEM_FUNCT12_ECALL = 0b000000000000
+SYSTEM_FUNCT12_SRET = 0b000100000010
+SYSTEM_FUNCT12_WFI = 0b000100000101
+SYSTEM_FUNCT12_MRET = 0b001100000010
+SYSTEM_FUNCT7_SRET = 0b0001000  # SRET and WFI
+SYSTEM_FUNCT7_SFENCE_VMA = 0b0001001
+SYSTEM_FUNCT7_MRET = 0b0011000
+SYSTEM_FUNCT3_CSRRW = 0b001  # The CSR instructions, the CSR number is held in the immediate
+SYSTEM_FUNCT3_CSRRS = 0b010
+SYSTEM_FUNCT3_CSRRC = 0b011
+SYSTEM_FUNCT3_CSRRWI = 0b101  # The immediate versions take a 5-bit unsigned immediate from the rs1 field
+SYSTEM_FUNCT3_CSRRSI = 0b110
+SYSTEM_FUNCT3_CSRRCI = 0b111
+
+# CSR numbers
+CSR_SSTATUS = 0x100  # A view of the supervisor bits of mstatus
+CSR_STVEC = 0x105
+CSR_SSCRATCH = 0x140
+CSR_SEPC = 0x141
+CSR_SCAUSE = 0x142
+CSR_STVAL = 0x143
+CSR_SATP = 0x180  # Sv32 paging mode and the physical page number of the root page table
+CSR_MSTATUS = 0x300
+CSR_MISA = 0x301
+CSR_MEDELEG = 0x302  # The exceptions delegated to supervisor mode
+CSR_MIDELEG = 0x303
+CSR_MIE = 0x304  # The interrupts enabled, by their bit in mip
+CSR_MTVEC = 0x305
+CSR_MSCRATCH = 0x340
+CSR_MEPC = 0x341
+CSR_MCAUSE = 0x342
+CSR_MTVAL = 0x343
+CSR_MIP = 0x344  # The pending interrupts, the machine level bits are set by the devices
+CSR_MHARTID = 0xf14  # The id of the hart running the code, read-only
+
+MISA_RV32IMASU = (1 << 30) | (1 << 0) | (1 << 8) | (1 << 12) | (1 << 18) | (1 << 20)
+
+# The bits of mstatus
+MSTATUS_SIE = 1 << 1
+MSTATUS_MIE = 1 << 3
+MSTATUS_SPIE = 1 << 5
+MSTATUS_MPIE = 1 << 7
+MSTATUS_SPP = 1 << 8
+MSTATUS_MPP_SHIFT = 11
+MSTATUS_MPP = 0b11 << MSTATUS_MPP_SHIFT
+SSTATUS_MASK = MSTATUS_SIE | MSTATUS_SPIE | MSTATUS_SPP | MSTATUS_SUM | MSTATUS_MXR
+
+CAUSE_USER_ECALL = 8  # An ECALL from user mode, the privilege mode is added for the other modes
+
+# The machine level interrupts, by their code in mcause and their bit in mip and mie
+INTERRUPT_BIT = 1 << 31  # Set in mcause when the trap is an interrupt
+INTERRUPT_SOFTWARE = 3
+INTERRUPT_TIMER = 7
+INTERRUPT_EXTERNAL = 11
+interrupt_priority = [INTERRUPT_EXTERNAL, INTERRUPT_SOFTWARE, INTERRUPT_TIMER]
+MIP_MSIP = 1 << INTERRUPT_SOFTWARE
+MIP_MTIP = 1 << INTERRUPT_TIMER
+MIP_MEIP = 1 << INTERRUPT_EXTERNAL
+MIP_WRITABLE = (1 << 1) | (1 << 5) | (1 << 9)  # Only the supervisor bits of mip can be written by the guest
+
+# AMO instruction opcode - the atomic memory operations of the A extension
+OP_AMO = 0b0101111
+AMO_FUNCT3_W = 0b010
+AMO_FUNCT5_LR = 0b00010  # The operation is held in the upper 5 bits of funct7, the lower 2 bits are aq and rl
+AMO_FUNCT5_SC = 0b00011
+AMO_FUNCT5_SWAP = 0b00001
+AMO_FUNCT5_ADD = 0b00000
+AMO_FUNCT5_XOR = 0b00100
+AMO_FUNCT5_AND = 0b01100
+AMO_FUNCT5_OR = 0b01000
+AMO_FUNCT5_MIN = 0b10000
+AMO_FUNCT5_MAX = 0b10100
+AMO_FUNCT5_MINU = 0b11000
+AMO_FUNCT5_MAXU = 0b11100
+
+# MISC-MEM instruction opcode - the fences
+OP_MISC_MEM = 0b0001111
+MISC_MEM_FUNCT3_FENCE = 0b000
+MISC_MEM_FUNCT3_FENCE_I = 0b001
 
 # LOAD instruction opcode
 OP_LOAD = 0b0000011
+LOAD_FUNCT3_LB = 0b000
+LOAD_FUNCT3_LH = 0b001
 LOAD_FUNCT3_LW = 0b010
+LOAD_FUNCT3_LBU = 0b100
+LOAD_FUNCT3_LHU = 0b101
 
 # STORE instruction opcode
 OP_STORE = 0b0100011
+STORE_FUNCT3_SB = 0b000
+STORE_FUNCT3_SH = 0b001
 STORE_FUNCT3_SW = 0b010
 
+# An all-zero word, there is no instruction at the address and the cpu skips over it
+OP_EMPTY = 0
+
+WORD_MASK = 0xffffffff  # Keeps the lower 32 bits of a result, used inline by the fused handlers
+SIGN_BIT = 1 << 31  # Flipping it orders signed 32-bit values like unsigned ones
+
+# The reasons Processor.run returns for
+STOP_EXIT = "exit"  # The guest called the exit system call
+STOP_BUDGET = "budget"  # The maximum number of steps was executed
+STOP_BREAKPOINT = "breakpoint"  # The next instruction is at one of the breakpoints
+STOP_FAULT = "fault"  # The instruction at pc raised an error
+
 # Assembler mnemonics for the registers
 mnemonics = ["zero",
              "ra",
@@ -101,439 +229,1237 @@ def ignore_overflow(n, bits):  # Keeps only the first bits of the given number
     return n & bit_mask_prefix(bits)
 
 
+def initial_csrs(hart_id):  # The CSRs of a cpu after a reset
+    csrs = {csr: 0 for csr in (CSR_STVEC, CSR_SSCRATCH, CSR_SEPC, CSR_SCAUSE, CSR_STVAL, CSR_SATP, CSR_MSTATUS,
+                               CSR_MEDELEG, CSR_MIDELEG, CSR_MIE, CSR_MTVEC, CSR_MSCRATCH, CSR_MEPC, CSR_MCAUSE,
+                               CSR_MTVAL, CSR_MIP)}
+    csrs[CSR_MISA] = MISA_RV32IMASU
+    csrs[CSR_MHARTID] = hart_id
+    return csrs
+
+
+def dispatch_key(opcode, funct3, funct7):  # Returns the key of an instruction in the execution table
+    return opcode | (funct3 << 7) | (funct7 << 10)
+
+
+# A decoded instruction. Every instruction has the same fields, the ones its format does not use are zero.
+# The immediate is already sign-extended and shifted into place, and execute is the handler
+# found in the execution table, so executing a decoded instruction needs no further lookups.
+class Instruction:
+    __slots__ = ("execute", "opcode", "funct3", "funct7", "rd", "rs1", "rs2", "imm", "word")
+    size = 1  # The number of instructions run by the handler
+
+    def __init__(self, execute, opcode, funct3=0, funct7=0, rd=0, rs1=0, rs2=0, imm=0):
+        self.execute = execute
+        self.opcode = opcode
+        self.funct3 = funct3
+        self.funct7 = funct7
+        self.rd = rd
+        self.rs1 = rs1
+        self.rs2 = rs2
+        self.imm = imm
+        self.word = 0  # The raw instruction, set by decode
+
+    def __repr__(self):
+        return (f"{self.execute.__name__}(rd={self.rd}, rs1={self.rs1}, rs2={self.rs2}, imm={self.imm}, "
+                f"funct3={self.funct3}, funct7={self.funct7})")
+
+
+# Two adjacent instructions run by a single handler, see Processor.predecode. The operand fields are the ones of
+# the first instruction, second is the other instruction of the pair. value holds the constant of the pair:
+# the sum of the two immediates, or for a branch the bias of its comparison, which is applied to both operands.
+# Everything that looks at one instruction at a time uses first, see unfused.
+class FusedInstruction(Instruction):
+    __slots__ = ("first", "second", "value", "compare")
+    size = 2
+
+    def __init__(self, execute, first, second):
+        super().__init__(execute, first.opcode, first.funct3, first.funct7, first.rd, first.rs1, first.rs2, first.imm)
+        self.word = first.word
+        self.first = first
+        self.second = second
+        self.compare, self.value = branch_conditions.get(second.execute, (None, (first.imm + second.imm) & WORD_MASK))
+
+    def __repr__(self):
+        return f"fused({self.first!r}, {self.second!r})"
+
+
+def unfused(decoded):  # Returns the first instruction of a fused pair, or the instruction itself
+    return decoded.first if type(decoded) is FusedInstruction else decoded
+
+
+# Why and where Processor.run stopped. pc is the address of the next instruction to execute,
+# or of the faulting one, and error holds the exception of a fault.
+class StopReason:
+    __slots__ = ("reason", "pc", "executed", "error")
+
+    def __init__(self, reason, pc, executed, error=None):
+        self.reason = reason
+        self.pc = pc
+        self.executed = executed  # The number of instructions executed by the run
+        self.error = error
+
+    def __repr__(self):
+        error = f", error={self.error!r}" if self.error is not None else ""
+        return f"StopReason({self.reason}, pc={hex(self.pc)}, executed={self.executed}{error})"
+
+
 # This class implements the functionality of a RISC-V 32-bit cpu
 class Processor:
 
-    def __init__(self):
+    # The system holds the memory and the system call state of the machine, the shared default system
+    # is used when none is given. Each machine of a process needs its own system.
+    def __init__(self, hart_id=0, system=None):
+        self.system = system if system is not None else default_system
+
         self.architecture = 32  # how many bits per register
 
         self.num_registers = 32  # the number of registers in the cpu
 
-        self.registers = [0] * 32  # the register file, from x0 to x31
+        # the register file, from x0 to x31. The registers always hold unsigned 32-bit values, every handler
+        # writes its result in that form, so the handlers never have to normalize their operands.
+        # A list is used rather than an array('I'), whose reads create a new int object every time.
+        self.registers = [0] * 32
 
         self.pc = 0  # the program counter, holds the address of the current instruction
 
         self.instruction_size = 4  # how many bytes per instruction
 
+        self.privilege = PRIVILEGE_MACHINE  # the privilege mode, the cpu starts in machine mode
+        self.csrs = initial_csrs(hart_id)  # the control and status registers, by number
+        self.scheduler = Scheduler()  # the timed events of the devices, the time is counted in instructions
+
+        # The locks that make the atomic memory operations atomic, picked by address. A single hart needs
+        # none, the harts of a multi-hart machine share the locks of their shared memory, and the store
+        # generations: a counter per lock, bumped by every store made under the lock.
+        self.atomic_locks = [contextlib.nullcontext()]
+        self.store_generations = None
+        self.reservation = None  # the address reserved by LR and the store generation of its lock then
+
+        self.instrumentation = []  # Observers of every executed instruction, see attach
+        self.system_handler = Processor.execute_system  # The handler of ECALL, the run loop looks for the exit after it
+        self.fused_pairs = 0  # The fused pairs executed, each one stands for two instructions
+
+        if self.system.debug:
+            self.attach(DebugPrinter())
+
+    def reset(self, pc):  # Puts the cpu back in its initial state, to start again at the given address
+        self.registers[:] = [0] * self.num_registers
+        self.pc = pc
+        self.privilege = PRIVILEGE_MACHINE
+        self.csrs = initial_csrs(self.csrs[CSR_MHARTID])
+        self.reservation = None
+        self.fused_pairs = 0
+        self.scheduler.reset()
+        self.update_translation()
+
     def advance_pc(self):
         self.pc = ignore_overflow(self.pc + self.instruction_size, self.architecture)
 
     def cycle(self):
-        to_execute = system.memory.read_word(self.pc)  # Fetch a new instruction
-        if to_execute == 0:  # There is no instruction at the current address
-            if system.debug:
-                print(f"Skipping over memory address:{self.pc}")
-            self.advance_pc()
-        else:
-            decoded = self.decode(to_execute)  # Decode the instruction
+        decode_cache = self.system.memory.decode_cache
+        try:
+            decoded = decode_cache.get(self.pc)  # Look for an already decoded instruction at this address
+            if decoded is None:
+                to_execute = self.system.memory.fetch_word(self.pc)  # Fetch a new instruction
+                decoded = self.decode(to_execute)  # Decode the instruction
+                decode_cache[self.pc] = decoded  # Stores to this address will invalidate the entry
+            elif type(decoded) is FusedInstruction:  # A cycle executes a single instruction
+                decoded = decoded.first
+
+            decoded.execute(self, decoded)  # Execute the instruction
+        except Trap as trap:  # The trap goes to the trap handler of the guest, when it has one
+            if not self.enter_trap(trap):
+                raise
 
-            self.execute(decoded)  # Execute the instruction
+        # The x0 register is hardwired to zero, so reset it after execution
+        self.registers[0] = 0
+
+    # Runs up to max_steps instructions, or until the guest exits, and returns a StopReason.
+    # The state used by every step is bound to locals, and the exit is only checked after a system call.
+    # A breakpoint stops the run before its instruction executes, unless it is the first one of the run,
+    # so calling run again resumes from it. A trap is delivered to the guest and the run goes on from its handler.
+    # The instructions missing the decode cache are predecoded, so the loop runs the fused pairs as one step.
+    # The run is split into slices that end when the next event of the scheduler is due. The time is brought
+    # up to date and the pending interrupts are taken between the slices only, a run without events is one slice.
+    # A device access ends the slice before it has any effect, see Bus.current, and its instruction then runs
+    # alone with the time up to date, so the devices read the exact time and an event they schedule starts a
+    # new slice.
+    def run(self, max_steps=None, breakpoints=()):
+        system = self.system
+        if system.terminate:
+            return StopReason(STOP_EXIT, self.pc, 0)
+        if self.instrumentation:
+            return self.run_cycles(max_steps, breakpoints)
+
+        memory = system.memory
+        decode_cache = memory.decode_cache
+        bus = memory.bus
+        registers = self.registers
+        execute_system = self.system_handler
+        scheduler = self.scheduler
+        limit = sys.maxsize if max_steps is None else max_steps
+        executed = 0
+        timed = 0  # The executed instructions already added to the time of the scheduler
+        if breakpoints:
+            self.unfuse(breakpoints)
+
+        bus.current = False
+        try:
+            while True:
+                try:
+                    while executed < limit:
+                        scheduler.advance(executed - timed)
+                        timed = executed
+                        if self.csrs[CSR_MIP]:
+                            self.take_interrupt()
+
+                        if bus.current:  # The instruction of the device access that ended the last slice
+                            end = executed + 1
+                        else:
+                            end = min(limit, executed + scheduler.span())
+                        last = end - 1  # A fused pair may run as the last step, so leave room for both instructions
+                        while executed < last:
+                            pc = self.pc
+                            if pc in breakpoints and executed:
+                                return StopReason(STOP_BREAKPOINT, pc, executed)
+
+                            decoded = decode_cache.get(pc)
+                            if decoded is None:
+                                decoded = self.predecode(pc, breakpoints)
+
+                            execute = decoded.execute
+                            execute(self, decoded)
+                            registers[0] = 0
+                            executed += decoded.size
+
+                            if execute is execute_system and system.terminate:
+                                return StopReason(STOP_EXIT, self.pc, executed)
+
+                        if executed < end:  # A single instruction is left in the slice
+                            if self.pc in breakpoints and executed:
+                                return StopReason(STOP_BREAKPOINT, self.pc, executed)
+                            self.cycle()
+                            executed += 1
+                            if system.terminate:
+                                return StopReason(STOP_EXIT, self.pc, executed)
+                        bus.current = False
+
+                    return StopReason(STOP_BUDGET, self.pc, executed)
+                except TimeBehind:
+                    bus.current = True
+                except Trap as trap:
+                    if not self.enter_trap(trap):
+                        return StopReason(STOP_FAULT, self.pc, executed, trap)
+                except Exception as error:
+                    return StopReason(STOP_FAULT, self.pc, executed, error)
+        finally:
+            bus.current = True
+            scheduler.advance(executed - timed)
+
+    def run_cycles(self, max_steps, breakpoints):  # The run loop of an instrumented cpu, one cycle at a time
+        system = self.system
+        scheduler = self.scheduler
+        limit = -1 if max_steps is None else max_steps
+        executed = 0
+
+        try:
+            while executed != limit:
+                if self.pc in breakpoints and executed:
+                    return StopReason(STOP_BREAKPOINT, self.pc, executed)
+
+                self.cycle()
+                executed += 1
+                scheduler.advance(1)
+                if self.csrs[CSR_MIP]:
+                    self.take_interrupt()
+
+                if system.terminate:
+                    return StopReason(STOP_EXIT, self.pc, executed)
+        except Exception as error:
+            return StopReason(STOP_FAULT, self.pc, executed, error)
+
+        return StopReason(STOP_BUDGET, self.pc, executed)
+
+    def fetch(self, pc):  # Returns the decoded instruction at the given address
+        decode_cache = self.system.memory.decode_cache
+        decoded = decode_cache.get(pc)
+        if decoded is None:
+            decoded = self.decode(self.system.memory.fetch_word(pc))
+            decode_cache[pc] = decoded
+        return unfused(decoded)
+
+    # Decodes the instruction at pc into the decode cache and returns it, fused with the following instruction
+    # when the pair has a fused handler. The following instruction of a pair is put in the cache as well, so a jump
+    # into the middle of the pair finds it on its own, and a store into it drops the pair with it. It is left out
+    # otherwise, so it can start a pair of its own. No pair is fused across the end of a page or over a breakpoint.
+    def predecode(self, pc, breakpoints=()):
+        memory = self.system.memory
+        decode_cache = memory.decode_cache
+        decoded = self.decode(memory.fetch_word(pc))
+        decode_cache[pc] = decoded
+
+        following = (pc + 4) & WORD_MASK
+        if decoded.execute not in fusion_firsts or not following & OFFSET_MASK or following in breakpoints:
+            return decoded
+
+        second = decode_cache.get(following)
+        if second is None:
+            try:
+                second = self.decode(memory.fetch_word(following))
+            except (NotImplementedError, Trap):  # The following word is data or is not mapped
+                return decoded
+
+        execute = fusion_table.get((decoded.execute, second.execute))
+        # The second instruction must use the result of the first one, which cannot be x0
+        if execute is None or decoded.rd == 0 or decoded.rd not in (second.rs1, second.rs2):
+            return decoded
+
+        fused = FusedInstruction(execute, decoded, second)
+        decode_cache[pc] = fused
+        decode_cache[following] = second
+        return fused
+
+    def unfuse(self, addresses):  # Splits the fused pairs whose second instruction is at one of the addresses
+        decode_cache = self.system.memory.decode_cache
+        for address in addresses:
+            decoded = decode_cache.get((address - 4) & WORD_MASK)
+            if type(decoded) is FusedInstruction:
+                decode_cache[(address - 4) & WORD_MASK] = decoded.first
+
+    # The cycle used while instrumentation is attached. Each observer is called with the cpu and the
+    # decoded instruction before it executes, and with the cpu, the old pc and the instruction after.
+    # An instruction that traps is not seen by the observers after it.
+    def cycle_instrumented(self):
+        pc = self.pc
+        try:
+            decoded = self.fetch(pc)
+
+            for observer in self.instrumentation:
+                observer.before(self, decoded)
+
+            decoded.execute(self, decoded)
+        except Trap as trap:
+            if not self.enter_trap(trap):
+                raise
+            return
+        self.registers[0] = 0
+
+        for observer in self.instrumentation:
+            observer.after(self, pc, decoded)
 
-            if system.debug:
-                print(f"Execute {decoded} , OPCODE: {bin(decoded[0])}")
-                self.debug_registers()  # Debug registers to stdout
+    # Attaches an observer of the executed instructions. The cycle method is replaced by the instrumented
+    # one, so a cpu without instrumentation never checks for it.
+    def attach(self, observer):
+        self.instrumentation.append(observer)
+        self.cycle = self.cycle_instrumented
 
-    def decode(self, instruction):  # Decodes the instruction and returns the instruction operands
+    def detach(self, observer):
+        self.instrumentation.remove(observer)
+        if not self.instrumentation:
+            del self.cycle  # Back to the plain cycle of the class
+
+    # Decodes the instruction and returns the instruction operands. The operand fields are extracted
+    # by the decoder of the instruction format, and the handler is looked up in the execution table.
+    def decode(self, instruction):
+        if instruction == 0:
+            return Instruction(Processor.execute_empty, OP_EMPTY)
 
         opcode = instruction & bit_mask_prefix(7)
-        instruction >>= 7  # get rid of the first 7 bits that denote the opcode
-
-        if opcode == OP_LUI:
-            return self.decode_lui(instruction)
-        elif opcode == OP_AUIPC:
-            return self.decode_auipc(instruction)
-        elif opcode == OP_JAL:
-            return self.decode_jal(instruction)
-        elif opcode == OP_JALR:
-            return self.decode_jalr(instruction)
-        elif opcode == OP_BRANCH:
-            return self.decode_branch(instruction)
-        elif opcode == OP_IMM:
-            return self.decode_imm(instruction)
-        elif opcode == OP_SYSTEM:
-            return self.decode_system(instruction)
-        elif opcode == OP_LOAD:
-            return self.decode_load(instruction)
-        elif opcode == OP_STORE:
-            return self.decode_store(instruction)
-        elif opcode == OP_OP:
-            return self.decode_op(instruction)
-        else:
+
+        decoder = decoders.get(opcode)
+        if decoder is None:
             raise NotImplementedError(f"Cannot decode opcode: {opcode}")
 
-    def decode_lui(self, instruction):  # Decodes a lui instruction
-        rd = instruction & bit_mask_prefix(5)
-        instruction >>= 5
+        funct3 = (instruction >> 12) & bit_mask_prefix(3)
+        funct7 = (instruction >> 25) & bit_mask_prefix(7)
+        # Unknown operations only fail once they are executed
+        execute = execution_table.get(dispatch_key(opcode, funct3, funct7), Processor.execute_unknown)
+
+        decoded = decoder(execute, opcode, funct3, funct7, instruction)
+        decoded.word = instruction
+        return decoded
 
-        imm = instruction & bit_mask_prefix(20)
-        instruction >>= 20
+    def execute(self, instruction):  # Executes the given instruction
+        instruction.execute(self, instruction)
 
-        return [OP_LUI, rd, imm]
+        # The x0 register is hardwired to zero, so reset it after execution
+        self.registers[0] = 0
 
-    def decode_auipc(self, instruction):  # Decodes an auipc instruction
-        rd = instruction & bit_mask_prefix(5)
-        instruction >>= 5
+    # There is no instruction at the current address, skip over it and the zero words following it
+    def execute_empty(self, instruction):
+        self.pc = self.system.memory.zero_run_end(self.pc)
 
-        imm = instruction & bit_mask_prefix(20)
-        instruction >>= 20
+    # The instruction was decoded, but there is no handler for its funct3/funct7 combination
+    def execute_unknown(self, instruction):
+        raise NotImplementedError(f"Cannot execute opcode: {instruction.opcode} funct3: {instruction.funct3} "
+                                  f"funct7: {instruction.funct7}")
 
-        return [OP_AUIPC, rd, imm]
+    # Overwrite the top 20 bits of the destination register and set the other 12 bits to zero
+    def execute_lui(self, instruction):
+        self.registers[instruction.rd] = instruction.imm
+        self.advance_pc()
 
-    def decode_jal(self, instruction):  # Decodes a jal instruction
-        rd = instruction & bit_mask_prefix(5)
-        instruction >>= 5
+    # Build a 32 bit offset from the 20 bit immediate, add the offset to pc and save
+    # the result in the destination register
+    def execute_auipc(self, instruction):
+        self.registers[instruction.rd] = ignore_overflow(self.pc + instruction.imm, self.architecture)
+        self.advance_pc()
 
-        jal_19_12 = bit_mask_prefix(8) & instruction
-        instruction >>= 8
+    # Add the offset (in multiples of 2 bytes) to the pc and store the address of the instruction
+    # following the jump (pc+4) into the destination register
+    def execute_jal(self, instruction):
+        return_address = ignore_overflow(self.pc + self.instruction_size, self.architecture)
+        self.pc = ignore_overflow(self.pc + instruction.imm, self.architecture)
+        self.registers[instruction.rd] = return_address
+
+    # Jump to rs1 plus the sign-extended offset, with the lowest bit cleared, and store the address
+    # of the instruction following the jump (pc+4) into the destination register
+    def execute_jalr(self, instruction):
+        return_address = ignore_overflow(self.pc + self.instruction_size, self.architecture)
+        self.pc = ignore_overflow(self.registers[instruction.rs1] + instruction.imm, self.architecture) & ~1
+        self.registers[instruction.rd] = return_address
+
+    # Take the branch if the jump flag is set, else go to the next instruction
+    def branch(self, instruction, jump):
+        if jump:
+            self.pc = ignore_overflow(self.pc + instruction.imm, self.architecture)
+        else:
+            self.advance_pc()
+
+    def execute_beq(self, instruction):  # Branch if equal
+        self.branch(instruction, self.registers[instruction.rs1] == self.registers[instruction.rs2])
 
-        jal_11 = bit_mask_prefix(1) & instruction
-        instruction >>= 1
+    def execute_bne(self, instruction):  # Branch if not equal
+        self.branch(instruction, self.registers[instruction.rs1] != self.registers[instruction.rs2])
 
-        jal_10_1 = bit_mask_prefix(10) & instruction
-        instruction >>= 10
+    def execute_blt(self, instruction):  # Branch if less than, comparing the registers as signed integers
+        a = get_two_complement(self.registers[instruction.rs1], self.architecture)
+        b = get_two_complement(self.registers[instruction.rs2], self.architecture)
+        self.branch(instruction, a < b)
 
-        jal_20 = bit_mask_prefix(1) & instruction
-        instruction >>= 1
+    def execute_bge(self, instruction):  # Branch if greater or equal, comparing the registers as signed integers
+        a = get_two_complement(self.registers[instruction.rs1], self.architecture)
+        b = get_two_complement(self.registers[instruction.rs2], self.architecture)
+        self.branch(instruction, a >= b)
 
-        offset = jal_10_1 | (jal_11 << 10) | (jal_19_12 << 11) | (jal_20 << 19)
+    def execute_bltu(self, instruction):  # Branch if less than, comparing the registers as unsigned integers
+        self.branch(instruction, self.registers[instruction.rs1] < self.registers[instruction.rs2])
 
-        return [OP_JAL, rd, offset]
+    def execute_bgeu(self, instruction):  # Branch if greater or equal, comparing the registers as unsigned integers
+        self.branch(instruction, self.registers[instruction.rs1] >= self.registers[instruction.rs2])
+
+    # Add the sign extended 12-bit immediate to rs1. Ignore overflow and store the result into rd
+    def execute_addi(self, instruction):
+        result = ignore_overflow(self.registers[instruction.rs1] + instruction.imm, self.architecture)
+        self.registers[instruction.rd] = result
+        self.advance_pc()
 
-    def decode_jalr(self, instruction):  # Decodes a jalr instruction
-        rd = instruction & bit_mask_prefix(5)
-        instruction >>= 5
+    # Set less than immediate, place the value 1 in rd if rs1 is less than the sign-extended immediate,
+    # else 0 is written to rd
+    def execute_slti(self, instruction):
+        if get_two_complement(self.registers[instruction.rs1], self.architecture) < instruction.imm:
+            self.registers[instruction.rd] = 1
+        else:
+            self.registers[instruction.rd] = 0
+        self.advance_pc()
 
-        funct3 = instruction & bit_mask_prefix(3)
-        instruction >>= 3
+    # Set less than unsigned immediate, similar to SLTI but sign-extends the immediate then
+    # treats it and the rs register as unsigned integers
+    def execute_sltiu(self, instruction):
+        unsigned_immediate = instruction.imm & bit_mask_prefix(self.architecture)
 
-        rs1 = instruction & bit_mask_prefix(5)
-        instruction >>= 5
+        if self.registers[instruction.rs1] < unsigned_immediate:
+            self.registers[instruction.rd] = 1
+        else:
+            self.registers[instruction.rd] = 0
+        self.advance_pc()
 
-        imm_11_0 = instruction & bit_mask_prefix(12)
-        instruction >>= 12
+    def execute_xori(self, instruction):  # Logical xor with the sign-extended immediate
+        value = instruction.imm & bit_mask_prefix(self.architecture)
+        self.registers[instruction.rd] = self.registers[instruction.rs1] ^ value
+        self.advance_pc()
 
-        offset = imm_11_0
+    def execute_ori(self, instruction):  # Logical or with the sign-extended immediate
+        value = instruction.imm & bit_mask_prefix(self.architecture)
+        self.registers[instruction.rd] = self.registers[instruction.rs1] | value
+        self.advance_pc()
 
-        return [OP_JALR, rd, funct3, rs1, offset]
+    def execute_andi(self, instruction):  # Logical and with the sign-extended immediate
+        value = instruction.imm & bit_mask_prefix(self.architecture)
+        self.registers[instruction.rd] = self.registers[instruction.rs1] & value
+        self.advance_pc()
 
-    def decode_branch(self, instruction):  # Decodes a branch instruction
-        imm_11 = instruction & bit_mask_prefix(1)
-        instruction >>= 1
+    def execute_slli(self, instruction):  # Logical left shift
+        shift_amount = instruction.imm & bit_mask_prefix(5)  # the shift amount is encoded in the lower 5 bits of the imm
+        operand = self.registers[instruction.rs1]
+        self.registers[instruction.rd] = ignore_overflow(operand << shift_amount, self.architecture)
+        self.advance_pc()
 
-        imm_4_1 = instruction & bit_mask_prefix(4)
-        instruction >>= 4
+    def execute_srli(self, instruction):  # Logical right shift
+        shift_amount = instruction.imm & bit_mask_prefix(5)
+        self.registers[instruction.rd] = self.registers[instruction.rs1] >> shift_amount
+        self.advance_pc()
 
-        funct3 = instruction & bit_mask_prefix(3)
-        instruction >>= 3
+    def execute_srai(self, instruction):  # Arithmetic right shift, the sign bit is copied into the vacated bits
+        shift_amount = instruction.imm & bit_mask_prefix(5)
+        operand = get_two_complement(self.registers[instruction.rs1], self.architecture)
+        self.registers[instruction.rd] = ignore_overflow(operand >> shift_amount, self.architecture)
+        self.advance_pc()
 
-        rs1 = instruction & bit_mask_prefix(5)
-        instruction >>= 5
+    # Executes a system call. An ECALL from user or supervisor mode traps into the guest when it has a trap
+    # handler for it, the other ones are served by the system of the host.
+    def execute_system(self, instruction):
+        funct12 = instruction.imm & bit_mask_prefix(12)
+        if funct12 == SYSTEM_FUNCT12_ECALL:
+            if self.privilege != PRIVILEGE_MACHINE and self.trap_vector(CAUSE_USER_ECALL + self.privilege):
+                raise Trap(CAUSE_USER_ECALL + self.privilege)
+            self.system.call(self.registers)  # The number is passed in a7 and the parameters in a0 to a5
+        else:
+            raise NotImplementedError(f"Cannot execute funct12: {funct12}")
 
-        rs2 = instruction & bit_mask_prefix(5)
-        instruction >>= 5
+        self.advance_pc()
 
-        imm_10_5 = instruction & bit_mask_prefix(6)
-        instruction >>= 6
+    def execute_mret(self, instruction):  # Returns from a machine mode trap handler
+        if instruction.imm & bit_mask_prefix(12) != SYSTEM_FUNCT12_MRET:
+            raise NotImplementedError(f"Cannot execute funct12: {instruction.imm & bit_mask_prefix(12)}")
 
-        imm_12 = instruction & bit_mask_prefix(1)
-        instruction >>= 1
+        status = self.csrs[CSR_MSTATUS]
+        self.privilege = (status & MSTATUS_MPP) >> MSTATUS_MPP_SHIFT
+        if status & MSTATUS_MPIE:  # MPIE goes back into MIE
+            status |= MSTATUS_MIE
+        else:
+            status &= ~MSTATUS_MIE
+        self.csrs[CSR_MSTATUS] = (status & ~MSTATUS_MPP) | MSTATUS_MPIE
+        self.pc = self.csrs[CSR_MEPC]
+        self.update_translation()
+        self.take_interrupt()
+
+    # Returns from a supervisor mode trap handler. WFI moves the time to the next event of the scheduler when no
+    # interrupt is pending, so a waiting guest costs nothing, and carries on once one is.
+    def execute_sret(self, instruction):
+        funct12 = instruction.imm & bit_mask_prefix(12)
+        if funct12 == SYSTEM_FUNCT12_WFI:
+            self.advance_pc()
+            if not self.csrs[CSR_MIP] & self.csrs[CSR_MIE]:
+                self.scheduler.skip()
+            self.take_interrupt()
+            return
+        if funct12 != SYSTEM_FUNCT12_SRET:
+            raise NotImplementedError(f"Cannot execute funct12: {funct12}")
 
-        offset = imm_4_1 | (imm_10_5 << 4) | (imm_11 << 10) | (imm_12 << 11)
+        status = self.csrs[CSR_MSTATUS]
+        self.privilege = PRIVILEGE_SUPERVISOR if status & MSTATUS_SPP else PRIVILEGE_USER
+        if status & MSTATUS_SPIE:  # SPIE goes back into SIE
+            status |= MSTATUS_SIE
+        else:
+            status &= ~MSTATUS_SIE
+        self.csrs[CSR_MSTATUS] = (status & ~MSTATUS_SPP) | MSTATUS_SPIE
+        self.pc = self.csrs[CSR_SEPC]
+        self.update_translation()
+        self.take_interrupt()
+
+    def execute_sfence_vma(self, instruction):  # Flushes every translation, the address and ASID operands are ignored
+        memory = self.system.memory
+        if isinstance(memory, VirtualMemory):
+            memory.flush()
+        memory.flush_code()
+        self.advance_pc()
 
-        return [OP_BRANCH, offset, funct3, rs1, rs2]
+    # Orders the memory accesses. Every access of a hart reaches the memory before its next instruction runs,
+    # so the order is already the program order and there is nothing to wait for.
+    def execute_fence(self, instruction):
+        self.advance_pc()
 
-    def decode_imm(self, instruction):  # Decodes an imm instruction
-        rd = instruction & bit_mask_prefix(5)
-        instruction >>= 5
+    # Makes the stores to the code visible to the fetches of this hart. The stores of the hart drop the decoded
+    # instructions they overwrite already, but the harts of a multi-hart machine have a decode cache each and
+    # only see their own stores, so a hart runs the code written by another one after a FENCE.I, as the ISA asks.
+    def execute_fence_i(self, instruction):
+        self.system.memory.flush_code()
+        self.advance_pc()
 
-        funct3 = instruction & bit_mask_prefix(3)
-        instruction >>= 3
+    def trap_vector(self, cause):  # Returns the address of the handler of a trap, zero when the guest has none
+        if cause & INTERRUPT_BIT:  # The machine interrupts are never delegated, a vectored mtvec has one entry each
+            vector = self.csrs[CSR_MTVEC]
+            base = vector & ~3
+            return base + 4 * (cause & ~INTERRUPT_BIT) if base and vector & 1 else base
+        if self.privilege != PRIVILEGE_MACHINE and self.csrs[CSR_MEDELEG] >> cause & 1:
+            return self.csrs[CSR_STVEC] & ~3
+        return self.csrs[CSR_MTVEC] & ~3
+
+    # Delivers a trap to the handler of the guest, in supervisor mode when the exception is delegated to it.
+    # Returns False when the guest has no trap handler, the trap is then a fault of the emulator.
+    def enter_trap(self, trap):
+        vector = self.trap_vector(trap.cause)
+        if not vector:
+            return False
+
+        status = self.csrs[CSR_MSTATUS]
+        if self.privilege != PRIVILEGE_MACHINE and self.csrs[CSR_MEDELEG] >> trap.cause & 1:
+            self.csrs[CSR_SEPC] = self.pc
+            self.csrs[CSR_SCAUSE] = trap.cause
+            self.csrs[CSR_STVAL] = trap.value
+            status &= ~(MSTATUS_SPP | MSTATUS_SPIE | MSTATUS_SIE)
+            status |= (MSTATUS_SPP if self.privilege == PRIVILEGE_SUPERVISOR else 0)
+            status |= (MSTATUS_SPIE if self.csrs[CSR_MSTATUS] & MSTATUS_SIE else 0)
+            self.privilege = PRIVILEGE_SUPERVISOR
+        else:
+            self.csrs[CSR_MEPC] = self.pc
+            self.csrs[CSR_MCAUSE] = trap.cause
+            self.csrs[CSR_MTVAL] = trap.value
+            status &= ~(MSTATUS_MPP | MSTATUS_MPIE | MSTATUS_MIE)
+            status |= self.privilege << MSTATUS_MPP_SHIFT
+            status |= (MSTATUS_MPIE if self.csrs[CSR_MSTATUS] & MSTATUS_MIE else 0)
+            self.privilege = PRIVILEGE_MACHINE
+
+        self.csrs[CSR_MSTATUS] = status
+        self.pc = vector
+        self.update_translation()
+        return True
+
+    # Enters the trap handler of the pending interrupt with the highest priority, if it is enabled. The machine
+    # interrupts are enabled by their bit in mie, and by MIE of mstatus while the cpu runs in machine mode.
+    # An interrupt stays pending while the guest has no trap handler.
+    def take_interrupt(self):
+        pending = self.csrs[CSR_MIP] & self.csrs[CSR_MIE]
+        if not pending or self.privilege == PRIVILEGE_MACHINE and not self.csrs[CSR_MSTATUS] & MSTATUS_MIE:
+            return
+        for code in interrupt_priority:
+            if pending >> code & 1:
+                self.enter_trap(Trap(INTERRUPT_BIT | code))
+                return
+
+    # Turns the memory into a virtual memory while Sv32 paging applies, in user and supervisor mode with
+    # paging enabled by satp, and back into the class it had otherwise. The virtual memory class is laid over the
+    # class of the memory, see virtual_class. The object stays the same, so the run loop keeps using it.
+    # The decoded instructions are dropped when the addresses change their meaning.
+    def update_translation(self):
+        memory = self.system.memory
+        satp = self.csrs[CSR_SATP]
+        if satp & SATP_MODE_SV32 and self.privilege != PRIVILEGE_MACHINE:
+            if not isinstance(memory, VirtualMemory):
+                memory.__class__ = virtual_class(type(memory))
+                memory.flush_code()
+            memory.configure(satp, self.privilege, self.csrs[CSR_MSTATUS])
+        elif isinstance(memory, VirtualMemory):
+            memory.__class__ = memory.physical_class
+            memory.flush_code()
+
+    def read_csr(self, instruction):  # Returns the number and the value of the CSR of the instruction
+        csr = instruction.imm & bit_mask_prefix(12)
+        if csr == CSR_SSTATUS:
+            return csr, self.csrs[CSR_MSTATUS] & SSTATUS_MASK
+
+        value = self.csrs.get(csr)
+        if value is None:
+            raise NotImplementedError(f"Cannot access CSR: {hex(csr)}")
+        return csr, value
+
+    def write_csr(self, csr, value):
+        if csr >> 10 == 0b11:  # The top two bits of the number mark the read-only CSRs
+            raise NotImplementedError(f"Cannot write read-only CSR: {hex(csr)}")
+        if csr == CSR_SSTATUS:
+            csr, value = CSR_MSTATUS, (self.csrs[CSR_MSTATUS] & ~SSTATUS_MASK) | (value & SSTATUS_MASK)
+        elif csr == CSR_MIP:
+            value = (self.csrs[CSR_MIP] & ~MIP_WRITABLE) | (value & MIP_WRITABLE)
+        self.csrs[csr] = value & bit_mask_prefix(self.architecture)
+
+        if csr == CSR_SATP:
+            self.system.memory.flush_code()
+            self.update_translation()
+        elif csr == CSR_MSTATUS:
+            self.update_translation()
+
+    # Atomic read and write of a CSR, the old value is written into rd. Each CSR instruction looks for
+    # an interrupt once it is done, as its write may have enabled one that is pending.
+    def execute_csrrw(self, instruction):
+        csr, value = self.read_csr(instruction)
+        self.write_csr(csr, self.registers[instruction.rs1])
+        self.registers[instruction.rd] = value
+        self.advance_pc()
+        self.take_interrupt()
+
+    # Atomic read and set bits of a CSR. CSRRS and CSRRC do not write the CSR when rs1 is x0,
+    # so they can read the read-only CSRs.
+    def execute_csrrs(self, instruction):
+        csr, value = self.read_csr(instruction)
+        if instruction.rs1 != 0:
+            self.write_csr(csr, value | self.registers[instruction.rs1])
+        self.registers[instruction.rd] = value
+        self.advance_pc()
+        self.take_interrupt()
 
-        rs1 = instruction & bit_mask_prefix(5)
-        instruction >>= 5
+    def execute_csrrc(self, instruction):  # Atomic read and clear bits of a CSR
+        csr, value = self.read_csr(instruction)
+        if instruction.rs1 != 0:
+            self.write_csr(csr, value & ~self.registers[instruction.rs1])
+        self.registers[instruction.rd] = value
+        self.advance_pc()
+        self.take_interrupt()
 
-        imm_11_0 = instruction & bit_mask_prefix(12)
-        instruction >>= 12
+    def execute_csrrwi(self, instruction):  # The immediate versions use the rs1 field as the operand
+        csr, value = self.read_csr(instruction)
+        self.write_csr(csr, instruction.rs1)
+        self.registers[instruction.rd] = value
+        self.advance_pc()
+        self.take_interrupt()
 
-        return [OP_IMM, rd, funct3, rs1, imm_11_0]
+    def execute_csrrsi(self, instruction):
+        csr, value = self.read_csr(instruction)
+        if instruction.rs1 != 0:
+            self.write_csr(csr, value | instruction.rs1)
+        self.registers[instruction.rd] = value
+        self.advance_pc()
+        self.take_interrupt()
 
-    # Decodes a system instruction. We parse rd,funct3 and rs1 even if they are unused.
-    def decode_system(self, instruction):
-        rd = instruction & bit_mask_prefix(5)
-        instruction >>= 5
+    def execute_csrrci(self, instruction):
+        csr, value = self.read_csr(instruction)
+        if instruction.rs1 != 0:
+            self.write_csr(csr, value & ~instruction.rs1)
+        self.registers[instruction.rd] = value
+        self.advance_pc()
+        self.take_interrupt()
+
+    # Returns the address of an atomic operation and the index of its lock. The lock is picked by the physical
+    # address, like the one of the stores of the memory.
+    def atomic_address(self, instruction):
+        address = self.registers[instruction.rs1]
+        if address & 3:
+            raise NotImplementedError(f"Misaligned atomic memory operation at address: {hex(address)}")
+        if len(self.atomic_locks) == 1:
+            return address, 0
+        return address, (self.system.memory.translate(address, ACCESS_READ) >> 2) % len(self.atomic_locks)
+
+    # Atomically loads the word at rs1, stores operation(loaded word, rs2) in its place and writes the
+    # loaded word into rd. The operations and the stores of the other harts are kept apart by the lock.
+    def atomic(self, instruction, operation):
+        address, stripe = self.atomic_address(instruction)
+        memory = self.system.memory
+        with self.atomic_locks[stripe]:
+            value = memory.read_word(address)
+            memory.write_word(operation(value, self.registers[instruction.rs2]), address)
+        self.registers[instruction.rd] = value
+        self.advance_pc()
 
-        funct3 = instruction & bit_mask_prefix(3)
-        instruction >>= 3
+    # Load reserved, loads a word and reserves its address for the following SC
+    def execute_lr_w(self, instruction):
+        address, stripe = self.atomic_address(instruction)
+        generations = self.store_generations
+        with self.atomic_locks[stripe]:
+            value = self.system.memory.read_word(address)
+            self.reservation = (address, generations[stripe] if generations is not None else 0)
+        self.registers[instruction.rd] = value
+        self.advance_pc()
 
-        rs1 = instruction & bit_mask_prefix(5)
-        instruction >>= 5
+    # Store conditional, stores rs2 if the reservation still holds and writes 0 into rd, else writes 1.
+    # The reservation holds while no store was made under the lock of its address since the LR, so any store
+    # to the word in between fails the SC, even one putting back the loaded value. A store to another word
+    # sharing the lock fails it as well, the guest retries.
+    def execute_sc_w(self, instruction):
+        address, stripe = self.atomic_address(instruction)
+        generations = self.store_generations
+        success = False
+        if self.reservation is not None and self.reservation[0] == address:
+            with self.atomic_locks[stripe]:
+                if generations is None or generations[stripe] == self.reservation[1]:
+                    self.system.memory.write_word(self.registers[instruction.rs2], address)
+                    success = True
+        self.reservation = None
+        self.registers[instruction.rd] = 0 if success else 1
+        self.advance_pc()
 
-        funct12 = instruction & bit_mask_prefix(12)
-        instruction >>= 12
+    def execute_amoswap_w(self, instruction):
+        self.atomic(instruction, lambda value, operand: operand)
 
-        return [OP_SYSTEM, funct12]  # Only funct12 is relevant for this instruction
+    def execute_amoadd_w(self, instruction):
+        self.atomic(instruction, lambda value, operand: ignore_overflow(value + operand, self.architecture))
 
-    def decode_load(self, instruction):  # Decodes a load instruction
-        rd = instruction & bit_mask_prefix(5)
-        instruction >>= 5
+    def execute_amoxor_w(self, instruction):
+        self.atomic(instruction, lambda value, operand: value ^ operand)
 
-        funct3 = instruction & bit_mask_prefix(3)
-        instruction >>= 3
+    def execute_amoand_w(self, instruction):
+        self.atomic(instruction, lambda value, operand: value & operand)
 
-        rs1 = instruction & bit_mask_prefix(5)
-        instruction >>= 5
+    def execute_amoor_w(self, instruction):
+        self.atomic(instruction, lambda value, operand: value | operand)
 
-        imm_11_0 = instruction & bit_mask_prefix(12)
-        instruction >>= 12
+    def execute_amomin_w(self, instruction):  # Signed minimum
+        self.atomic(instruction, lambda value, operand: min(value, operand, key=self.signed))
 
-        return [OP_LOAD, rd, funct3, rs1, imm_11_0]
+    def execute_amomax_w(self, instruction):  # Signed maximum
+        self.atomic(instruction, lambda value, operand: max(value, operand, key=self.signed))
 
-    def decode_store(self, instruction):  # Decodes a store instruction
-        imm_4_0 = instruction & bit_mask_prefix(5)
-        instruction >>= 5
+    def execute_amominu_w(self, instruction):
+        self.atomic(instruction, min)
 
-        funct3 = instruction & bit_mask_prefix(3)
-        instruction >>= 3
+    def execute_amomaxu_w(self, instruction):
+        self.atomic(instruction, max)
 
-        rs1 = instruction & bit_mask_prefix(5)
-        instruction >>= 5
+    def signed(self, value):  # Returns the register value as a signed integer
+        return get_two_complement(value, self.architecture)
 
-        rs2 = instruction & bit_mask_prefix(5)
-        instruction >>= 5
+    def execute_lb(self, instruction):  # Load a byte from memory and sign-extend it
+        address = ignore_overflow(self.registers[instruction.rs1] + instruction.imm, self.architecture)
+        value = get_two_complement(self.system.memory.read_byte(address), 8)
+        self.registers[instruction.rd] = ignore_overflow(value, self.architecture)
+        self.advance_pc()
 
-        imm_11_5 = instruction & bit_mask_prefix(7)
-        instruction >>= 7
+    def execute_lh(self, instruction):  # Load a 16-bit halfword from memory and sign-extend it
+        address = ignore_overflow(self.registers[instruction.rs1] + instruction.imm, self.architecture)
+        value = get_two_complement(self.system.memory.read_halfword(address), 16)
+        self.registers[instruction.rd] = ignore_overflow(value, self.architecture)
+        self.advance_pc()
 
-        return [OP_STORE, imm_4_0, funct3, rs1, rs2, imm_11_5]
+    def execute_lw(self, instruction):  # Load a 32-bit word from memory
+        address = ignore_overflow(self.registers[instruction.rs1] + instruction.imm, self.architecture)
+        self.registers[instruction.rd] = self.system.memory.read_word(address)
+        self.advance_pc()
 
-    def decode_op(self, instruction):  # Decodes a register-register operation
-        rd = instruction & bit_mask_prefix(5)
-        instruction >>= 5
+    def execute_lbu(self, instruction):  # Load a byte from memory and zero-extend it
+        address = ignore_overflow(self.registers[instruction.rs1] + instruction.imm, self.architecture)
+        self.registers[instruction.rd] = self.system.memory.read_byte(address)
+        self.advance_pc()
 
-        funct3 = instruction & bit_mask_prefix(3)
-        instruction >>= 3
+    def execute_lhu(self, instruction):  # Load a 16-bit halfword from memory and zero-extend it
+        address = ignore_overflow(self.registers[instruction.rs1] + instruction.imm, self.architecture)
+        self.registers[instruction.rd] = self.system.memory.read_halfword(address)
+        self.advance_pc()
 
-        rs1 = instruction & bit_mask_prefix(5)
-        instruction >>= 5
+    def execute_sb(self, instruction):  # Store the lower 8 bits of rs2
+        address = ignore_overflow(self.registers[instruction.rs1] + instruction.imm, self.architecture)
+        self.system.memory.write_byte(self.registers[instruction.rs2], address)
+        self.advance_pc()
 
-        rs2 = instruction & bit_mask_prefix(5)
-        instruction >>= 5
+    def execute_sh(self, instruction):  # Store the lower 16 bits of rs2
+        address = ignore_overflow(self.registers[instruction.rs1] + instruction.imm, self.architecture)
+        self.system.memory.write_halfword(self.registers[instruction.rs2], address)
+        self.advance_pc()
 
-        funct7 = instruction & bit_mask_prefix(7)
-        instruction >>= 7
+    def execute_sw(self, instruction):  # Store 32 bits
+        address = ignore_overflow(self.registers[instruction.rs1] + instruction.imm, self.architecture)
+        self.system.memory.write_word(self.registers[instruction.rs2], address)
+        self.advance_pc()
 
-        return [OP_OP, rd, funct3, rs1, rs2, funct7]
+    def execute_add(self, instruction):  # Add rs2 to rs1, ignoring overflow
+        a = self.registers[instruction.rs1]
+        b = self.registers[instruction.rs2]
+        self.registers[instruction.rd] = ignore_overflow(a + b, self.architecture)
+        self.advance_pc()
 
-    def execute(self, instruction):  # Executes the given instruction
-        opcode = instruction[0]
-        if opcode == OP_LUI:
-            self.execute_lui(instruction)
-        elif opcode == OP_AUIPC:
-            self.execute_auipc(instruction)
-        elif opcode == OP_JAL:
-            self.execute_jal(instruction)
-        elif opcode == OP_IMM:
-            self.execute_imm(instruction)
-        elif opcode == OP_BRANCH:
-            self.execute_branch(instruction)
-        elif opcode == OP_SYSTEM:
-            self.execute_system(instruction)
-        elif opcode == OP_LOAD:
-            self.execute_load(instruction)
-        elif opcode == OP_STORE:
-            self.execute_store(instruction)
-        elif opcode == OP_OP:
-            self.execute_op(instruction)
-        else:
-            raise NotImplementedError(f"Cannot execute opcode: {opcode}")
+    def execute_sub(self, instruction):  # Subtract rs2 from rs1, ignoring overflow
+        a = self.registers[instruction.rs1]
+        b = self.registers[instruction.rs2]
+        self.registers[instruction.rd] = ignore_overflow(a - b, self.architecture)
+        self.advance_pc()
 
-        # The x0 register is hardwired to zero, so reset it after execution
-        self.registers[0] = 0
+    def execute_sll(self, instruction):  # Logical left shift by the lower 5 bits of rs2
+        shift_amount = self.registers[instruction.rs2] & bit_mask_prefix(5)
+        operand = self.registers[instruction.rs1]
+        self.registers[instruction.rd] = ignore_overflow(operand << shift_amount, self.architecture)
+        self.advance_pc()
 
-    # Overwrite the top 20 bits of the destination register and set the other 12 bits to zero
-    def execute_lui(self, instruction):
-        rd = instruction[1]
-        self.registers[rd] = instruction[2] << 12
+    def execute_slt(self, instruction):  # Set less than, comparing the registers as signed integers
+        a = get_two_complement(self.registers[instruction.rs1], self.architecture)
+        b = get_two_complement(self.registers[instruction.rs2], self.architecture)
+        self.registers[instruction.rd] = 1 if a < b else 0
         self.advance_pc()
 
-    # Build a 32 bit offset from the 20 bit immediate, add the offset to pc and save
-    # the result in the destination register
-    def execute_auipc(self, instruction):
-        rd = instruction[1]
-        offset = get_two_complement(instruction[2] << 12, self.architecture)
+    def execute_sltu(self, instruction):  # Set less than, comparing the registers as unsigned integers
+        a = self.registers[instruction.rs1]
+        b = self.registers[instruction.rs2]
+        self.registers[instruction.rd] = 1 if a < b else 0
+        self.advance_pc()
 
-        self.registers[rd] = ignore_overflow(self.pc + offset, self.architecture)  # Store the result into rd
+    def execute_xor(self, instruction):  # Perform logical xor
+        a = self.registers[instruction.rs1]
+        b = self.registers[instruction.rs2]
+        self.registers[instruction.rd] = a ^ b
         self.advance_pc()
 
-    # Add the offset (in multiples of 2 bytes) to the pc and store the address of the instruction
-    # following the jump (pc+4) into the destination register
-    def execute_jal(self, instruction):
-        rd = instruction[1]
-        offset = get_two_complement(instruction[2], 20) * 2
-        self.pc = ignore_overflow(self.pc + offset, self.architecture)
-        self.registers[rd] = self.pc + 4
+    def execute_srl(self, instruction):
+        # The shift amount is held in the lower 5 bits of rs2
+        shift_amount = self.registers[instruction.rs2] & bit_mask_prefix(5)
 
-    # Executes the corresponding branch instruction given by funct3
-    def execute_branch(self, instruction):
-        offset = get_two_complement(instruction[1], 12) * 2
-        funct3 = instruction[2]
-        rs1 = instruction[3]
-        rs2 = instruction[4]
+        result = self.registers[instruction.rs1] >> shift_amount
+        self.registers[instruction.rd] = result
+        self.advance_pc()
 
-        jump = False  # Set this flag accordingly based on funct3
+    def execute_sra(self, instruction):  # Arithmetic right shift by the lower 5 bits of rs2
+        shift_amount = self.registers[instruction.rs2] & bit_mask_prefix(5)
+        operand = get_two_complement(self.registers[instruction.rs1], self.architecture)
+        self.registers[instruction.rd] = ignore_overflow(operand >> shift_amount, self.architecture)
+        self.advance_pc()
 
-        if funct3 == BRANCH_FUNCT3_BEQ:
-            jump = self.registers[rs1] == self.registers[rs2]
-        elif funct3 == BRANCH_FUNCT3_BNE:
-            jump = self.registers[rs1] != self.registers[rs2]
+    def execute_or(self, instruction):  # Perform logical or
+        a = self.registers[instruction.rs1]
+        b = self.registers[instruction.rs2]
+        self.registers[instruction.rd] = a | b
+        self.advance_pc()
 
-        if jump:
-            self.pc = ignore_overflow(self.pc + offset, self.architecture)
-        else:
-            self.advance_pc()
+    def execute_and(self, instruction):  # Perform logical and
+        a = self.registers[instruction.rs1]
+        b = self.registers[instruction.rs2]
+        self.registers[instruction.rd] = a & b
+        self.advance_pc()
 
-    # Execute the given imm instruction by computing the corresponding operation given by funct3
-    def execute_imm(self, instruction):
-        rd = instruction[1]
-        funct3 = instruction[2]
-        rs1 = instruction[3]
-        immediate = instruction[4]
-
-        if funct3 == IMM_FUNCT3_ADDI:
-            # Add the sign extended 12-bit immediate to rs1. Ignore overflow and store the result into rd
-            value = get_two_complement(immediate, 12)
-            result = ignore_overflow(self.registers[rs1] + value, self.architecture)
-            self.registers[rd] = result
-
-        elif funct3 == IMM_FUNCT3_SLTI:
-            # Set less than immediate, place the value 1 in rd if rs1 is less than the sign-extended immediate,
-            # else 0 is written to rd
-            value = get_two_complement(immediate, 12)
-            if self.registers[rs1] < value:
-                self.registers[rd] = 1
-            else:
-                self.registers[rd] = 0
-
-        elif funct3 == IMM_FUNCT3_SLTIU:
-            # Set less than unsigned immediate, similar to SLTI but sign-extends the immediate then
-            # treats it and the rs register as unsigned integers
-            value = get_two_complement(immediate, 12)
-            unsigned_immediate = value & bit_mask_prefix(self.architecture)
-            unsigned_register = self.registers[rs1] & bit_mask_prefix(self.architecture)
-
-            if unsigned_register < unsigned_immediate:
-                self.registers[rd] = 1
-            else:
-                self.registers[rd] = 0
-        elif funct3 == IMM_FUNCT3_SLLI:  # Logical left shift
-            shift_amount = immediate & bit_mask_prefix(5)  # the shift amount is encoded in the lower 5 bits of the imm
-            operand = self.registers[rs1]
-            self.registers[rd] = ignore_overflow(operand << shift_amount, self.architecture)
-
-        elif funct3 == IMM_FUNCT3_ORI:  # Logical or with the sign-extended immediate
-            value = get_two_complement(immediate, 12)
-            self.registers[rd] = self.registers[rs1] | value
+    def execute_mul(self, instruction):  # Multiply, the lower 32 bits of the product
+        a = self.registers[instruction.rs1]
+        b = self.registers[instruction.rs2]
+        self.registers[instruction.rd] = ignore_overflow(a * b, self.architecture)
+        self.advance_pc()
 
-        else:
-            raise NotImplementedError(f"Cannot execute funct3: {funct3}")
+    def execute_mulh(self, instruction):  # The upper 32 bits of the product of the signed registers
+        a = get_two_complement(self.registers[instruction.rs1], self.architecture)
+        b = get_two_complement(self.registers[instruction.rs2], self.architecture)
+        self.registers[instruction.rd] = ignore_overflow((a * b) >> self.architecture, self.architecture)
         self.advance_pc()
 
-    # Executes a system call
-    def execute_system(self, instruction):
-        funct12 = instruction[1]
-        if funct12 == SYSTEM_FUNCT12_ECALL:
-            system.call(self.registers[10:16])  # The parameters are passed through a0 to a5
-        else:
-            raise NotImplementedError(f"Cannot execute funct12: {funct12}")
+    def execute_mulhsu(self, instruction):  # The upper 32 bits of the product of signed rs1 and unsigned rs2
+        a = get_two_complement(self.registers[instruction.rs1], self.architecture)
+        b = self.registers[instruction.rs2]
+        self.registers[instruction.rd] = ignore_overflow((a * b) >> self.architecture, self.architecture)
+        self.advance_pc()
 
+    def execute_mulhu(self, instruction):  # The upper 32 bits of the product of the unsigned registers
+        a = self.registers[instruction.rs1]
+        b = self.registers[instruction.rs2]
+        self.registers[instruction.rd] = (a * b) >> self.architecture
         self.advance_pc()
 
-    # Executes a load instruction
-    def execute_load(self, instruction):
-        rd = instruction[1]
-        funct3 = instruction[2]
-        rs1 = instruction[3]
-        imm_11_0 = instruction[4]
+    # Signed division, rounding towards zero. Dividing by zero gives -1, and the overflowing division
+    # of the most negative number by -1 gives the dividend back.
+    def execute_div(self, instruction):
+        dividend = get_two_complement(self.registers[instruction.rs1], self.architecture)
+        divisor = get_two_complement(self.registers[instruction.rs2], self.architecture)
 
-        if funct3 == LOAD_FUNCT3_LW:
-            offset = get_two_complement(imm_11_0, 12)
-            address = ignore_overflow(self.registers[rs1] + offset, self.architecture)
-            self.registers[rd] = system.memory.read_word(address)
+        if divisor == 0:
+            result = -1
         else:
-            raise NotImplementedError(f"Cannot execute funct3: {funct3}")
+            result = abs(dividend) // abs(divisor)
+            if (dividend < 0) != (divisor < 0):
+                result = -result
 
+        self.registers[instruction.rd] = ignore_overflow(result, self.architecture)
         self.advance_pc()
 
-    # Executes a store instruction
-    def execute_store(self, instruction):
-        imm_4_0 = instruction[1]
-        funct3 = instruction[2]
-        rs1 = instruction[3]
-        rs2 = instruction[4]
-        imm_11_5 = instruction[5]
+    def execute_divu(self, instruction):  # Unsigned division, dividing by zero sets all the bits
+        dividend = self.registers[instruction.rs1]
+        divisor = self.registers[instruction.rs2]
+        result = dividend // divisor if divisor else bit_mask_prefix(self.architecture)
+        self.registers[instruction.rd] = result
+        self.advance_pc()
 
-        if funct3 == STORE_FUNCT3_SW:  # Store 32 bits
-            imm_11_0 = imm_4_0 | (imm_11_5 << 5)
-            offset = get_two_complement(imm_11_0, 12)
-            address = ignore_overflow(self.registers[rs1] + offset, self.architecture)
-            system.memory.write_word(self.registers[rs2], address)
+    # Signed remainder, it takes the sign of the dividend. The remainder of a division by zero is the dividend,
+    # and the overflowing division of the most negative number by -1 has no remainder.
+    def execute_rem(self, instruction):
+        dividend = get_two_complement(self.registers[instruction.rs1], self.architecture)
+        divisor = get_two_complement(self.registers[instruction.rs2], self.architecture)
 
+        if divisor == 0:
+            result = dividend
         else:
-            raise NotImplementedError(f"Cannot execute funct3: {funct3}")
-
-        self.advance_pc()
-
-    # Executes a register-register instruction
-    def execute_op(self, instruction):
-        rd = instruction[1]
-        funct3 = instruction[2]
-        rs1 = instruction[3]
-        rs2 = instruction[4]
-        funct7 = instruction[5]
-
-        if funct7 == OP_FUNCT7_STANDARD:
-            if funct3 == OP_FUNCT3_SRL:
-                # The shift amount is held in the lower 5 bits of rs2
-                shift_amount = self.registers[rs2] & bit_mask_prefix(5)
-
-                result = self.registers[rs1] >> shift_amount
-                self.registers[rd] = result
-            elif funct3 == OP_FUNCT3_XOR:  # Perform logical xor
-                a = self.registers[rs1]
-                b = self.registers[rs2]
-                self.registers[rd] = a ^ b
-
-            else:
-                raise NotImplementedError(f"Cannot execute funct3: {funct3}")
-        elif funct7 == OP_FUNC7_MULDIV:
-            if funct3 == OP_FUNCT3_REM:
-                #  Get the signed version of the divisor
-                divisor = get_two_complement(self.registers[rs2], self.architecture)
-                #  Get the signed version of the dividend
-                dividend = get_two_complement(self.registers[rs1], self.architecture)
-
-                if divisor == 0:
-                    result = dividend
-                else:
-                    quotient = dividend / divisor
-                    if quotient < 0:  # If the quotient is less than 0, apply the ceil operation
-                        quotient = math.ceil(quotient)
-                    else:  # Else apply the floor operation
-                        quotient = math.floor(quotient)
-
-                    result = ignore_overflow(dividend - (divisor * quotient), self.architecture)
-
-                self.registers[rd] = ignore_overflow(result, self.architecture)
-
-            else:
-                raise NotImplementedError(f"Cannot execute funct3:{funct3}")
-        else:
-            raise NotImplementedError(f"Cannot execute funct7: {funct7}")
+            result = abs(dividend) % abs(divisor)
+            if dividend < 0:
+                result = -result
 
+        self.registers[instruction.rd] = ignore_overflow(result, self.architecture)
         self.advance_pc()
 
+    def execute_remu(self, instruction):  # Unsigned remainder, the remainder of a division by zero is the dividend
+        dividend = self.registers[instruction.rs1]
+        divisor = self.registers[instruction.rs2]
+        self.registers[instruction.rd] = dividend % divisor if divisor else dividend
+        self.advance_pc()
+
+    # The handlers of the fused pairs. Each one has the effect of its two instructions in order, and the pc is
+    # on the second instruction whenever that one may fault, so a trap finds the state of an unfused run.
+
+    def execute_lui_addi(self, fused):  # LUI and ADDI loading a 32-bit constant
+        registers = self.registers
+        registers[fused.rd] = fused.imm
+        registers[fused.second.rd] = fused.value
+        self.pc = (self.pc + 8) & WORD_MASK
+        self.fused_pairs += 1
+
+    def execute_auipc_addi(self, fused):  # AUIPC and ADDI computing an address relative to the pc
+        registers = self.registers
+        registers[fused.rd] = (self.pc + fused.imm) & WORD_MASK
+        registers[fused.second.rd] = (self.pc + fused.value) & WORD_MASK
+        self.pc = (self.pc + 8) & WORD_MASK
+        self.fused_pairs += 1
+
+    def execute_auipc_jalr(self, fused):  # AUIPC and JALR calling or jumping to a function relative to the pc
+        registers = self.registers
+        pc = self.pc
+        registers[fused.rd] = (pc + fused.imm) & WORD_MASK
+        registers[fused.second.rd] = (pc + 8) & WORD_MASK
+        self.pc = (pc + fused.value) & WORD_MASK & ~1
+        self.fused_pairs += 1
+
+    def execute_auipc_lw(self, fused):  # AUIPC and LW loading a word relative to the pc
+        registers = self.registers
+        pc = self.pc
+        registers[fused.rd] = (pc + fused.imm) & WORD_MASK
+        self.pc = (pc + 4) & WORD_MASK
+        registers[fused.second.rd] = self.system.memory.read_word((pc + fused.value) & WORD_MASK)
+        self.pc = (pc + 8) & WORD_MASK
+        self.fused_pairs += 1
+
+    # ADDI and a branch on its result, usually the counter of a loop. The comparison of the branch is done on
+    # the operands with their bias applied, which orders the signed values like the unsigned ones.
+    def execute_addi_branch(self, fused):
+        registers = self.registers
+        registers[fused.rd] = (registers[fused.rs1] + fused.imm) & WORD_MASK
+        branch = fused.second
+        bias = fused.value
+        if fused.compare(registers[branch.rs1] ^ bias, registers[branch.rs2] ^ bias):
+            self.pc = (self.pc + 4 + branch.imm) & WORD_MASK
+        else:
+            self.pc = (self.pc + 8) & WORD_MASK
+        self.fused_pairs += 1
+
+    def execute_compare_branch(self, fused):  # A comparison or another operation that cannot fault, and a branch
+        first = fused.first
+        first.execute(self, first)
+        registers = self.registers
+        branch = fused.second
+        bias = fused.value
+        if fused.compare(registers[branch.rs1] ^ bias, registers[branch.rs2] ^ bias):
+            self.pc = (self.pc + branch.imm) & WORD_MASK
+        else:
+            self.pc = (self.pc + 4) & WORD_MASK
+        self.fused_pairs += 1
+
     def debug_registers(self):
         for x in range(32):
             print(f"{mnemonics[x]}", self.registers[x])
 
         print(f"pc:{hex(self.pc)}")
+
+
+class DebugPrinter:  # Prints every executed instruction and the registers, attached when system.debug is set
+    def before(self, cpu, decoded):
+        if decoded.opcode == OP_EMPTY:
+            print(f"Skipping over memory address:{cpu.pc}")
+
+    def after(self, cpu, pc, decoded):
+        if decoded.opcode != OP_EMPTY:
+            print(f"Execute {decoded} , OPCODE: {bin(decoded.opcode)}")
+            cpu.debug_registers()  # Debug registers to stdout
+
+
+# The decoders of the instruction formats. Each one extracts the operands of its format
+# from the raw instruction and returns the decoded instruction.
+
+def decode_r_type(execute, opcode, funct3, funct7, instruction):  # Register-register operations
+    rd = (instruction >> 7) & bit_mask_prefix(5)
+    rs1 = (instruction >> 15) & bit_mask_prefix(5)
+    rs2 = (instruction >> 20) & bit_mask_prefix(5)
+
+    return Instruction(execute, opcode, funct3, funct7, rd=rd, rs1=rs1, rs2=rs2)
+
+
+def decode_i_type(execute, opcode, funct3, funct7, instruction):  # Immediate operations, loads, jalr and system
+    rd = (instruction >> 7) & bit_mask_prefix(5)
+    rs1 = (instruction >> 15) & bit_mask_prefix(5)
+    imm_11_0 = (instruction >> 20) & bit_mask_prefix(12)
+
+    return Instruction(execute, opcode, funct3, funct7, rd=rd, rs1=rs1, imm=get_two_complement(imm_11_0, 12))
+
+
+def decode_s_type(execute, opcode, funct3, funct7, instruction):  # Stores
+    imm_4_0 = (instruction >> 7) & bit_mask_prefix(5)
+    rs1 = (instruction >> 15) & bit_mask_prefix(5)
+    rs2 = (instruction >> 20) & bit_mask_prefix(5)
+    imm_11_5 = (instruction >> 25) & bit_mask_prefix(7)
+
+    imm_11_0 = imm_4_0 | (imm_11_5 << 5)
+
+    return Instruction(execute, opcode, funct3, funct7, rs1=rs1, rs2=rs2, imm=get_two_complement(imm_11_0, 12))
+
+
+def decode_b_type(execute, opcode, funct3, funct7, instruction):  # Branches
+    imm_11 = (instruction >> 7) & bit_mask_prefix(1)
+    imm_4_1 = (instruction >> 8) & bit_mask_prefix(4)
+    rs1 = (instruction >> 15) & bit_mask_prefix(5)
+    rs2 = (instruction >> 20) & bit_mask_prefix(5)
+    imm_10_5 = (instruction >> 25) & bit_mask_prefix(6)
+    imm_12 = (instruction >> 31) & bit_mask_prefix(1)
+
+    offset = imm_4_1 | (imm_10_5 << 4) | (imm_11 << 10) | (imm_12 << 11)
+    offset = get_two_complement(offset, 12) * 2  # The offset is given in multiples of 2 bytes
+
+    return Instruction(execute, opcode, funct3, funct7, rs1=rs1, rs2=rs2, imm=offset)
+
+
+def decode_u_type(execute, opcode, funct3, funct7, instruction):  # LUI and AUIPC
+    rd = (instruction >> 7) & bit_mask_prefix(5)
+    imm_31_12 = instruction & (bit_mask_prefix(20) << 12)
+
+    if opcode == OP_AUIPC:  # AUIPC adds the immediate to the pc, so it is used as a signed offset
+        imm_31_12 = get_two_complement(imm_31_12, 32)
+
+    return Instruction(execute, opcode, funct3, funct7, rd=rd, imm=imm_31_12)
+
+
+def decode_j_type(execute, opcode, funct3, funct7, instruction):  # JAL
+    rd = (instruction >> 7) & bit_mask_prefix(5)
+    jal_19_12 = (instruction >> 12) & bit_mask_prefix(8)
+    jal_11 = (instruction >> 20) & bit_mask_prefix(1)
+    jal_10_1 = (instruction >> 21) & bit_mask_prefix(10)
+    jal_20 = (instruction >> 31) & bit_mask_prefix(1)
+
+    offset = jal_10_1 | (jal_11 << 10) | (jal_19_12 << 11) | (jal_20 << 19)
+    offset = get_two_complement(offset, 20) * 2  # The offset is given in multiples of 2 bytes
+
+    return Instruction(execute, opcode, funct3, funct7, rd=rd, imm=offset)
+
+
+# The decoder of each opcode
+decoders = {
+    OP_LUI: decode_u_type,
+    OP_AUIPC: decode_u_type,
+    OP_JAL: decode_j_type,
+    OP_JALR: decode_i_type,
+    OP_BRANCH: decode_b_type,
+    OP_IMM: decode_i_type,
+    OP_OP: decode_r_type,
+    OP_SYSTEM: decode_i_type,
+    OP_LOAD: decode_i_type,
+    OP_STORE: decode_s_type,
+    OP_AMO: decode_r_type,
+    OP_MISC_MEM: decode_i_type,
+}
+
+# The execution table, maps dispatch_key(opcode, funct3, funct7) to the handler of the instruction.
+# Keys are expanded over every funct3/funct7 value the instruction does not depend on,
+# so a single lookup finds the handler of any instruction.
+execution_table = {}
+
+
+# Adds an instruction to the execution table. Leave funct3 or funct7 as None when
+# the instruction does not use them to select the operation.
+def add_instruction(execute, opcode, funct3=None, funct7=None):
+    funct3_values = range(8) if funct3 is None else [funct3]
+    funct7_values = range(128) if funct7 is None else [funct7]
+
+    for f3 in funct3_values:
+        for f7 in funct7_values:
+            execution_table[dispatch_key(opcode, f3, f7)] = execute
+
+
+add_instruction(Processor.execute_lui, OP_LUI)
+add_instruction(Processor.execute_auipc, OP_AUIPC)
+add_instruction(Processor.execute_jal, OP_JAL)
+add_instruction(Processor.execute_jalr, OP_JALR, JALR_FUNCT3)
+
+add_instruction(Processor.execute_beq, OP_BRANCH, BRANCH_FUNCT3_BEQ)
+add_instruction(Processor.execute_bne, OP_BRANCH, BRANCH_FUNCT3_BNE)
+add_instruction(Processor.execute_blt, OP_BRANCH, BRANCH_FUNCT3_BLT)
+add_instruction(Processor.execute_bge, OP_BRANCH, BRANCH_FUNCT3_BGE)
+add_instruction(Processor.execute_bltu, OP_BRANCH, BRANCH_FUNCT3_BLTU)
+add_instruction(Processor.execute_bgeu, OP_BRANCH, BRANCH_FUNCT3_BGEU)
+
+add_instruction(Processor.execute_addi, OP_IMM, IMM_FUNCT3_ADDI)
+add_instruction(Processor.execute_slti, OP_IMM, IMM_FUNCT3_SLTI)
+add_instruction(Processor.execute_sltiu, OP_IMM, IMM_FUNCT3_SLTIU)
+add_instruction(Processor.execute_xori, OP_IMM, IMM_FUNCT3_XORI)
+add_instruction(Processor.execute_ori, OP_IMM, IMM_FUNCT3_ORI)
+add_instruction(Processor.execute_andi, OP_IMM, IMM_FUNCT3_ANDI)
+add_instruction(Processor.execute_slli, OP_IMM, IMM_FUNCT3_SLLI, OP_FUNCT7_STANDARD)
+add_instruction(Processor.execute_srli, OP_IMM, IMM_FUNCT3_SRLI, IMM_FUNCT7_SRLI)
+add_instruction(Processor.execute_srai, OP_IMM, IMM_FUNCT3_SRLI, IMM_FUNCT7_SRAI)
+
+add_instruction(Processor.execute_add, OP_OP, OP_FUNCT3_ADD, OP_FUNCT7_STANDARD)
+add_instruction(Processor.execute_sub, OP_OP, OP_FUNCT3_ADD, OP_FUNCT7_ALTERNATE)
+add_instruction(Processor.execute_sll, OP_OP, OP_FUNCT3_SLL, OP_FUNCT7_STANDARD)
+add_instruction(Processor.execute_slt, OP_OP, OP_FUNCT3_SLT, OP_FUNCT7_STANDARD)
+add_instruction(Processor.execute_sltu, OP_OP, OP_FUNCT3_SLTU, OP_FUNCT7_STANDARD)
+add_instruction(Processor.execute_xor, OP_OP, OP_FUNCT3_XOR, OP_FUNCT7_STANDARD)
+add_instruction(Processor.execute_srl, OP_OP, OP_FUNCT3_SRL, OP_FUNCT7_STANDARD)
+add_instruction(Processor.execute_sra, OP_OP, OP_FUNCT3_SRL, OP_FUNCT7_ALTERNATE)
+add_instruction(Processor.execute_or, OP_OP, OP_FUNCT3_OR, OP_FUNCT7_STANDARD)
+add_instruction(Processor.execute_and, OP_OP, OP_FUNCT3_AND, OP_FUNCT7_STANDARD)
+add_instruction(Processor.execute_mul, OP_OP, OP_FUNCT3_MUL, OP_FUNC7_MULDIV)
+add_instruction(Processor.execute_mulh, OP_OP, OP_FUNCT3_MULH, OP_FUNC7_MULDIV)
+add_instruction(Processor.execute_mulhsu, OP_OP, OP_FUNCT3_MULHSU, OP_FUNC7_MULDIV)
+add_instruction(Processor.execute_mulhu, OP_OP, OP_FUNCT3_MULHU, OP_FUNC7_MULDIV)
+add_instruction(Processor.execute_div, OP_OP, OP_FUNCT3_DIV, OP_FUNC7_MULDIV)
+add_instruction(Processor.execute_divu, OP_OP, OP_FUNCT3_DIVU, OP_FUNC7_MULDIV)
+add_instruction(Processor.execute_rem, OP_OP, OP_FUNCT3_REM, OP_FUNC7_MULDIV)
+add_instruction(Processor.execute_remu, OP_OP, OP_FUNCT3_REMU, OP_FUNC7_MULDIV)
+
+add_instruction(Processor.execute_system, OP_SYSTEM, SYSTEM_FUNCT3_PRIV)
+add_instruction(Processor.execute_mret, OP_SYSTEM, SYSTEM_FUNCT3_PRIV, SYSTEM_FUNCT7_MRET)
+add_instruction(Processor.execute_sret, OP_SYSTEM, SYSTEM_FUNCT3_PRIV, SYSTEM_FUNCT7_SRET)
+add_instruction(Processor.execute_sfence_vma, OP_SYSTEM, SYSTEM_FUNCT3_PRIV, SYSTEM_FUNCT7_SFENCE_VMA)
+add_instruction(Processor.execute_csrrw, OP_SYSTEM, SYSTEM_FUNCT3_CSRRW)
+add_instruction(Processor.execute_csrrs, OP_SYSTEM, SYSTEM_FUNCT3_CSRRS)
+add_instruction(Processor.execute_csrrc, OP_SYSTEM, SYSTEM_FUNCT3_CSRRC)
+add_instruction(Processor.execute_csrrwi, OP_SYSTEM, SYSTEM_FUNCT3_CSRRWI)
+add_instruction(Processor.execute_csrrsi, OP_SYSTEM, SYSTEM_FUNCT3_CSRRSI)
+add_instruction(Processor.execute_csrrci, OP_SYSTEM, SYSTEM_FUNCT3_CSRRCI)
+
+add_instruction(Processor.execute_fence, OP_MISC_MEM, MISC_MEM_FUNCT3_FENCE)
+add_instruction(Processor.execute_fence_i, OP_MISC_MEM, MISC_MEM_FUNCT3_FENCE_I)
+
+add_instruction(Processor.execute_lb, OP_LOAD, LOAD_FUNCT3_LB)
+add_instruction(Processor.execute_lh, OP_LOAD, LOAD_FUNCT3_LH)
+add_instruction(Processor.execute_lw, OP_LOAD, LOAD_FUNCT3_LW)
+add_instruction(Processor.execute_lbu, OP_LOAD, LOAD_FUNCT3_LBU)
+add_instruction(Processor.execute_lhu, OP_LOAD, LOAD_FUNCT3_LHU)
+
+add_instruction(Processor.execute_sb, OP_STORE, STORE_FUNCT3_SB)
+add_instruction(Processor.execute_sh, OP_STORE, STORE_FUNCT3_SH)
+add_instruction(Processor.execute_sw, OP_STORE, STORE_FUNCT3_SW)
+
+
+def add_atomic_instruction(execute, funct5):  # Atomic instructions ignore the aq and rl ordering bits
+    for ordering in range(4):
+        add_instruction(execute, OP_AMO, AMO_FUNCT3_W, (funct5 << 2) | ordering)
+
+
+add_atomic_instruction(Processor.execute_lr_w, AMO_FUNCT5_LR)
+add_atomic_instruction(Processor.execute_sc_w, AMO_FUNCT5_SC)
+add_atomic_instruction(Processor.execute_amoswap_w, AMO_FUNCT5_SWAP)
+add_atomic_instruction(Processor.execute_amoadd_w, AMO_FUNCT5_ADD)
+add_atomic_instruction(Processor.execute_amoxor_w, AMO_FUNCT5_XOR)
+add_atomic_instruction(Processor.execute_amoand_w, AMO_FUNCT5_AND)
+add_atomic_instruction(Processor.execute_amoor_w, AMO_FUNCT5_OR)
+add_atomic_instruction(Processor.execute_amomin_w, AMO_FUNCT5_MIN)
+add_atomic_instruction(Processor.execute_amomax_w, AMO_FUNCT5_MAX)
+add_atomic_instruction(Processor.execute_amominu_w, AMO_FUNCT5_MINU)
+add_atomic_instruction(Processor.execute_amomaxu_w, AMO_FUNCT5_MAXU)
+
+
+# The fused handlers of the instruction pairs, by the handlers of the two instructions, see Processor.predecode
+fusion_table = {}
+fusion_firsts = set()  # The handlers that start a fused pair, the other instructions are never looked up
+
+# The comparisons of the branches, and the bias applied to both their operands
+branch_conditions = {
+    Processor.execute_beq: (operator.eq, 0),
+    Processor.execute_bne: (operator.ne, 0),
+    Processor.execute_blt: (operator.lt, SIGN_BIT),
+    Processor.execute_bge: (operator.ge, SIGN_BIT),
+    Processor.execute_bltu: (operator.lt, 0),
+    Processor.execute_bgeu: (operator.ge, 0),
+}
+
+
+def add_fusion(execute, firsts, seconds):  # Fuses every pair of a handler of firsts followed by one of seconds
+    for first in firsts:
+        fusion_firsts.add(first)
+        for second in seconds:
+            fusion_table[(first, second)] = execute
+
+
+add_fusion(Processor.execute_lui_addi, [Processor.execute_lui], [Processor.execute_addi])
+add_fusion(Processor.execute_auipc_addi, [Processor.execute_auipc], [Processor.execute_addi])
+add_fusion(Processor.execute_auipc_jalr, [Processor.execute_auipc], [Processor.execute_jalr])
+add_fusion(Processor.execute_auipc_lw, [Processor.execute_auipc], [Processor.execute_lw])
+add_fusion(Processor.execute_addi_branch, [Processor.execute_addi], branch_conditions)
+add_fusion(Processor.execute_compare_branch,
+           [Processor.execute_slt, Processor.execute_sltu, Processor.execute_slti, Processor.execute_sltiu,
+            Processor.execute_andi, Processor.execute_xori, Processor.execute_add, Processor.execute_sub,
+            Processor.execute_and, Processor.execute_xor], branch_conditions)
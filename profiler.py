@@ -0,0 +1,145 @@
+import argparse
+import sys
+from collections import Counter
+
+from processor import Processor, OP_JAL, OP_JALR, STOP_FAULT
+from system import System
+import image
+
+# The profiler takes a sample every this many instructions by default
+DEFAULT_PERIOD = 1000
+
+# The deepest shadow call stack, the outermost calls are dropped past it
+MAX_DEPTH = 512
+
+RETURN_ADDRESS = 1  # ra, the link register of the calling convention
+
+
+# A sampling profiler of the guest, for the interpreter. Every period instructions, an event of the scheduler of
+# the cpu records the pc and the shadow call stack, so the run loop goes at full speed between the samples.
+# The shadow stack is kept by the calls and returns only: while profiling, the decoder gives the JAL and JALR
+# linking into ra, and the JALR jumping to ra without linking, handlers that push and pop the call sites.
+# The samples are named after the symbols of the memory, the addresses without a symbol are shown in hexadecimal.
+class Profiler:
+    def __init__(self, cpu, period=DEFAULT_PERIOD):
+        self.cpu = cpu
+        self.period = period
+        self.stack = []  # The addresses of the calls that have not returned yet, the outermost first
+        self.samples = Counter()  # By the call sites of the stack followed by the sampled pc
+        self.event = None
+
+    def start(self):  # The decoded instructions are dropped, so the calls and returns are decoded again
+        self.cpu.decode = self.decode
+        self.cpu.system.memory.flush_code()
+        self.event = self.cpu.scheduler.schedule(self.cpu.scheduler.now + self.period, self.sample)
+
+    def stop(self):
+        del self.cpu.decode  # Back to the decoder of the class
+        self.cpu.system.memory.flush_code()
+        self.cpu.scheduler.cancel(self.event)
+        self.event = None
+
+    def decode(self, instruction):
+        decoded = Processor.decode(self.cpu, instruction)
+        if decoded.opcode == OP_JAL or decoded.opcode == OP_JALR:
+            if decoded.rd == RETURN_ADDRESS:
+                decoded.execute = self.execute_call
+            elif decoded.rd == 0 and decoded.opcode == OP_JALR and decoded.rs1 == RETURN_ADDRESS:
+                decoded.execute = self.execute_return
+        return decoded
+
+    def execute_call(self, cpu, decoded):
+        pc = cpu.pc
+        if decoded.opcode == OP_JAL:
+            Processor.execute_jal(cpu, decoded)
+        else:
+            Processor.execute_jalr(cpu, decoded)
+
+        stack = self.stack
+        stack.append(pc)
+        if len(stack) > MAX_DEPTH:
+            del stack[0]
+
+    # A return pops its call. When the calls in between never returned, as after a longjmp, they are popped too,
+    # and a jump to ra that returns to no call on the stack leaves the stack alone.
+    def execute_return(self, cpu, decoded):
+        Processor.execute_jalr(cpu, decoded)
+
+        stack = self.stack
+        call = (cpu.pc - cpu.instruction_size) & 0xffffffff
+        if stack and stack[-1] == call:
+            stack.pop()
+        elif call in stack:
+            while stack.pop() != call:
+                pass
+
+    def sample(self):
+        self.samples[(*self.stack, self.cpu.pc)] += 1
+        self.event = self.cpu.scheduler.schedule(self.cpu.scheduler.now + self.period, self.sample)
+
+    # Reports
+
+    def name(self, address):
+        name = self.cpu.system.memory.symbols.lookup(address)
+        return name if name is not None else hex(address)
+
+    def collapsed(self):  # Returns the samples by stack of function names, the outermost first
+        stacks = Counter()
+        for addresses, count in self.samples.items():
+            stacks[";".join(self.name(address) for address in addresses)] += count
+        return stacks
+
+    def write_collapsed(self, filename):  # Writes the collapsed stacks, the input format of the flame graph tools
+        with open(filename, "w") as file:
+            for stack, count in sorted(self.collapsed().items()):
+                file.write(f"{stack} {count}\n")
+
+    # Returns the functions with the most samples, as (name, self samples, total samples). A sample counts for
+    # itself in the function of its pc, and once in total for every function of its stack.
+    def top(self, count=20):
+        own = Counter()
+        total = Counter()
+        for addresses, samples in self.samples.items():
+            names = [self.name(address) for address in addresses]
+            own[names[-1]] += samples
+            for name in set(names):
+                total[name] += samples
+        return [(name, samples, total[name]) for name, samples in own.most_common(count)]
+
+    def format_top(self, count=20):  # Returns the table of the top functions, with their shares of the samples
+        samples = sum(self.samples.values()) or 1
+        lines = [f"{'self':>7} {'total':>7}  function"]
+        for name, own, total in self.top(count):
+            lines.append(f"{100 * own / samples:6.1f}% {100 * total / samples:6.1f}%  {name}")
+        return "\n".join(lines)
+
+
+def main(arguments=None):
+    arguments_parser = argparse.ArgumentParser(description="Profiles a program by sampling its pc and call stack")
+    arguments_parser.add_argument("program", help="a memory dump or an ELF executable")
+    arguments_parser.add_argument("--period", type=int, default=DEFAULT_PERIOD, help="instructions between samples")
+    arguments_parser.add_argument("--max-steps", type=int, default=None, help="instruction budget of the run")
+    arguments_parser.add_argument("--collapsed", help="write the collapsed stacks for a flame graph to this file")
+    arguments_parser.add_argument("--top", type=int, default=20, help="the number of functions in the table")
+    arguments = arguments_parser.parse_args(arguments)
+
+    memory = image.load(arguments.program)
+    system = System(memory)
+    cpu = Processor(system=system)
+    cpu.pc = memory.start
+
+    profiler = Profiler(cpu, arguments.period)
+    profiler.start()
+    stop = cpu.run(arguments.max_steps)
+    profiler.stop()
+    system.flush()
+
+    print(f"{stop.executed} instructions, {sum(profiler.samples.values())} samples", file=sys.stderr)
+    print(profiler.format_top(arguments.top), file=sys.stderr)
+    if arguments.collapsed:
+        profiler.write_collapsed(arguments.collapsed)
+    return 1 if stop.reason == STOP_FAULT else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,264 @@
+import argparse
+import concurrent.futures
+import glob
+import io
+import json
+import os
+import signal
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+
+from processor import Processor, STOP_FAULT
+from translator import Translator
+from system import System, SystemException, standard_streams
+from instrumentation import Counters
+from tracing import Tracer, TraceException
+import image
+
+# The guest runs in slices of this many instructions, the budget is checked between slices
+SLICE_SIZE = 10000
+
+STATUS_PASSED = "passed"
+STATUS_FAILED = "failed"  # The guest reported a failure through an unknown exit code
+STATUS_ERROR = "error"  # The emulator could not execute the guest
+STATUS_TIMEOUT = "timeout"
+STATUS_BUDGET = "budget"  # The guest did not finish within its instruction budget
+
+
+def discover(paths):  # Expands files, directories and glob patterns into a sorted list of test files
+    tests = []
+    for path in paths:
+        if os.path.isdir(path):
+            tests += glob.glob(os.path.join(path, "*.mc"))
+        elif os.path.exists(path):
+            tests.append(path)
+        else:
+            tests += glob.glob(path, recursive=True)
+    return sorted(set(tests))
+
+
+class TimeoutException(Exception):  # Raised in a test that runs past its timeout
+    pass
+
+
+# The standard streams of a test. The guest reads an empty input, so a read of its standard input returns the
+# end of file at once instead of blocking the worker. The output goes to the standard streams of the host, opened
+# once per process and shared by the tests of the worker.
+def test_streams():
+    return [io.BytesIO()] + standard_streams()[1:]
+
+
+def raise_timeout(signum, frame):
+    raise TimeoutException()
+
+
+# Arms a timer raising TimeoutException after the given seconds, so the timeout stops a test in the middle of a
+# slice, or of a system call waiting on the host, and returns the signal handler it replaced. The timer needs
+# setitimer and the main thread of the process, as in the workers of the pool. Elsewhere it returns None and the
+# timeout is only checked between the slices.
+def arm_timeout(seconds):
+    if not hasattr(signal, "setitimer") or threading.current_thread() is not threading.main_thread():
+        return None
+    previous = signal.signal(signal.SIGALRM, raise_timeout)
+    signal.setitimer(signal.ITIMER_REAL, max(seconds, 1e-6))
+    return previous if previous is not None else signal.SIG_DFL
+
+
+def disarm_timeout(previous):
+    signal.setitimer(signal.ITIMER_REAL, 0)
+    signal.signal(signal.SIGALRM, previous)
+
+
+def new_result(path, engine):  # The result of a test that has not run yet
+    return {"name": os.path.splitext(os.path.basename(path))[0], "path": path, "engine": engine,
+            "status": STATUS_PASSED, "reason": "", "instructions": 0, "seconds": 0.0, "mips": 0.0, "fused": 0.0}
+
+
+def run_slice(cpu, translator, count):  # Executes about count instructions and returns how many were executed
+    if translator is not None:
+        return translator.run(count)
+
+    stop = cpu.run(count)
+    if stop.reason == STOP_FAULT:
+        raise stop.error
+    return stop.executed
+
+
+# Runs a single test in the current process and returns its result as a dictionary. When a counters
+# directory is given, the interpreter is instrumented and the counters are written there as JSON.
+# When a trace directory is given, the execution trace is written there. The timeout covers the whole test,
+# the MIPS only the run of the guest, without the load of its image.
+def run_test(path, engine="interpreter", max_instructions=None, timeout=None, counters=None, trace=None):
+    result = new_result(path, engine)
+    executed = 0
+    system = None
+    cpu = None
+    instrumentation = None
+    tracer = None
+    handler = None  # The signal handler replaced by the timer of the timeout
+    begin = time.perf_counter()
+    start = end = None
+
+    try:
+        memory = image.load(path)
+        system = System(memory, test_streams())
+
+        cpu = Processor(system=system)
+        cpu.pc = memory.start
+        translator = Translator(cpu) if engine == "translator" else None
+        if counters is not None:
+            instrumentation = Counters()
+            cpu.attach(instrumentation)
+        if trace is not None:
+            tracer = Tracer(os.path.join(trace, result["name"] + ".trace.gz"))
+            tracer.start(cpu)
+
+        start = time.perf_counter()
+        try:
+            if timeout is not None:
+                handler = arm_timeout(timeout - (start - begin))
+            while not system.terminate:
+                if max_instructions is not None and executed >= max_instructions:
+                    result["status"] = STATUS_BUDGET
+                    result["reason"] = f"Instruction budget of {max_instructions} exhausted at pc {hex(cpu.pc)}"
+                    break
+                if timeout is not None and time.perf_counter() - begin > timeout:
+                    raise TimeoutException()
+
+                count = SLICE_SIZE
+                if max_instructions is not None:
+                    count = min(count, max_instructions - executed)
+                executed += run_slice(cpu, translator, count)
+        finally:
+            if handler is not None:
+                disarm_timeout(handler)
+            end = time.perf_counter()
+
+        if system.terminate and system.exit_code != 0:
+            result["status"] = STATUS_FAILED
+            result["reason"] = f"Exited with status {system.exit_code}"
+
+    except TimeoutException:
+        result["status"] = STATUS_TIMEOUT
+        result["reason"] = f"Timed out after {timeout} seconds at pc {hex(cpu.pc)}"
+    except SystemException as error:
+        result["status"] = STATUS_FAILED
+        result["reason"] = str(error)
+    except Exception as error:
+        result["status"] = STATUS_ERROR
+        result["reason"] = f"{type(error).__name__}: {error}"
+
+    if system is not None:  # The guest may have stopped without exiting, its output is in the shared streams
+        system.flush()
+    if tracer is not None:
+        try:
+            tracer.close()
+        except TraceException as error:
+            result["status"] = STATUS_ERROR
+            result["reason"] = str(error)
+
+    seconds = time.perf_counter() - begin
+    if counters is not None and instrumentation is not None:
+        instrumentation.write_json(os.path.join(counters, result["name"] + ".json"))
+
+    result["instructions"] = executed
+    result["seconds"] = seconds
+    if end is not None and end > start:
+        result["mips"] = executed / (end - start) / 1e6
+    if cpu is not None and executed:  # The share of the instructions run as fused pairs by the interpreter
+        result["fused"] = 2 * cpu.fused_pairs / executed
+    return result
+
+
+# Runs the tests across a pool of processes and returns their results in the order they finish. A test whose
+# worker died, which breaks the pool for the tests still running, gets an error result like the other errors.
+def run_tests(paths, jobs=None, engine="interpreter", max_instructions=None, timeout=None, progress=None,
+              counters=None, trace=None):
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(run_test, path, engine, max_instructions, timeout, counters, trace): path
+                   for path in paths}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as error:
+                result = new_result(futures[future], engine)
+                result["status"] = STATUS_ERROR
+                result["reason"] = f"{type(error).__name__}: {error}"
+            results.append(result)
+            if progress is not None:
+                progress(result)
+    return results
+
+
+def write_json(results, filename):
+    with open(filename, "w") as file:
+        json.dump(sorted(results, key=lambda result: result["path"]), file, indent=2)
+
+
+def write_junit(results, filename):
+    failures = sum(result["status"] in (STATUS_FAILED, STATUS_TIMEOUT, STATUS_BUDGET) for result in results)
+    errors = sum(result["status"] == STATUS_ERROR for result in results)
+    seconds = sum(result["seconds"] for result in results)
+
+    suite = ElementTree.Element("testsuite", name="riscv-emulator", tests=str(len(results)), failures=str(failures),
+                                errors=str(errors), time=f"{seconds:.6f}")
+    for result in sorted(results, key=lambda result: result["path"]):
+        case = ElementTree.SubElement(suite, "testcase", classname=result["engine"], name=result["name"],
+                                      time=f"{result['seconds']:.6f}")
+        properties = ElementTree.SubElement(case, "properties")
+        for key in ("instructions", "mips", "fused"):
+            ElementTree.SubElement(properties, "property", name=key, value=str(result[key]))
+
+        if result["status"] == STATUS_ERROR:
+            ElementTree.SubElement(case, "error", message=result["reason"], type=result["status"])
+        elif result["status"] != STATUS_PASSED:
+            ElementTree.SubElement(case, "failure", message=result["reason"], type=result["status"])
+
+    ElementTree.ElementTree(suite).write(filename, encoding="utf-8", xml_declaration=True)
+
+
+def print_result(result):
+    print(f"{result['status'].upper():8} {result['path']} - {result['instructions']} instructions, "
+          f"{result['mips']:.2f} MIPS, {result['fused']:.1%} fused {result['reason']}")
+
+
+def main(arguments=None):
+    arguments_parser = argparse.ArgumentParser(description="Runs the emulator over a set of test programs")
+    arguments_parser.add_argument("paths", nargs="*", default=["tests"],
+                                  help="test files, directories of .mc files or glob patterns")
+    arguments_parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="number of processes")
+    arguments_parser.add_argument("--engine", choices=["interpreter", "translator"], default="interpreter")
+    arguments_parser.add_argument("--max-instructions", type=int, default=None,
+                                  help="instruction budget of each test")
+    arguments_parser.add_argument("--timeout", type=float, default=60.0, help="wall-clock timeout of each test")
+    arguments_parser.add_argument("--json", help="write the results as JSON to this file")
+    arguments_parser.add_argument("--junit", help="write the results as JUnit XML to this file")
+    arguments_parser.add_argument("--counters", help="instrument the tests and write their counters to this directory")
+    arguments_parser.add_argument("--trace", help="write the compressed execution trace of each test to this directory")
+    arguments = arguments_parser.parse_args(arguments)
+
+    for directory in (arguments.counters, arguments.trace):
+        if directory:
+            if arguments.engine != "interpreter":
+                arguments_parser.error("the counters and traces are only collected by the interpreter")
+            os.makedirs(directory, exist_ok=True)
+
+    paths = discover(arguments.paths)
+    results = run_tests(paths, arguments.jobs, arguments.engine, arguments.max_instructions, arguments.timeout,
+                        print_result, arguments.counters, arguments.trace)
+
+    if arguments.json:
+        write_json(results, arguments.json)
+    if arguments.junit:
+        write_junit(results, arguments.junit)
+
+    passed = sum(result["status"] == STATUS_PASSED for result in results)
+    print(f"{passed}/{len(results)} tests passed")
+    return 0 if passed == len(results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,47 @@
+import heapq
+import itertools
+import sys
+
+
+# The timed events of a machine, in a priority queue ordered by the time they are due. The time is counted
+# in instructions: the run loop of the cpu adds the instructions it executed at the end of each slice, and
+# a slice never runs past the next event, so the cpu only looks at the scheduler when an event is due.
+class Scheduler:
+    def __init__(self):
+        self.now = 0  # The time of the machine, the instructions executed and the ones skipped by WFI
+        self.events = []  # The pending events as [due, sequence, callback], a cancelled event has no callback
+        self.sequence = itertools.count()  # Keeps the events due at the same time in the order they were scheduled
+        self.resolution = sys.maxsize  # The longest slice, so now is never further behind the cpu
+
+    def reset(self):
+        self.now = 0
+        self.events = []
+
+    def schedule(self, due, callback):  # Calls callback once the time reaches due, returns the event
+        event = [due, next(self.sequence), callback]
+        heapq.heappush(self.events, event)
+        return event
+
+    def cancel(self, event):  # The event stays in the queue until it is due, it is then dropped
+        event[2] = None
+
+    def span(self):  # Returns the number of instructions the cpu can execute before the next event, at least one
+        events = self.events
+        while events and events[0][2] is None:
+            heapq.heappop(events)
+        if not events:
+            return self.resolution
+        return max(1, min(events[0][0] - self.now, self.resolution))
+
+    def advance(self, count):  # Adds the executed instructions to the time, and calls the callbacks now due
+        self.now += count
+        events = self.events
+        while events and events[0][0] <= self.now:
+            callback = heapq.heappop(events)[2]
+            if callback is not None:
+                callback()
+
+    def skip(self):  # Moves the time to the next event, the cpu has nothing to do until then
+        self.span()  # Drops the cancelled events at the head of the queue
+        if self.events:
+            self.advance(max(0, self.events[0][0] - self.now))
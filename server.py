@@ -0,0 +1,218 @@
+import argparse
+import asyncio
+import collections
+import io
+import json
+import sys
+
+from processor import Processor, STOP_EXIT, STOP_BUDGET, STOP_FAULT
+from translator import Translator
+from system import System
+import image
+
+# The guests take turns, each one runs a slice of this many instructions before the next one
+SLICE_SIZE = 10000
+
+DEFAULT_BUDGET = 10 ** 8  # The instruction budget of the jobs that do not give one
+
+ENGINES = ["interpreter", "translator"]
+
+
+class JobException(Exception):  # Throw when a job request is invalid
+    pass
+
+
+# A guest submitted by a client. Its standard input is given by the request, and its standard output
+# and error are captured and sent back with its result. The image named by the client is loaded without
+# writing a compiled image next to it, in an executor so that the other guests run meanwhile.
+class Job:
+    def __init__(self, client, request):
+        if not isinstance(request, dict) or not isinstance(request.get("image"), str):
+            raise JobException("A job needs the path of an image")
+        engine = request.get("engine", "interpreter")
+        if engine not in ENGINES:
+            raise JobException(f"Unknown engine: {engine}")
+        budget = request.get("max_steps")
+        if budget is None:
+            budget = DEFAULT_BUDGET
+        if type(budget) is not int or budget < 0:
+            raise JobException(f"Invalid max_steps: {budget!r}")
+        stdin = request.get("stdin", "")
+        if not isinstance(stdin, str):
+            raise JobException("The stdin of a job must be a string")
+
+        self.client = client
+        self.id = request.get("id")
+        self.image = request["image"]
+        self.engine = engine
+        self.budget = budget
+        self.stdin = stdin
+        self.executed = 0
+
+    def load(self):
+        return image.load(self.image, cache=False)
+
+    def start(self, memory):
+        self.output = io.BytesIO()
+        self.errors = io.BytesIO()
+        streams = (io.BytesIO(self.stdin.encode()), self.output, self.errors)
+        self.system = System(memory, streams, host_files=False)
+
+        self.cpu = Processor(system=self.system)
+        self.cpu.pc = memory.start
+        self.translator = Translator(self.cpu) if self.engine == "translator" else None
+
+    # Runs up to count instructions, and returns the result of the job when it is over
+    def run_slice(self, count):
+        count = min(count, self.budget - self.executed)
+        try:
+            if self.translator is not None:
+                self.executed += self.translator.run(count)
+            else:
+                stop = self.cpu.run(count)
+                self.executed += stop.executed
+                if stop.reason == STOP_FAULT:
+                    raise stop.error
+        except Exception as error:
+            return self.result(STOP_FAULT, f"{type(error).__name__}: {error}")
+
+        if self.system.terminate:
+            return self.result(STOP_EXIT)
+        if self.executed >= self.budget:
+            return self.result(STOP_BUDGET)
+        return None
+
+    def result(self, reason, error=""):
+        return {"id": self.id, "reason": reason, "exit_code": self.system.exit_code, "pc": self.cpu.pc,
+                "executed": self.executed, "stdout": self.output.getvalue().decode(errors="replace"),
+                "stderr": self.errors.getvalue().decode(errors="replace"), "error": error}
+
+
+class Client:  # A connection, the results of its jobs are written to it as soon as they are known
+    def __init__(self, writer):
+        self.writer = writer
+        self.pending = 0  # The jobs of the client that are not over
+        self.idle = asyncio.Event()  # Set when no job of the client is pending
+        self.idle.set()
+
+    def send(self, message):
+        if not self.writer.is_closing():
+            self.writer.write(json.dumps(message).encode() + b"\n")
+
+    def add_job(self):
+        self.pending += 1
+        self.idle.clear()
+
+    def finish_job(self, result):
+        self.send(result)
+        self.pending -= 1
+        if self.pending == 0:
+            self.idle.set()
+
+
+# Runs the jobs of every client in one process. A job request is a line of JSON holding the image to run,
+# and optionally an id, a max_steps budget, an engine and the text of the standard input. The guests run
+# in turns of SLICE_SIZE instructions, and the event loop serves the connections between the turns.
+# Each result is a line of JSON, written as soon as its job is over, so the results of a client come back
+# in the order the jobs finish.
+class EmulationServer:
+    def __init__(self, slice_size=SLICE_SIZE):
+        self.slice_size = slice_size
+        self.jobs = collections.deque()  # The jobs that are not over, in the order of their next turn
+        self.ready = asyncio.Event()  # Set when there are jobs to run
+
+    async def schedule(self):  # Runs a slice of each job in turn, until the server is closed
+        while True:
+            if not self.jobs:
+                self.ready.clear()
+                await self.ready.wait()
+
+            job = self.jobs.popleft()
+            if job.client.writer.is_closing():  # The client is gone, no one waits for the result
+                job.client.finish_job(None)
+                continue
+
+            result = job.run_slice(self.slice_size)
+            if result is None:
+                self.jobs.append(job)
+            else:
+                job.client.finish_job(result)
+            await asyncio.sleep(0)  # Let the event loop serve the connections
+
+    async def serve_client(self, reader, writer):
+        client = Client(writer)
+        loop = asyncio.get_running_loop()
+        try:
+            while line := await reader.readline():
+                request = None
+                try:
+                    request = json.loads(line)
+                    job = Job(client, request)
+                    job.start(await loop.run_in_executor(None, job.load))
+                except Exception as error:  # Invalid requests and images only fail their own job
+                    identifier = request.get("id") if isinstance(request, dict) else None
+                    client.send({"id": identifier, "reason": "error", "error": f"{type(error).__name__}: {error}"})
+                    continue
+
+                client.add_job()
+                self.jobs.append(job)
+                self.ready.set()
+
+            await client.idle.wait()  # The client stopped sending, answer the jobs it is waiting for
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, path=None, host="127.0.0.1", port=None):  # Listens on a Unix socket or on a TCP port
+        if path is not None:
+            server = await asyncio.start_unix_server(self.serve_client, path)
+        else:
+            server = await asyncio.start_server(self.serve_client, host, port)
+
+        scheduler = asyncio.create_task(self.schedule())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            scheduler.cancel()
+
+
+# Sends the job requests to a server and returns their results, in the order they finished
+async def submit(requests, path=None, host="127.0.0.1", port=None):
+    if path is not None:
+        reader, writer = await asyncio.open_unix_connection(path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+
+    for request in requests:
+        writer.write(json.dumps(request).encode() + b"\n")
+    writer.write_eof()
+    await writer.drain()
+
+    results = [json.loads(line) async for line in reader]
+    writer.close()
+    return results
+
+
+def main(arguments=None):
+    arguments_parser = argparse.ArgumentParser(description="Serves emulation jobs over a socket")
+    arguments_parser.add_argument("--socket", help="listen on this Unix socket")
+    arguments_parser.add_argument("--host", default="127.0.0.1")
+    arguments_parser.add_argument("--port", type=int, help="listen on this TCP port")
+    arguments_parser.add_argument("--slice", type=int, default=SLICE_SIZE, help="instructions per turn of a guest")
+    arguments = arguments_parser.parse_args(arguments)
+
+    if arguments.socket is None and arguments.port is None:
+        arguments_parser.error("give a --socket or a --port")
+
+    try:
+        asyncio.run(EmulationServer(arguments.slice).serve(arguments.socket, arguments.host, arguments.port))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
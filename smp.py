@@ -0,0 +1,194 @@
+import argparse
+import multiprocessing
+import queue
+import struct
+import sys
+from multiprocessing import shared_memory
+
+from memory import Memory, ZERO_PAGE, PAGE_BITS, PAGE_SIZE
+from processor import Processor, STOP_EXIT, STOP_BUDGET, STOP_FAULT
+from system import System
+import image
+
+# Each hart runs in its own process, they look at the stop event between slices of this many instructions
+SLICE_SIZE = 10000
+
+# The memory of the guest shared by the harts covers its program and at least this many bytes
+DEFAULT_RAM_SIZE = 4 * 1024 * 1024
+
+# The atomic memory operations and the stores take one of these locks, picked by the address of the word
+ATOMIC_LOCKS = 64
+
+# A hart stopped because another hart exited or faulted
+STOP_STOPPED = "stopped"
+
+# The seconds the machine waits for a result before it looks for the harts whose process died
+RESULT_POLL_INTERVAL = 0.1
+
+
+# The memory of a hart of a multi-hart machine. Stores take the lock of their word, so they cannot land
+# between the load and the store of an atomic memory operation of another hart, and bump the store generation
+# of the lock, which breaks the LR reservations of its words. The locks are reentrant, as the atomic operations
+# store through this memory while holding the lock. The stores call the acquire and release methods of the
+# locks directly: the with statement goes through the Python methods of the multiprocessing locks, which cost
+# more than the store itself.
+# Each hart has its own decode cache, which only the stores of the hart invalidate. Code written by another hart
+# runs once the hart executes a FENCE.I, see Processor.execute_fence_i.
+class LockedMemory(Memory):
+    def __init__(self, start, locks, generations):
+        super().__init__(start)
+        self.locks = locks
+        self.acquires = [lock.acquire for lock in locks]
+        self.releases = [lock.release for lock in locks]
+        self.generations = generations
+
+    def write_word(self, data, address):
+        stripe = (address >> 2) % len(self.locks)
+        self.acquires[stripe]()
+        try:
+            Memory.write_word(self, data, address)
+            self.generations[stripe] += 1
+        finally:
+            self.releases[stripe]()
+
+    def write_halfword(self, data, address):
+        stripe = (address >> 2) % len(self.locks)
+        self.acquires[stripe]()
+        try:
+            Memory.write_halfword(self, data, address)
+            self.generations[stripe] += 1
+        finally:
+            self.releases[stripe]()
+
+    def write_byte(self, data, address):
+        stripe = (address >> 2) % len(self.locks)
+        self.acquires[stripe]()
+        try:
+            Memory.write_byte(self, data, address)
+            self.generations[stripe] += 1
+        finally:
+            self.releases[stripe]()
+
+
+# The body of the process of a hart. The pages of the shared memory are mapped into the memory of the
+# hart, so the stores of every hart are seen by the others without copies.
+def run_hart(name, base, size, start, hart_id, locks, generations, stop, max_steps, results):
+    shared = shared_memory.SharedMemory(name)
+    memory = LockedMemory(start, locks, generations)
+    for offset in range(0, size, PAGE_SIZE):
+        memory.map_page((base + offset) >> PAGE_BITS, shared.buf[offset:offset + PAGE_SIZE])
+
+    cpu = Processor(hart_id, System(memory))
+    cpu.pc = start
+    cpu.atomic_locks = locks
+    cpu.store_generations = generations
+
+    result = {"hart": hart_id, "reason": STOP_STOPPED, "pc": start, "executed": 0, "error": ""}
+    while not stop.is_set():
+        count = SLICE_SIZE if max_steps is None else min(SLICE_SIZE, max_steps - result["executed"])
+        reason = cpu.run(count)
+        result["executed"] += reason.executed
+        if reason.reason != STOP_BUDGET or result["executed"] == max_steps:
+            result["reason"] = reason.reason
+            if reason.error is not None:
+                result["error"] = f"{type(reason.error).__name__}: {reason.error}"
+            break
+
+    result["pc"] = cpu.pc
+    if result["reason"] in (STOP_EXIT, STOP_FAULT):
+        stop.set()  # The guest exited or failed, stop the other harts
+    results.put(result)
+
+    # The shared memory can only be closed once no page views it
+    memory.pages = {}
+    memory.read_number = memory.write_number = -1
+    memory.read_page = ZERO_PAGE
+    memory.write_page = None
+    cpu.system.memory = None
+    shared.close()
+
+
+# A machine with several harts running the same program, each one in its own process.
+# The memory of the guest is held in a multiprocessing shared memory block covering the pages
+# of the program and the RAM after them. The harts start at the entry point, with their id in mhartid.
+class SMPMachine:
+    def __init__(self, memory, harts, ram_size=DEFAULT_RAM_SIZE):
+        numbers = sorted(memory.pages)
+        first = numbers[0] if numbers else memory.start >> PAGE_BITS
+        last = numbers[-1] + 1 if numbers else first
+
+        self.base = first << PAGE_BITS
+        self.size = max(last - first, -(-ram_size // PAGE_SIZE)) * PAGE_SIZE
+        self.start = memory.start
+        self.harts = harts
+
+        self.shared = shared_memory.SharedMemory(create=True, size=self.size)
+        for number in numbers:
+            offset = (number << PAGE_BITS) - self.base
+            self.shared.buf[offset:offset + PAGE_SIZE] = memory.pages[number].data
+
+        self.locks = [multiprocessing.RLock() for _ in range(ATOMIC_LOCKS)]
+        self.generations = multiprocessing.RawArray("Q", ATOMIC_LOCKS)  # Only changed under the lock of each one
+
+    # Runs every hart until one of them exits or faults, or until each one executed max_steps instructions.
+    # Returns the result of each hart: why it stopped, its pc, the executed instructions and its error.
+    # A hart whose process dies without a result faults, and stops the other harts.
+    def run(self, max_steps=None):
+        stop = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=run_hart,
+                                             args=(self.shared.name, self.base, self.size, self.start, hart_id,
+                                                   self.locks, self.generations, stop, max_steps, results))
+                     for hart_id in range(self.harts)]
+        for process in processes:
+            process.start()
+
+        finished = {}
+        while len(finished) < len(processes):
+            try:
+                result = results.get(timeout=RESULT_POLL_INTERVAL)
+                finished[result["hart"]] = result
+                continue
+            except queue.Empty:
+                pass
+
+            for hart_id, process in enumerate(processes):  # A hart that exited normally has sent its result
+                if hart_id not in finished and not process.is_alive() and process.exitcode != 0:
+                    finished[hart_id] = {"hart": hart_id, "reason": STOP_FAULT, "pc": self.start, "executed": 0,
+                                         "error": f"The process of the hart died with exit code {process.exitcode}"}
+                    stop.set()
+
+        for process in processes:
+            process.join()
+        return [finished[hart_id] for hart_id in sorted(finished)]
+
+    def read_word(self, address):  # Reads a word of the shared memory, to look at the results of the guest
+        return struct.unpack_from("<I", self.shared.buf, address - self.base)[0]
+
+    def close(self):  # Frees the shared memory
+        self.shared.close()
+        self.shared.unlink()
+
+
+def main(arguments=None):
+    arguments_parser = argparse.ArgumentParser(description="Runs a program on several harts")
+    arguments_parser.add_argument("program", help="a memory dump or an ELF executable")
+    arguments_parser.add_argument("--harts", type=int, default=multiprocessing.cpu_count())
+    arguments_parser.add_argument("--max-steps", type=int, default=None, help="instruction budget of each hart")
+    arguments_parser.add_argument("--ram-size", type=int, default=DEFAULT_RAM_SIZE, help="bytes of shared memory")
+    arguments = arguments_parser.parse_args(arguments)
+
+    machine = SMPMachine(image.load(arguments.program), arguments.harts, arguments.ram_size)
+    try:
+        results = machine.run(arguments.max_steps)
+    finally:
+        machine.close()
+
+    for result in results:
+        print(f"hart {result['hart']}: {result['reason']} at pc {hex(result['pc'])} after {result['executed']} "
+              f"instructions {result['error']}")
+    return 0 if any(result["reason"] == STOP_EXIT for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,134 @@
+import json
+import mmap
+import os
+import struct
+
+from memory import Memory, Page, PAGE_SIZE
+from mmu import physical_class
+
+# A snapshot file is a header, the machine state as JSON, the numbers of the saved pages and the pages
+# themselves, starting at a page-aligned offset so they can be mapped straight into a memory.
+SNAPSHOT_MAGIC = b"RVSN"
+SNAPSHOT_VERSION = 2
+
+# magic, version, length of the JSON state, number of pages
+header_format = struct.Struct("<4sHII")
+
+
+class SnapshotException(Exception):  # Throw when a snapshot file is invalid
+    pass
+
+
+def align_page(n):  # Rounds n up to a multiple of the page size
+    return (n + PAGE_SIZE - 1) & ~(PAGE_SIZE - 1)
+
+
+# The full state of a machine: the registers, pc, CSRs, privilege mode and reservation of the cpu, the time of its
+# scheduler, the memory, the system state and the state of the mapped devices, by the address they are mapped at.
+# The pages are shared copy-on-write with the memory the snapshot was taken from and with every
+# memory restored from it, so taking or restoring a snapshot does not copy the memory contents.
+class Snapshot:
+    def __init__(self, registers, pc, start, pages, system_state, cpu_state, device_states, decode_cache=None):
+        self.registers = registers
+        self.pc = pc
+        self.start = start
+        self.pages = pages  # The shared pages, by page number
+        self.system_state = system_state
+        self.cpu_state = cpu_state  # The CSRs by number, the privilege mode, the reservation and the time
+        self.device_states = device_states  # By the address of the device
+        self.decode_cache = decode_cache or {}  # The decoded instructions, so a restored machine starts warm
+
+    @staticmethod
+    def take(cpu):  # Takes a snapshot of the cpu, the system, its memory and its devices
+        memory = cpu.system.memory
+        cpu.system.flush()  # The output buffered by the devices belongs to the past of the snapshot
+        cpu_state = {"csrs": dict(cpu.csrs), "privilege": cpu.privilege, "time": cpu.scheduler.now,
+                     "reservation": list(cpu.reservation) if cpu.reservation is not None else None}
+        device_states = {start: device.state() for start, _, device in memory.bus.ranges}
+        return Snapshot(tuple(cpu.registers), cpu.pc, memory.start, memory.share_pages(), cpu.system.state(),
+                        cpu_state, device_states, dict(memory.decode_cache))
+
+    # Restores the machine into the cpu and the system. The restored memory is new, it keeps the devices, the code
+    # listeners and the symbols of the memory it replaces, so a translator of the cpu has to be created again.
+    # It has the class of the memory it replaces without paging, and keeps the attributes that class adds to
+    # a memory, such as the locks of a hart of a multi-hart machine.
+    def restore(self, cpu):
+        previous = cpu.system.memory
+        cls = physical_class(previous)
+        memory = cls.__new__(cls)
+        memory.__dict__.update({name: value for name, value in vars(previous).items() if not hasattr(cls, name)})
+        Memory.__init__(memory, self.start)
+        memory.pages = dict(self.pages)
+        memory.decode_cache = dict(self.decode_cache)
+        memory.bus = previous.bus
+        memory.device_pages = previous.device_pages
+        memory.code_listeners = previous.code_listeners
+        memory.symbols = previous.symbols
+
+        for key, value in self.system_state.items():  # The open files of the system are kept
+            setattr(cpu.system, key, value)
+        cpu.system.memory = memory
+
+        cpu.registers[:] = self.registers
+        cpu.pc = self.pc
+        cpu.csrs = dict(self.cpu_state["csrs"])
+        cpu.privilege = self.cpu_state["privilege"]
+        reservation = self.cpu_state["reservation"]
+        cpu.reservation = tuple(reservation) if reservation is not None else None
+        cpu.scheduler.now = self.cpu_state["time"]
+        cpu.update_translation()
+
+        for start, _, device in memory.bus.ranges:  # The devices schedule their events again from the restored time
+            if start in self.device_states:
+                device.load_state(self.device_states[start])
+        return memory
+
+    def save(self, filename):  # Writes the snapshot to a file, the decoded instructions are not saved
+        cpu_state = dict(self.cpu_state, csrs={str(csr): value for csr, value in self.cpu_state["csrs"].items()})
+        state = json.dumps({"registers": list(self.registers), "pc": self.pc, "start": self.start,
+                            "system": self.system_state, "cpu": cpu_state,
+                            "devices": {str(start): state for start, state in self.device_states.items()}}).encode()
+        numbers = sorted(self.pages)
+
+        header = header_format.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(state), len(numbers))
+        header += state + struct.pack(f"<{len(numbers)}I", *numbers)
+
+        temporary = f"{filename}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as file:
+            file.write(header)
+            file.write(bytes(align_page(len(header)) - len(header)))
+            for number in numbers:
+                file.write(self.pages[number].data)
+        os.replace(temporary, filename)
+
+    # Reads a snapshot from a file. The file is mapped copy-on-write and its pages are only read
+    # from disk when a restored machine touches them.
+    @staticmethod
+    def load(filename):
+        with open(filename, "rb") as file:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+
+        try:
+            magic, version, length, count = header_format.unpack_from(data, 0)
+            if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                raise SnapshotException(f"Not a snapshot: {filename}")
+
+            offset = header_format.size
+            state = json.loads(bytes(data[offset:offset + length]))
+            numbers = struct.unpack_from(f"<{count}I", data, offset + length)
+        except (ValueError, KeyError, struct.error) as error:
+            raise SnapshotException(f"Invalid snapshot {filename}: {error}")
+
+        view = memoryview(data)
+        offset = align_page(offset + length + 4 * count)
+        pages = {}
+        for index, number in enumerate(numbers):
+            page = view[offset + index * PAGE_SIZE:offset + (index + 1) * PAGE_SIZE]
+            if len(page) != PAGE_SIZE:
+                raise SnapshotException(f"The snapshot is truncated: {filename}")
+            pages[number] = Page(page, True)
+
+        cpu_state = dict(state["cpu"], csrs={int(csr): value for csr, value in state["cpu"]["csrs"].items()})
+        device_states = {int(start): device_state for start, device_state in state["devices"].items()}
+        return Snapshot(tuple(state["registers"]), state["pc"], state["start"], pages, state["system"], cpu_state,
+                        device_states)
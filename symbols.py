@@ -0,0 +1,20 @@
+import bisect
+
+
+# The labels of a program, sorted by address. The name of an address is the one of the closest label at or
+# before it, so every instruction of a function is named after the function.
+class SymbolTable:
+    def __init__(self, symbols=()):  # The symbols are given as (address, name) pairs, in any order
+        symbols = sorted(symbols)
+        self.addresses = [address for address, _ in symbols]
+        self.names = [name for _, name in symbols]
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def __iter__(self):  # Yields the (address, name) pairs by address
+        return zip(self.addresses, self.names)
+
+    def lookup(self, address):  # Returns the name of the label covering the address, or None
+        index = bisect.bisect_right(self.addresses, address) - 1
+        return self.names[index] if index >= 0 else None
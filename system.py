@@ -1,17 +1,208 @@
+import errno
+import os
+
+from memory import PAGE_BITS
+
+# The numbers of the Linux system calls, passed in a7. The parameters are passed in a0 to a5
+# and the result, or the negated error number, is returned in a0.
+SYSCALL_OPENAT = 56
+SYSCALL_CLOSE = 57
+SYSCALL_READ = 63
+SYSCALL_WRITE = 64
+SYSCALL_EXIT = 93
+SYSCALL_BRK = 214
+
+# The flags of openat, as defined by Linux on RISC-V
+O_ACCMODE = 0o3
+O_CREAT = 0o100
+O_EXCL = 0o200
+O_TRUNC = 0o1000
+O_APPEND = 0o2000
+AT_FDCWD = -100
+
+OUTPUT_BUFFER_SIZE = 64 * 1024  # The writes of the guest to a file are batched in buffers of this size
+
+
 class SystemException(Exception):  # Throw when an unknown system code is called
     pass
 
 
+host_streams = []  # The standard streams of the host, opened by the first guest using them and shared by the others
+
+
+# Returns the standard streams of the host. They are opened on the descriptors 0 to 2 of the process, not through
+# sys.stdin and sys.stdout which may be replaced, as under a test runner. They are buffered but never closed, and
+# every system shares them, so the output of the guests of a process keeps its order.
+def standard_streams():
+    if not host_streams:
+        host_streams.extend([open(0, "rb", closefd=False),
+                             open(1, "wb", buffering=OUTPUT_BUFFER_SIZE, closefd=False),
+                             open(2, "wb", buffering=OUTPUT_BUFFER_SIZE, closefd=False)])
+    return host_streams
+
+
+# The memory and the system calls of a machine. The riscv-tests programs leave a7 at zero and pass a single
+# exit code in a0, 1 when the test passed. The other programs make Linux system calls, selected by a7.
+# The standard streams of the guest are the ones of the host, unless three binary files are given. Either way the
+# stream files are opened once, when the first guest is given, and a reset hands the same ones to the next guest.
+# Without host_files, the guest cannot open the files of the host.
 class System:
-    def __init__(self):
+    def __init__(self, memory=None, streams=None, host_files=True):
         self.terminate = False
         self.debug = False
+        self.memory = None
+        self.exit_code = 0  # The status given to the exit system call
+        self.program_break = None  # The end of the heap, it starts after the pages of the program
+        self.files = {}  # The open files of the guest, by file descriptor
+        self.devices = []  # The devices buffering output of the guest, flushed before the files
+        self.host_files = host_files
+        self.streams = streams  # None for the standard streams of the host
+
+        if memory is not None:
+            self.reset(memory)
+
+    # Prepares the system to run a new guest in the given memory. The memory holds the loaded program only, so the
+    # heap starts after its last page, whatever pages the stack of the guest touches later.
+    def reset(self, memory):
+        self.flush()
+        for descriptor, file in self.files.items():
+            if descriptor > 2:
+                file.close()
+
+        self.memory = memory
+        self.terminate = False
+        self.exit_code = 0
+        self.program_break = (max(memory.pages) + 1) << PAGE_BITS if memory.pages else 0
+        if self.streams is None:
+            self.streams = standard_streams()
+        self.files = dict(enumerate(self.streams))
+
+    def flush(self):  # Writes the buffered output of the guest
+        for device in self.devices:
+            device.flush()
+        for file in self.files.values():
+            if file.writable():
+                file.flush()
+
+    def state(self):  # The state that a snapshot of the machine holds, the open files are not part of it
+        return {"terminate": self.terminate, "debug": self.debug, "exit_code": self.exit_code,
+                "program_break": self.program_break}
 
-    def call(self, parameters):
-        if parameters[0] == 1:
-            self.terminate = True
+    def call(self, registers):
+        number = registers[17]
+        if number == 0:
+            if registers[10] == 1:
+                self.flush()
+                self.terminate = True
+            else:
+                raise SystemException(f"Unknown system call: {registers[10]}")
+            return
+
+        handler = system_calls.get(number)
+        if handler is None:
+            raise SystemException(f"Unknown system call: {number}")
+        result = handler(self, *registers[10:16])
+        registers[10] = result & 0xffffffff
+
+    def get_file(self, descriptor):
+        file = self.files.get(descriptor)
+        if file is None:
+            raise OSError(errno.EBADF, "Bad file descriptor")
+        return file
+
+    # Reads a NUL terminated string from the guest memory. It is returned as bytes, the host takes them as a path
+    # like Linux does, so a name that is not valid UTF-8 cannot fail in the emulator.
+    def read_string(self, address):
+        data = bytearray()
+        while True:
+            byte = self.memory.read_byte(address)
+            if byte == 0:
+                return bytes(data)
+            data.append(byte)
+            address = (address + 1) & 0xffffffff
+
+    # Writes count bytes from the guest buffer to a file. The pages of the buffer are handed to the file
+    # as memoryview slices, and the file batches them in its buffer.
+    def call_write(self, descriptor, address, count, *unused):
+        file = self.get_file(descriptor)
+        for view in self.memory.views(address, count):
+            file.write(view)
+        return count
+
+    # Reads up to count bytes from a file straight into the pages of the guest buffer
+    def call_read(self, descriptor, address, count, *unused):
+        file = self.get_file(descriptor)
+        if descriptor == 0:
+            self.flush()  # Show the output before waiting for the input
+        total = 0
+        for view in self.memory.writable_views(address, count):
+            read = file.readinto(view) or 0
+            total += read
+            if read < len(view):
+                break
+        return total
+
+    def call_openat(self, directory, address, flags, mode, *unused):
+        if not self.host_files:
+            return -errno.EACCES
+        if directory != AT_FDCWD & 0xffffffff:
+            return -errno.EBADF  # Only paths relative to the working directory are supported
+
+        host_flags = [os.O_RDONLY, os.O_WRONLY, os.O_RDWR, os.O_RDWR][flags & O_ACCMODE]
+        for guest, host in ((O_CREAT, os.O_CREAT), (O_EXCL, os.O_EXCL), (O_TRUNC, os.O_TRUNC),
+                            (O_APPEND, os.O_APPEND)):
+            if flags & guest:
+                host_flags |= host
+
+        handle = os.open(self.read_string(address), host_flags, mode)
+        file_mode = "ab" if flags & O_APPEND else ["rb", "wb", "r+b", "r+b"][flags & O_ACCMODE]
+        descriptor = 3
+        while descriptor in self.files:  # Like Linux, the lowest free descriptor is used
+            descriptor += 1
+        self.files[descriptor] = open(handle, file_mode, buffering=OUTPUT_BUFFER_SIZE)
+        return descriptor
+
+    def call_close(self, descriptor, *unused):
+        file = self.get_file(descriptor)
+        del self.files[descriptor]
+        if descriptor > 2:
+            file.close()
         else:
-            raise SystemException(f"Unknown system call: {parameters[0]}")
+            file.flush()
+        return 0
+
+    def call_exit(self, status, *unused):
+        self.flush()
+        self.terminate = True
+        self.exit_code = status
+        return status
+
+    # Moves the end of the heap. The pages are allocated when they are first written,
+    # so the heap only has to be bounded by the program.
+    def call_brk(self, address, *unused):
+        if address >= self.program_break:
+            self.program_break = address
+        return self.program_break
+
+
+def system_call(handler):  # Turns the host errors of a system call into negated error numbers, like Linux
+    def call(self, *parameters):
+        try:
+            return handler(self, *parameters)
+        except OSError as error:
+            return -(error.errno or errno.EIO)
+
+    return call
+
 
+# The handler of each Linux system call
+system_calls = {
+    SYSCALL_OPENAT: system_call(System.call_openat),
+    SYSCALL_CLOSE: system_call(System.call_close),
+    SYSCALL_READ: system_call(System.call_read),
+    SYSCALL_WRITE: system_call(System.call_write),
+    SYSCALL_EXIT: System.call_exit,
+    SYSCALL_BRK: System.call_brk,
+}
 
-system = System()
+system = System()  # The system of the processors created without one
@@ -0,0 +1,77 @@
+import unittest
+
+import assembler
+from processor import (Processor, STOP_EXIT, OP_LOAD, OP_STORE, LOAD_FUNCT3_LB, LOAD_FUNCT3_LH, LOAD_FUNCT3_LHU,
+                       STORE_FUNCT3_SH)
+from system import System
+
+try:
+    from batch import BatchMachine, LANE_EXITED, LANE_FAULT
+except ImportError:  # The batch machine needs numpy
+    BatchMachine = None
+
+START = 0x80000000
+DATA = 0x80001000  # The second page of the window, after the code
+VALUES = [0, 1, 0x7f, 0x80, 0xff, 0x8000, 0x12345678, 0x80000000, 0xdeadbeef, 0xffffffff]
+
+
+def lb(rd, rs1, imm):
+    return assembler.i_type(OP_LOAD, LOAD_FUNCT3_LB, rd, rs1, imm)
+
+
+def lh(rd, rs1, imm):
+    return assembler.i_type(OP_LOAD, LOAD_FUNCT3_LH, rd, rs1, imm)
+
+
+def lhu(rd, rs1, imm):
+    return assembler.i_type(OP_LOAD, LOAD_FUNCT3_LHU, rd, rs1, imm)
+
+
+def sh(rs2, rs1, imm):
+    return assembler.s_type(OP_STORE, STORE_FUNCT3_SH, rs1, rs2, imm)
+
+
+# Stores x6 with each width, at aligned and misaligned offsets and across the end of the data page,
+# and loads it back with each width and sign extension into x18 to x31
+def program():
+    words = assembler.load_immediate(5, DATA) + assembler.load_immediate(7, DATA + 0x1000)
+    words += [assembler.sw(6, 5, 0), sh(6, 5, 8), assembler.sb(6, 5, 12), assembler.sw(6, 5, 17), sh(6, 5, 23),
+              assembler.sw(6, 7, -2)]
+    loads = [assembler.lw(0, 5, 0), lb(0, 5, 0), assembler.lbu(0, 5, 3), lh(0, 5, 8), lhu(0, 5, 8), lb(0, 5, 12),
+             assembler.lbu(0, 5, 12), assembler.lw(0, 5, 17), lh(0, 5, 23), lhu(0, 5, 23), assembler.lw(0, 7, -2),
+             lh(0, 7, -1), assembler.lw(0, 5, 16), lb(0, 5, 19)]
+    words += [load | (18 + index) << 7 for index, load in enumerate(loads)]  # The destination register
+    return words + [assembler.addi(17, 0, 0)]
+
+
+@unittest.skipIf(BatchMachine is None, "numpy is not installed")
+class BatchMachineTest(unittest.TestCase):
+    def test_loads_and_stores_match_the_interpreter(self):
+        words = program() + assembler.exit_program()
+        machine = BatchMachine(assembler.assemble(words, START), len(VALUES), size=0x3000)
+        machine.registers[:, 6] = VALUES
+        machine.run()
+
+        for lane, value in enumerate(VALUES):
+            memory = assembler.assemble(words, START)
+            cpu = Processor(system=System(memory))
+            cpu.pc = START
+            cpu.registers[6] = value
+            self.assertEqual(cpu.run().reason, STOP_EXIT)
+
+            self.assertEqual(machine.state[lane], LANE_EXITED, machine.fault_reason)
+            self.assertEqual([int(register) for register in machine.registers[lane]], cpu.registers, hex(value))
+            window = machine.memory[lane, DATA - START:DATA - START + 0x1004].tobytes()
+            self.assertEqual(window, bytes(memory.read_bytes(DATA, 0x1004)))
+
+    def test_access_outside_of_the_window_faults_the_lane(self):
+        words = assembler.load_immediate(5, DATA) + [assembler.add(5, 5, 6), assembler.lw(7, 5, 0)]
+        machine = BatchMachine(assembler.assemble(words + assembler.exit_program(), START), 2, size=0x2000)
+        machine.registers[:, 6] = [0, 0x1000]  # The second lane loads from the end of the window
+        machine.run()
+        self.assertEqual(list(machine.state), [LANE_EXITED, LANE_FAULT])
+        self.assertIn("outside of the batch window", machine.fault_reason[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
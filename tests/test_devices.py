@@ -0,0 +1,144 @@
+import errno
+import io
+import unittest
+
+from bus import Bus, BusException, TimeBehind
+from memory import Memory
+from system import System, SYSCALL_READ, SYSCALL_WRITE
+from uart import Uart, UART_BASE, UART_RBR, UART_LSR, UART_BUFFER_SIZE, LSR_DATA_READY, LSR_TRANSMIT_EMPTY
+
+DEVICE = 0x20000000
+
+
+class Registers:  # A device of plain registers, recording its accesses
+    def __init__(self, size):
+        self.data = bytearray(size)
+        self.accesses = []
+
+    def read(self, offset, size):
+        self.accesses.append(("read", offset, size))
+        return int.from_bytes(self.data[offset:offset + size], "little")
+
+    def write(self, offset, size, value):
+        self.accesses.append(("write", offset, size))
+        self.data[offset:offset + size] = (value & ((1 << 8 * size) - 1)).to_bytes(size, "little")
+
+
+class BusTest(unittest.TestCase):
+    def test_overlapping_devices_are_rejected(self):
+        bus = Bus()
+        bus.attach(0x100, 0x10, Registers(0x10))
+        bus.attach(0x110, 0x10, Registers(0x10))  # Right after the first one
+        bus.attach(0xf0, 0x10, Registers(0x10))  # Right before it
+        for address, size in ((0x108, 0x10), (0xf8, 0x10), (0x80, 0x100), (0x104, 4)):
+            with self.assertRaises(BusException):
+                bus.attach(address, size, Registers(size))
+
+    def test_accesses_reach_the_device_of_their_range(self):
+        bus = Bus()
+        first, second = Registers(0x10), Registers(0x10)
+        bus.attach(0x100, 0x10, first)
+        bus.attach(0x200, 0x10, second)
+
+        bus.write(0x204, 4, 0x12345678)
+        self.assertEqual(bus.last[2], second)
+        self.assertEqual(bus.read(0x204, 2), 0x5678)
+        self.assertEqual(bus.read(0x108, 4), 0)
+        self.assertEqual(bus.last[2], first)
+        self.assertEqual(second.accesses, [("write", 4, 4), ("read", 4, 2)])
+        self.assertEqual(first.accesses, [("read", 8, 4)])
+
+        self.assertEqual(bus.read(0x180, 4), 0)  # Between the ranges
+        bus.write(0x180, 4, 1)
+        self.assertEqual(bus.last[2], first)  # A miss keeps the last range
+
+    def test_accesses_wait_for_the_time(self):
+        bus = Bus()
+        registers = Registers(4)
+        bus.attach(0, 4, registers)
+        bus.current = False
+        with self.assertRaises(TimeBehind):
+            bus.write(0, 4, 1)
+        self.assertEqual(registers.accesses, [])
+
+
+class DevicePageTest(unittest.TestCase):
+    def setUp(self):
+        self.memory = Memory()
+        self.registers = Registers(16)
+        self.memory.map_device(DEVICE, 16, self.registers)
+
+    def test_misaligned_accesses_go_through_the_bus_byte_by_byte(self):
+        self.memory.write_word(0x44332211, DEVICE + 1)
+        self.assertEqual(self.registers.data[:6], b"\0\x11\x22\x33\x44\0")
+        self.assertEqual(self.memory.read_word(DEVICE + 1), 0x44332211)
+        self.assertEqual(self.memory.read_halfword(DEVICE + 3), 0x4433)
+        self.memory.write_halfword(0x6655, DEVICE + 5)
+        self.assertEqual(self.memory.read_word(DEVICE + 4), 0x665544)
+
+        self.assertEqual(self.registers.accesses[:4], [("write", 1, 1), ("write", 2, 1), ("write", 3, 1),
+                                                       ("write", 4, 1)])
+        self.assertNotIn(DEVICE >> 12, self.memory.pages)  # No RAM stands in for the device
+
+    def test_ranges_of_bytes_reach_the_devices(self):
+        self.memory.write_bytes(DEVICE + 2, b"abc")
+        self.assertEqual(self.registers.data[2:5], b"abc")
+        self.assertEqual(self.memory.read_bytes(DEVICE, 6), b"\0\0abc\0")
+        self.assertEqual(b"".join(self.memory.views(DEVICE + 1, 3)), b"\0ab")
+        self.assertNotIn(DEVICE >> 12, self.memory.pages)
+
+        with self.assertRaises(OSError) as context:
+            list(self.memory.writable_views(DEVICE, 4))
+        self.assertEqual(context.exception.errno, errno.EFAULT)
+
+    def test_system_calls_on_a_device_buffer(self):
+        system = System(self.memory, [io.BytesIO(b"input"), io.BytesIO(), io.BytesIO()])
+        self.registers.data[:] = b"0123456789abcdef"
+        registers = [0] * 32
+        registers[10:13], registers[17] = [1, DEVICE + 4, 6], SYSCALL_WRITE
+        system.call(registers)
+        self.assertEqual(registers[10], 6)
+        self.assertEqual(system.files[1].getvalue(), b"456789")
+
+        registers[10:13], registers[17] = [0, DEVICE, 4], SYSCALL_READ
+        system.call(registers)
+        self.assertEqual(registers[10], -errno.EFAULT & 0xffffffff)
+
+
+class UartTest(unittest.TestCase):
+    def setUp(self):
+        self.stdout = io.BytesIO()
+        self.system = System(Memory(), [io.BytesIO(), self.stdout, io.BytesIO()])
+        self.uart = Uart(self.system)
+        self.memory = self.system.memory
+
+    def test_transmit_flushes_at_the_end_of_each_line(self):
+        self.assertEqual(self.memory.read_byte(UART_BASE + UART_LSR), LSR_TRANSMIT_EMPTY)
+        for byte in b"hi":
+            self.memory.write_byte(byte, UART_BASE + UART_RBR)
+        self.assertEqual(self.stdout.getvalue(), b"")
+        self.memory.write_byte(0x0a, UART_BASE + UART_RBR)
+        self.assertEqual(self.stdout.getvalue(), b"hi\n")
+
+    def test_transmit_flushes_a_full_buffer(self):
+        for _ in range(UART_BUFFER_SIZE - 1):
+            self.memory.write_byte(ord("x"), UART_BASE + UART_RBR)
+        self.assertEqual(self.stdout.getvalue(), b"")
+        self.memory.write_byte(ord("x"), UART_BASE + UART_RBR)
+        self.assertEqual(self.stdout.getvalue(), b"x" * UART_BUFFER_SIZE)
+
+        self.memory.write_byte(ord("y"), UART_BASE + UART_RBR)
+        self.system.flush()  # The system flushes its devices before its files
+        self.assertEqual(self.stdout.getvalue(), b"x" * UART_BUFFER_SIZE + b"y")
+
+    def test_receive_queue(self):
+        self.uart.receive(b"ok")
+        self.assertEqual(self.memory.read_byte(UART_BASE + UART_LSR), LSR_TRANSMIT_EMPTY | LSR_DATA_READY)
+        self.assertEqual(self.memory.read_byte(UART_BASE + UART_RBR), ord("o"))
+        self.assertEqual(self.memory.read_byte(UART_BASE + UART_RBR), ord("k"))
+        self.assertEqual(self.memory.read_byte(UART_BASE + UART_LSR), LSR_TRANSMIT_EMPTY)
+        self.assertEqual(self.memory.read_byte(UART_BASE + UART_RBR), 0)  # An empty queue reads as zero
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+import random
+import unittest
+
+import assembler
+from processor import (Processor, STOP_EXIT, OP_IMM, OP_OP, OP_LUI, OP_AUIPC, OP_FUNCT7_STANDARD,
+                       OP_FUNCT7_ALTERNATE, OP_FUNC7_MULDIV, IMM_FUNCT7_SRAI)
+from system import System
+from translator import Translator
+
+try:
+    from batch import BatchMachine, LANE_EXITED
+except ImportError:  # The batch machine needs numpy
+    BatchMachine = None
+
+START = 0x80000000
+MASK = 0xffffffff
+PROGRAMS = 40
+LENGTH = 48  # The random instructions of a program
+SPECIAL_VALUES = [0, 1, 2, 0x7fffffff, 0x80000000, 0x80000001, 0xfffffffe, MASK]
+
+
+def signed(value):
+    return value - (1 << 32) if value & 0x80000000 else value
+
+
+def quotient(a, b):  # Signed division rounding towards zero, in Python integers
+    return abs(a) // abs(b) * (1 if (a < 0) == (b < 0) else -1)
+
+
+# The reference results of the register and immediate operations, as functions of the unsigned operands.
+# They are written from the specification, independently of the handlers of the engines.
+register_operations = {
+    (OP_FUNCT7_STANDARD, 0): lambda a, b: a + b,
+    (OP_FUNCT7_ALTERNATE, 0): lambda a, b: a - b,
+    (OP_FUNCT7_STANDARD, 1): lambda a, b: a << (b & 31),
+    (OP_FUNCT7_STANDARD, 2): lambda a, b: int(signed(a) < signed(b)),
+    (OP_FUNCT7_STANDARD, 3): lambda a, b: int(a < b),
+    (OP_FUNCT7_STANDARD, 4): lambda a, b: a ^ b,
+    (OP_FUNCT7_STANDARD, 5): lambda a, b: a >> (b & 31),
+    (OP_FUNCT7_ALTERNATE, 5): lambda a, b: signed(a) >> (b & 31),
+    (OP_FUNCT7_STANDARD, 6): lambda a, b: a | b,
+    (OP_FUNCT7_STANDARD, 7): lambda a, b: a & b,
+    (OP_FUNC7_MULDIV, 0): lambda a, b: a * b,
+    (OP_FUNC7_MULDIV, 1): lambda a, b: (signed(a) * signed(b)) >> 32,
+    (OP_FUNC7_MULDIV, 2): lambda a, b: (signed(a) * b) >> 32,
+    (OP_FUNC7_MULDIV, 3): lambda a, b: (a * b) >> 32,
+    (OP_FUNC7_MULDIV, 4): lambda a, b: -1 if b == 0 else quotient(signed(a), signed(b)),
+    (OP_FUNC7_MULDIV, 5): lambda a, b: MASK if b == 0 else a // b,
+    (OP_FUNC7_MULDIV, 6): lambda a, b: a if b == 0 else signed(a) - signed(b) * quotient(signed(a), signed(b)),
+    (OP_FUNC7_MULDIV, 7): lambda a, b: a if b == 0 else a % b,
+}
+
+immediate_operations = {
+    0: lambda a, imm: a + imm,
+    2: lambda a, imm: int(signed(a) < imm),
+    3: lambda a, imm: int(a < imm & MASK),
+    4: lambda a, imm: a ^ imm,
+    6: lambda a, imm: a | imm,
+    7: lambda a, imm: a & imm,
+}
+
+
+def random_instruction(generator):
+    rd = generator.choice([0] + list(range(1, 32)) * 4)  # x0 is written once in a while, it must stay zero
+    rs1, rs2 = generator.randrange(32), generator.randrange(32)
+    kind = generator.randrange(10)
+    if kind < 5:
+        funct7, funct3 = generator.choice(list(register_operations))
+        return assembler.r_type(OP_OP, funct3, funct7, rd, rs1, rs2)
+    if kind < 8:
+        funct3 = generator.choice(list(immediate_operations) + [1, 5, 5])
+        if funct3 == 1:
+            return assembler.i_type(OP_IMM, 1, rd, rs1, generator.randrange(32))
+        if funct3 == 5:
+            imm = generator.randrange(32) | generator.choice([0, IMM_FUNCT7_SRAI << 5])
+            return assembler.i_type(OP_IMM, 5, rd, rs1, imm)
+        return assembler.i_type(OP_IMM, funct3, rd, rs1, generator.choice([0, 1, -1, 2047, -2048,
+                                                                            generator.randrange(-2048, 2048)]))
+    return assembler.u_type(generator.choice([OP_LUI, OP_AUIPC]), rd, generator.randrange(1 << 20))
+
+
+def reference(words, registers):  # Runs the straight-line program on the reference model
+    registers = list(registers)
+    for index, word in enumerate(words):
+        opcode, rd, funct3 = word & 0x7f, (word >> 7) & 31, (word >> 12) & 7
+        a, b = registers[(word >> 15) & 31], registers[(word >> 20) & 31]
+        imm = signed(word) >> 20
+        if opcode == OP_OP:
+            value = register_operations[(word >> 25, funct3)](a, b)
+        elif opcode == OP_IMM and funct3 == 1:
+            value = a << (imm & 31)
+        elif opcode == OP_IMM and funct3 == 5:
+            value = (signed(a) if imm >> 5 == IMM_FUNCT7_SRAI else a) >> (imm & 31)
+        elif opcode == OP_IMM:
+            value = immediate_operations[funct3](a, imm)
+        else:
+            value = (word & ~0xfff) + (START + 4 * index if opcode == OP_AUIPC else 0)
+        if rd:
+            registers[rd] = value & MASK
+    return registers
+
+
+# Runs random programs of the integer and M extension operations, from registers holding the edge values of
+# the operations, on every engine. The final registers must match the reference model, and the interpreter and
+# the translator must keep every register a Python int in the unsigned 32-bit range.
+class DifferentialFuzzTest(unittest.TestCase):
+    def programs(self):
+        generator = random.Random(2024)
+        for _ in range(PROGRAMS):
+            words = [random_instruction(generator) for _ in range(LENGTH)]
+            words += [assembler.addi(17, 0, 0)]  # The exit call takes its number from a7
+            registers = [0] + [generator.choice(SPECIAL_VALUES + [generator.getrandbits(32)]) for _ in range(31)]
+            yield words, registers, reference(words + assembler.exit_program()[:1], registers)
+
+    def run_engine(self, words, registers, translated):
+        memory = assembler.assemble(words + assembler.exit_program(), START)
+        cpu = Processor(system=System(memory))
+        cpu.pc = START
+        cpu.registers[:] = registers
+        if translated:
+            Translator(cpu).run()
+        else:
+            self.assertEqual(cpu.run().reason, STOP_EXIT)
+        self.assertTrue(cpu.system.terminate)
+        return cpu.registers
+
+    def check_engine(self, translated):
+        for words, registers, expected in self.programs():
+            result = self.run_engine(words, registers, translated)
+            for number, value in enumerate(result):
+                self.assertIs(type(value), int)
+                self.assertTrue(0 <= value <= MASK, f"x{number} = {value}")
+            self.assertEqual(result, expected, [hex(word) for word in words])
+
+    def test_interpreter(self):
+        self.check_engine(translated=False)
+
+    def test_translator(self):
+        self.check_engine(translated=True)
+
+    @unittest.skipIf(BatchMachine is None, "numpy is not installed")
+    def test_batch_machine(self):
+        for words, registers, expected in self.programs():
+            machine = BatchMachine(assembler.assemble(words + assembler.exit_program(), START), 1)
+            machine.registers[0, :] = registers
+            machine.run()
+            self.assertEqual(machine.state[0], LANE_EXITED, machine.fault_reason)
+            self.assertEqual([int(value) for value in machine.registers[0]], expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+import unittest
+
+import assembler
+from gdbstub import GDBStub
+from mmu import CAUSE_LOAD_PAGE_FAULT, PRIVILEGE_SUPERVISOR, SATP_MODE_SV32, PTE_V, PTE_R, PTE_W, PTE_X, PTE_A, PTE_D
+from processor import Processor, CSR_MCAUSE, CSR_MTVEC, CSR_SATP
+from system import System
+
+START = 0x80000000
+DATA = 0x80010000
+ROOT = 0x80100000  # The first level page table of the guests with paging
+ALIAS = 0xc0000000  # Mapped to the same megapage as START while paging is on
+
+
+def stub(words):
+    memory = assembler.assemble(list(words) + assembler.exit_program(), START)
+    cpu = Processor(system=System(memory))
+    cpu.pc = START
+    return GDBStub(cpu)
+
+
+def enable_paging(cpu):  # Maps START and ALIAS to the megapage of START, in supervisor mode
+    leaf = (START >> 12) << 10 | PTE_V | PTE_R | PTE_W | PTE_X | PTE_A | PTE_D
+    for address in (START, ALIAS):
+        cpu.system.memory.write_word(leaf, ROOT + (address >> 22) * 4)
+    cpu.csrs[CSR_SATP] = SATP_MODE_SV32 | ROOT >> 12
+    cpu.privilege = PRIVILEGE_SUPERVISOR
+    cpu.update_translation()
+
+
+def hex_word(value):
+    return value.to_bytes(4, "little").hex()
+
+
+class GDBStubTest(unittest.TestCase):
+    def test_registers(self):
+        gdb = stub([])
+        self.assertEqual(gdb.handle(b"P5=" + hex_word(42).encode()), "OK")
+        self.assertEqual(gdb.handle(b"p5"), hex_word(42))
+        self.assertEqual(gdb.handle(b"p20"), hex_word(START))
+        self.assertEqual(gdb.handle(b"g")[5 * 8:6 * 8], hex_word(42))
+
+    def test_memory_write_drops_the_decoded_instruction(self):
+        gdb = stub([assembler.addi(5, 0, 1)])
+        self.assertEqual(gdb.handle(b"s"), "S05")
+        gdb.cpu.pc = START
+
+        patched = hex_word(assembler.addi(5, 0, 7)).encode()
+        self.assertEqual(gdb.handle(b"M%x,4:" % START + patched), "OK")
+        self.assertEqual(gdb.handle(b"m%x,4" % START).encode(), patched)
+        self.assertEqual(gdb.handle(b"c"), "W00")
+        self.assertEqual(gdb.cpu.registers[5], 7)
+
+    def test_memory_access_is_translated(self):
+        gdb = stub([])
+        enable_paging(gdb.cpu)
+        self.assertEqual(gdb.handle(b"M%x,4:2a000000" % (ALIAS + DATA - START)), "OK")
+        self.assertEqual(gdb.cpu.system.memory.read_word(DATA), 42)
+        self.assertEqual(gdb.handle(b"m40000000,4"), "E14")
+
+    def test_breakpoint(self):
+        gdb = stub([assembler.addi(5, 0, 1), assembler.addi(6, 0, 2)])
+        self.assertEqual(gdb.handle(b"Z0,%x,4" % (START + 4)), "OK")
+        self.assertEqual(gdb.handle(b"c"), "S05")
+        self.assertEqual(gdb.cpu.pc, START + 4)
+        self.assertEqual(gdb.handle(b"c"), "W00")
+        self.assertEqual(gdb.cpu.registers[6], 2)
+
+    def test_store_next_to_a_breakpoint_keeps_it(self):
+        following = assembler.addi(7, 0, 2)
+        words = assembler.load_immediate(5, START + 24) + assembler.load_immediate(6, following)
+        words += [assembler.sw(6, 5, 0), assembler.addi(8, 0, 1), following]
+        gdb = stub(words)
+        memory = gdb.cpu.system.memory
+        memory.decode_cache[START + 24] = gdb.cpu.decode(following)  # The stored word was decoded already
+        self.assertEqual(gdb.handle(b"Z0,%x,4" % (START + 20)), "OK")
+
+        self.assertEqual(gdb.handle(b"c"), "S05")
+        self.assertEqual(gdb.cpu.pc, START + 20)
+        self.assertEqual(gdb.cpu.registers[8], 0)
+
+    def test_watchpoint_follows_the_paging_switch(self):
+        words = assembler.load_immediate(5, ALIAS + DATA - START) + [assembler.addi(6, 0, 9), assembler.sw(6, 5, 0)]
+        gdb = stub(words)
+        address = ALIAS + DATA - START
+        self.assertEqual(gdb.handle(b"Z2,%x,4" % address), "OK")
+        enable_paging(gdb.cpu)
+
+        self.assertEqual(gdb.handle(b"c"), f"T05watch:{address:x};")
+        self.assertEqual(gdb.cpu.system.memory.read_word(DATA), 9)
+
+    def test_step_delivers_a_trap_to_the_guest(self):
+        gdb = stub(assembler.load_immediate(5, 0x40000000) + [assembler.lw(6, 5, 0)])
+        gdb.cpu.csrs[CSR_MTVEC] = START + 0x100
+        enable_paging(gdb.cpu)
+        gdb.cpu.run(2)
+
+        self.assertEqual(gdb.handle(b"s"), "S05")
+        self.assertEqual(gdb.cpu.pc, START + 0x100)
+        self.assertEqual(gdb.cpu.csrs[CSR_MCAUSE], CAUSE_LOAD_PAGE_FAULT)
+
+
+if __name__ == "__main__":
+    unittest.main()
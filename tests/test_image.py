@@ -0,0 +1,51 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import image
+from image import ImageException
+
+SOURCE = os.path.join(os.path.dirname(__file__), "rv32ui-v-addi.mc")
+
+
+class ImageTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.source = os.path.join(directory.name, "addi.mc")
+        shutil.copy(SOURCE, self.source)
+        self.compiled = image.image_path(self.source)
+
+    def test_source_hash_reads_in_chunks(self):
+        with open(self.source, "rb") as file:
+            expected = hashlib.sha256(file.read()).digest()
+        with mock.patch.object(image, "HASH_CHUNK_SIZE", 1000):
+            self.assertEqual(image.source_hash(self.source), expected)
+
+    def test_load_compiles_and_reuses_the_image(self):
+        memory = image.load(self.source)
+        self.assertTrue(os.path.exists(self.compiled))
+
+        cached = image.read_image(self.compiled, image.source_hash(self.source))
+        self.assertEqual(sorted(cached.pages), sorted(memory.pages))
+        self.assertEqual(cached.start, memory.start)
+
+    def test_truncated_image_is_rebuilt(self):
+        memory = image.load(self.source)
+        size = os.path.getsize(self.compiled)
+        with open(self.compiled, "r+b") as file:
+            file.truncate(size - 1)
+        with self.assertRaises(ImageException):
+            image.read_image(self.compiled)
+
+        reloaded = image.load(self.source)
+        self.assertEqual(os.path.getsize(self.compiled), size)
+        for number, page in memory.pages.items():
+            self.assertEqual(bytes(reloaded.pages[number].data), bytes(page.data))
+
+
+if __name__ == "__main__":
+    unittest.main()
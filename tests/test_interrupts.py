@@ -0,0 +1,113 @@
+import io
+import unittest
+
+import assembler
+from clint import Clint, CLINT_BASE, CLINT_MSIP, CLINT_MTIMECMP, CLINT_MTIME
+from mmu import Trap, PRIVILEGE_USER, PRIVILEGE_MACHINE
+from processor import (Processor, STOP_EXIT, CSR_MTVEC, CSR_MIE, CSR_MIP, CSR_MSTATUS, CSR_MCAUSE, CSR_MEPC,
+                       MSTATUS_MIE, MSTATUS_MPIE, MSTATUS_MPP, MSTATUS_MPP_SHIFT, INTERRUPT_BIT, INTERRUPT_TIMER,
+                       INTERRUPT_SOFTWARE, MIP_MTIP, MIP_MSIP)
+from system import System
+
+START = 0x80000000
+HANDLER = 0x80001000  # Saves mcause and mepc in x22 and x23, then exits
+
+
+def machine(words, enabled=0):  # Returns a cpu and its CLINT, running the words with the interrupts of mie enabled
+    boot = assembler.load_immediate(7, HANDLER) + [assembler.csrw(CSR_MTVEC, 7)]
+    if enabled:
+        boot += [assembler.addi(7, 0, enabled), assembler.csrw(CSR_MIE, 7), assembler.addi(7, 0, MSTATUS_MIE),
+                 assembler.csrrs(0, CSR_MSTATUS, 7)]
+    memory = assembler.assemble(boot + list(words) + [assembler.addi(17, 0, 0)] + assembler.exit_program(), START)
+    handler = [assembler.csrr(22, CSR_MCAUSE), assembler.csrr(23, CSR_MEPC), assembler.addi(17, 0, 0)]
+    for index, word in enumerate(handler + assembler.exit_program()):
+        memory.write_word(word, HANDLER + 4 * index)
+    cpu = Processor(system=System(memory, [io.BytesIO(), io.BytesIO(), io.BytesIO()]))
+    cpu.pc = START
+    return cpu, Clint(cpu)
+
+
+def set_mtimecmp(value):  # The upper word first, so the register never holds a smaller time on the way
+    return assembler.load_immediate(5, CLINT_BASE + CLINT_MTIMECMP) + [assembler.sw(0, 5, 4)] + \
+        assembler.load_immediate(6, value) + [assembler.sw(6, 5, 0)]
+
+
+class InterruptTest(unittest.TestCase):
+    def test_timer_interrupt_is_taken_when_mtimecmp_is_reached(self):
+        cpu, _ = machine(set_mtimecmp(500) + [assembler.addi(21, 21, 1), assembler.jal(0, -4)], MIP_MTIP)
+        stop = cpu.run()
+
+        self.assertEqual(stop.reason, STOP_EXIT)
+        self.assertEqual(cpu.registers[22], INTERRUPT_BIT | INTERRUPT_TIMER)
+        self.assertEqual(cpu.scheduler.now, 500 + 5)  # The five instructions of the handler run from mtimecmp on
+
+    def test_mtime_reads_the_time_of_the_cpu(self):
+        words = assembler.load_immediate(5, CLINT_BASE + CLINT_MTIME) + [assembler.addi(0, 0, 0)] * 5
+        words += [assembler.lw(6, 5, 0)]
+        cpu, clint = machine(words)
+        cpu.run()
+        self.assertEqual(cpu.registers[6], 3 + 2 + 5)
+        self.assertEqual(clint.mtime(), cpu.scheduler.now)
+
+    def test_software_interrupt_is_taken_after_the_store(self):
+        words = assembler.load_immediate(5, CLINT_BASE + CLINT_MSIP) + [assembler.addi(6, 0, 1),
+                                                                        assembler.sw(6, 5, 0)]
+        cpu, _ = machine(words + [assembler.addi(21, 0, 1)], MIP_MSIP)
+        self.assertEqual(cpu.run().reason, STOP_EXIT)
+
+        self.assertEqual(cpu.registers[22], INTERRUPT_BIT | INTERRUPT_SOFTWARE)
+        self.assertEqual(cpu.registers[21], 0)
+        self.assertEqual(cpu.registers[23], START + 4 * (3 + 4 + 4))  # The instruction after the store
+
+    def test_pending_interrupts_wait_for_mie_and_mstatus(self):
+        cpu, _ = machine([])
+        cpu.csrs[CSR_MTVEC] = HANDLER
+        cpu.csrs[CSR_MIP] |= MIP_MTIP
+        cpu.take_interrupt()
+        self.assertEqual(cpu.pc, START)  # Not enabled in mie
+
+        cpu.csrs[CSR_MIE] = MIP_MTIP
+        cpu.take_interrupt()
+        self.assertEqual(cpu.pc, START)  # Machine mode with MIE clear
+
+        cpu.privilege = PRIVILEGE_USER  # The machine interrupts are always enabled in the lower modes
+        cpu.take_interrupt()
+        self.assertEqual(cpu.pc, HANDLER)
+        self.assertEqual(cpu.privilege, PRIVILEGE_MACHINE)
+        self.assertEqual(cpu.csrs[CSR_MCAUSE], INTERRUPT_BIT | INTERRUPT_TIMER)
+
+    def test_vectored_mtvec(self):
+        cpu, _ = machine([])
+        cpu.csrs[CSR_MTVEC] = HANDLER | 1
+        cpu.csrs[CSR_MIE] = cpu.csrs[CSR_MIP] = MIP_MTIP
+        cpu.csrs[CSR_MSTATUS] |= MSTATUS_MIE
+        cpu.take_interrupt()
+        self.assertEqual(cpu.pc, HANDLER + 4 * INTERRUPT_TIMER)
+
+        cpu.pc = START
+        self.assertTrue(cpu.enter_trap(Trap(2)))  # The exceptions go to the base
+        self.assertEqual(cpu.pc, HANDLER)
+
+    def test_mret_returns_to_the_previous_mode(self):
+        cpu, _ = machine([])
+        cpu.csrs[CSR_MEPC] = START + 0x100
+        cpu.csrs[CSR_MSTATUS] = PRIVILEGE_USER << MSTATUS_MPP_SHIFT | MSTATUS_MPIE
+        cpu.execute_mret(cpu.decode(assembler.mret()))
+
+        self.assertEqual(cpu.pc, START + 0x100)
+        self.assertEqual(cpu.privilege, PRIVILEGE_USER)
+        status = cpu.csrs[CSR_MSTATUS]
+        self.assertEqual(status & (MSTATUS_MIE | MSTATUS_MPIE | MSTATUS_MPP), MSTATUS_MIE | MSTATUS_MPIE)
+
+    def test_wfi_skips_to_the_next_event(self):
+        cpu, _ = machine(set_mtimecmp(100000) + [assembler.wfi(), assembler.jal(0, -4)], MIP_MTIP)
+        stop = cpu.run()
+
+        self.assertEqual(stop.reason, STOP_EXIT)
+        self.assertEqual(cpu.registers[22], INTERRUPT_BIT | INTERRUPT_TIMER)
+        self.assertLess(stop.executed, 50)
+        self.assertGreaterEqual(cpu.scheduler.now, 100000)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+import os
+import struct
+import tempfile
+import unittest
+from unittest import mock
+
+import elf
+import parser
+from elf import ElfException, ELF_MAGIC, ELFCLASS32, ELFDATA2LSB, EM_RISCV, PT_LOAD
+
+START = 0x80000000
+PHYSICAL = 0x10000000  # The physical address of the segments, the loader ignores it
+SEGMENT_OFFSET = 0x1000
+
+
+def elf_file(segments, entry=START):  # Returns an executable of (address, data, memory size) segments
+    ident = ELF_MAGIC + bytes([ELFCLASS32, ELFDATA2LSB, 1]) + bytes(9)
+    header = elf.header_format.pack(ident, 2, EM_RISCV, 1, entry, elf.header_format.size, 0, 0,
+                                    elf.header_format.size, elf.program_header_format.size, len(segments))
+    headers, contents = b"", b""
+    for address, data, memory_size in segments:
+        headers += elf.program_header_format.pack(PT_LOAD, SEGMENT_OFFSET + len(contents), address,
+                                                  PHYSICAL + len(contents), len(data), memory_size, 7, 4)
+        contents += data
+    prefix = header + headers
+    return prefix + bytes(SEGMENT_OFFSET - len(prefix)) + contents
+
+
+class LoaderTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def write(self, name, data):
+        path = os.path.join(self.directory, name)
+        with open(path, "wb" if isinstance(data, bytes) else "w") as file:
+            file.write(data)
+        return path
+
+    def test_elf_segments_go_to_their_virtual_addresses(self):
+        code = struct.pack("<2I", 0x00100513, 0x00000073)
+        path = self.write("program.elf", elf_file([(START, code, len(code)), (START + 0x2000, b"\xff" * 16, 16),
+                                                   (START + 0x2004, b"\x2a", 0x2000)], entry=START + 4))
+        self.assertTrue(elf.is_elf(path))
+
+        memory = elf.load(path)
+        self.assertEqual(memory.start, START + 4)
+        self.assertEqual(memory.read_word(START), 0x00100513)
+        self.assertEqual(memory.read_word(START + 0x2000), 0xffffffff)
+        self.assertEqual(memory.read_word(START + 0x2004), 0x2a)  # The rest is zeroed over the earlier segment
+        self.assertEqual(memory.read_word(START + 0x2008), 0)
+        self.assertIn((START + 0x3fff) >> 12, memory.pages)  # The zeroed part belongs to the program
+        self.assertNotIn(PHYSICAL >> 12, memory.pages)
+
+    def test_truncated_elf_files_are_rejected(self):
+        data = elf_file([(START, b"\x13\x00\x00\x00" * 8, 32)])
+        for name, truncated in (("empty", b""), ("header", data[:20]), ("program headers", data[:60]),
+                                ("segment", data[:-1])):
+            with self.subTest(name):
+                with self.assertRaises(ElfException):
+                    elf.load(self.write(name.replace(" ", "-") + ".elf", truncated))
+
+    def test_not_a_riscv_executable(self):
+        data = bytearray(elf_file([]))
+        data[18] = 62  # x86-64
+        with self.assertRaises(ElfException):
+            elf.load(self.write("amd64.elf", bytes(data)))
+
+    def test_dump_sections_in_any_order(self):
+        dump = ("Disassembly of section .data:\n"
+                "80002000 <data>:\n"
+                "80002000:\t0000002a\n"
+                "80002004:\t0007\n"
+                "\n"
+                "Disassembly of section .text:\n"
+                "80000000 <_start>:\n"
+                "80000000:\t00100513\n"
+                "80000004:\t00000073\n")
+        path = self.write("program.mc", dump)
+        with mock.patch.object(parser, "CHUNK_SIZE", 4):  # Every word is a chunk of its own
+            memory = parser.parse(path)
+
+        self.assertEqual(memory.start, 0x80002000)  # The first entry
+        self.assertEqual(memory.read_word(START), 0x00100513)
+        self.assertEqual(memory.read_word(START + 4), 0x00000073)
+        self.assertEqual(memory.read_word(0x80002000), 0x2a)
+        self.assertEqual(memory.read_halfword(0x80002004), 7)
+        self.assertEqual(list(memory.symbols), [(START, "_start"), (0x80002000, "data")])
+        self.assertEqual(memory.symbols.lookup(START + 4), "_start")
+
+    def test_dump_without_a_program(self):
+        with self.assertRaises(ValueError):
+            parser.parse(self.write("empty.mc", "Disassembly of section .text:\n"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+
+from memory import Memory, ZERO_PAGE, PAGE_BITS, PAGE_SIZE
+
+BASE = 0x80000000
+BOUNDARY = BASE + PAGE_SIZE  # The start of the second page
+
+
+class SparseMemoryTest(unittest.TestCase):
+    def test_reads_do_not_allocate(self):
+        memory = Memory()
+        self.assertEqual(memory.read_word(0xfffffffc), 0)
+        self.assertEqual(memory.read_halfword(0x12345676), 0)
+        self.assertEqual(memory.read_byte(BASE), 0)
+        self.assertEqual(memory.read_bytes(BASE - 2, PAGE_SIZE + 4), bytes(PAGE_SIZE + 4))
+        self.assertEqual(memory.pages, {})
+        self.assertIs(memory.read_page, ZERO_PAGE)
+
+    def test_write_allocates_its_page_only(self):
+        memory = Memory()
+        memory.write_byte(0xab, 0xfffff123)
+        memory.write_word(0x12345678, BASE + 8)
+        self.assertEqual(sorted(memory.pages), [BASE >> PAGE_BITS, 0xfffff])
+        self.assertEqual(memory.read_byte(0xfffff123), 0xab)
+        self.assertEqual(memory.read_word(BASE + 8), 0x12345678)
+
+    def test_read_after_write_sees_the_allocated_page(self):
+        memory = Memory()
+        self.assertEqual(memory.read_word(BASE), 0)  # Caches the zero page for reading
+        memory.write_word(7, BASE)
+        self.assertEqual(memory.read_word(BASE), 7)
+
+
+class MisalignedAccessTest(unittest.TestCase):
+    def test_word_across_two_pages(self):
+        memory = Memory()
+        for offset in (1, 2, 3):
+            memory.write_word(0x44332211, BOUNDARY - offset)
+            self.assertEqual(memory.read_word(BOUNDARY - offset), 0x44332211)
+            self.assertEqual(memory.read_byte(BOUNDARY - offset), 0x11)
+            self.assertEqual(memory.read_byte(BOUNDARY + 3 - offset), 0x44)
+        self.assertEqual(sorted(memory.pages), [BASE >> PAGE_BITS, BOUNDARY >> PAGE_BITS])
+
+    def test_halfword_across_two_pages(self):
+        memory = Memory()
+        memory.write_halfword(0xbbaa, BOUNDARY - 1)
+        self.assertEqual(memory.read_halfword(BOUNDARY - 1), 0xbbaa)
+        self.assertEqual((memory.read_byte(BOUNDARY - 1), memory.read_byte(BOUNDARY)), (0xaa, 0xbb))
+
+    def test_misaligned_inside_a_page(self):
+        memory = Memory()
+        memory.write_word(0x44332211, BASE + 5)
+        self.assertEqual(memory.read_word(BASE + 4), 0x33221100)
+        self.assertEqual(memory.read_word(BASE + 5), 0x44332211)
+        self.assertEqual(memory.read_halfword(BASE + 7), 0x4433)
+
+    def test_read_across_into_a_page_never_written(self):
+        memory = Memory()
+        memory.write_word(0xffffffff, BOUNDARY - 4)
+        self.assertEqual(memory.read_word(BOUNDARY - 2), 0xffff)
+        self.assertNotIn(BOUNDARY >> PAGE_BITS, memory.pages)
+
+    def test_store_across_two_pages_drops_the_decoded_instructions(self):
+        memory = Memory()
+        memory.decode_cache[BOUNDARY - 4] = "first"
+        memory.decode_cache[BOUNDARY] = "second"
+        memory.decode_cache[BOUNDARY + 4] = "third"
+        memory.write_word(0, BOUNDARY - 2)
+        self.assertEqual(memory.decode_cache, {BOUNDARY + 4: "third"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,186 @@
+import threading
+import unittest
+
+import assembler
+from memory import Memory
+from mmu import (VirtualMemory, PageFault, PRIVILEGE_USER, PRIVILEGE_SUPERVISOR, PRIVILEGE_MACHINE, SATP_MODE_SV32,
+                 PTE_V, PTE_R, PTE_W, PTE_X, PTE_U, PTE_A, PTE_D, MSTATUS_SUM, MSTATUS_MXR, CAUSE_FETCH_PAGE_FAULT,
+                 CAUSE_LOAD_PAGE_FAULT, CAUSE_STORE_PAGE_FAULT)
+from processor import (Processor, STOP_EXIT, CSR_SATP, CSR_MSTATUS, CSR_MEDELEG, CSR_STVEC, CSR_SEPC, CSR_SCAUSE,
+                       CSR_STVAL, CSR_MCAUSE)
+from smp import LockedMemory
+from system import System
+
+START = 0x80000000
+ROOT = 0x80100000  # The first level page table
+TABLE = 0x80101000  # The second level page table of the virtual addresses from VIRTUAL
+VIRTUAL = 0x00400000
+DATA = 0x80200000  # The physical pages mapped by the tests, one after the other
+MEGAPAGE = 0x00800000  # Mapped by a first level leaf to the 4 MiB from SUPERPAGE
+SUPERPAGE = 0x80400000
+
+
+def map_page(memory, virtual, physical, flags, table=TABLE):  # Maps a 4 KiB page through the second level table
+    memory.write_word((table >> 12) << 10 | PTE_V, ROOT + (virtual >> 22) * 4)
+    memory.write_word((physical >> 12) << 10 | flags | PTE_V, table + ((virtual >> 12) & 0x3ff) * 4)
+
+
+def entry_address(virtual, table=TABLE):
+    return table + ((virtual >> 12) & 0x3ff) * 4
+
+
+def machine(memory=None, words=()):
+    memory = memory or assembler.assemble(list(words) + assembler.exit_program(), START)
+    cpu = Processor(system=System(memory))
+    cpu.pc = START
+    return cpu
+
+
+def enable_paging(cpu, privilege):
+    cpu.privilege = privilege
+    cpu.write_csr(CSR_SATP, SATP_MODE_SV32 | ROOT >> 12)
+
+
+def execute(cpu, word):  # Executes a single instruction, wherever the pc is
+    decoded = cpu.decode(word)
+    decoded.execute(cpu, decoded)
+
+
+class MMUTest(unittest.TestCase):
+    def test_two_level_walk(self):
+        cpu = machine()
+        memory = cpu.system.memory
+        map_page(memory, VIRTUAL, DATA, PTE_R)
+        map_page(memory, VIRTUAL + 0x1000, DATA + 0x1000, PTE_R)
+        memory.write_word(0x11111111, DATA + 8)
+        memory.write_word(0x22222222, DATA + 0x1008)
+        memory.write_word(SUPERPAGE >> 12 << 10 | PTE_R | PTE_V, ROOT + (MEGAPAGE >> 22) * 4)
+        memory.write_word(0x33333333, SUPERPAGE + 0x3004)
+        enable_paging(cpu, PRIVILEGE_SUPERVISOR)
+
+        self.assertIsInstance(memory, VirtualMemory)
+        self.assertEqual(memory.read_word(VIRTUAL + 8), 0x11111111)
+        self.assertEqual(memory.read_word(VIRTUAL + 0x1008), 0x22222222)
+        self.assertEqual(memory.read_word(MEGAPAGE + 0x3004), 0x33333333)
+        with self.assertRaises(PageFault) as context:
+            memory.read_word(VIRTUAL + 0x2000)  # No second level entry
+        self.assertEqual((context.exception.cause, context.exception.value), (CAUSE_LOAD_PAGE_FAULT, VIRTUAL + 0x2000))
+        with self.assertRaises(PageFault):
+            memory.read_word(0x00c00000)  # No first level entry
+
+        cpu.privilege = PRIVILEGE_MACHINE
+        cpu.update_translation()
+        self.assertIs(type(memory), Memory)
+        self.assertEqual(memory.read_word(DATA + 8), 0x11111111)
+
+    def test_permission_faults(self):
+        cpu = machine()
+        memory = cpu.system.memory
+        map_page(memory, VIRTUAL, DATA, PTE_R)
+        map_page(memory, VIRTUAL + 0x1000, DATA + 0x1000, PTE_X)
+        map_page(memory, VIRTUAL + 0x2000, DATA + 0x2000, PTE_R | PTE_W | PTE_U)
+        enable_paging(cpu, PRIVILEGE_SUPERVISOR)
+
+        memory.read_word(VIRTUAL)
+        with self.assertRaises(PageFault) as context:
+            memory.write_word(1, VIRTUAL)
+        self.assertEqual(context.exception.cause, CAUSE_STORE_PAGE_FAULT)
+        with self.assertRaises(PageFault) as context:
+            memory.fetch_word(VIRTUAL)
+        self.assertEqual(context.exception.cause, CAUSE_FETCH_PAGE_FAULT)
+        memory.fetch_word(VIRTUAL + 0x1000)
+        with self.assertRaises(PageFault) as context:
+            memory.read_word(VIRTUAL + 0x1000)
+        self.assertEqual(context.exception.cause, CAUSE_LOAD_PAGE_FAULT)
+        with self.assertRaises(PageFault):
+            memory.read_word(VIRTUAL + 0x2000)  # A user page without SUM
+
+        cpu.write_csr(CSR_MSTATUS, cpu.csrs[CSR_MSTATUS] | MSTATUS_SUM | MSTATUS_MXR)
+        memory.read_word(VIRTUAL + 0x1000)
+        memory.write_word(1, VIRTUAL + 0x2000)
+        with self.assertRaises(PageFault):
+            memory.fetch_word(VIRTUAL + 0x2000)  # Supervisor mode never executes the user pages
+
+        enable_paging(cpu, PRIVILEGE_USER)
+        memory.write_word(2, VIRTUAL + 0x2000)
+        with self.assertRaises(PageFault):
+            memory.read_word(VIRTUAL)
+
+    def test_accessed_and_dirty_bits(self):
+        cpu = machine()
+        memory = cpu.system.memory
+        map_page(memory, VIRTUAL, DATA, PTE_R | PTE_W)
+        enable_paging(cpu, PRIVILEGE_SUPERVISOR)
+        physical = Memory.read_word.__get__(memory)
+
+        memory.read_word(VIRTUAL)
+        self.assertEqual(physical(entry_address(VIRTUAL)) & (PTE_A | PTE_D), PTE_A)
+        memory.write_word(5, VIRTUAL + 4)
+        self.assertEqual(physical(entry_address(VIRTUAL)) & (PTE_A | PTE_D), PTE_A | PTE_D)
+        self.assertEqual(physical(DATA + 4), 5)
+
+    def test_page_fault_delegated_to_supervisor_mode(self):
+        handler = START + 0x1000
+        cpu = machine(words=[assembler.lw(5, 6, 0)])
+        memory = cpu.system.memory
+        for index, word in enumerate(assembler.exit_program()):
+            memory.write_word(word, handler + 4 * index)
+        table = TABLE + 0x1000
+        map_page(memory, START, START, PTE_R | PTE_X | PTE_U, table)
+        map_page(memory, handler, handler, PTE_R | PTE_X, table)
+        cpu.csrs[CSR_MEDELEG] = 1 << CAUSE_LOAD_PAGE_FAULT
+        cpu.csrs[CSR_STVEC] = handler
+        cpu.registers[6] = VIRTUAL  # Not mapped
+        enable_paging(cpu, PRIVILEGE_USER)
+
+        self.assertEqual(cpu.run().reason, STOP_EXIT)
+        self.assertEqual(cpu.csrs[CSR_SCAUSE], CAUSE_LOAD_PAGE_FAULT)
+        self.assertEqual(cpu.csrs[CSR_STVAL], VIRTUAL)
+        self.assertEqual(cpu.csrs[CSR_SEPC], START)
+        self.assertEqual(cpu.csrs[CSR_MCAUSE], 0)
+        self.assertEqual(cpu.privilege, PRIVILEGE_SUPERVISOR)
+
+    def test_satp_write_and_sfence_vma_flush_the_tlb(self):
+        cpu = machine()
+        memory = cpu.system.memory
+        map_page(memory, VIRTUAL, DATA, PTE_R)
+        memory.write_word(1, DATA)
+        memory.write_word(2, DATA + 0x1000)
+        memory.write_word(3, DATA + 0x2000)
+        enable_paging(cpu, PRIVILEGE_SUPERVISOR)
+        remap = Memory.write_word.__get__(memory)
+
+        self.assertEqual(memory.read_word(VIRTUAL), 1)
+        remap((DATA + 0x1000) >> 12 << 10 | PTE_R | PTE_V, entry_address(VIRTUAL))
+        self.assertEqual(memory.read_word(VIRTUAL), 1)  # The translation is still in the TLB
+        cpu.write_csr(CSR_SATP, cpu.csrs[CSR_SATP])
+        self.assertEqual(memory.read_word(VIRTUAL), 2)
+
+        remap((DATA + 0x2000) >> 12 << 10 | PTE_R | PTE_V, entry_address(VIRTUAL))
+        self.assertEqual(memory.read_word(VIRTUAL), 2)
+        execute(cpu, assembler.sfence_vma())
+        self.assertEqual(memory.read_word(VIRTUAL), 3)
+
+    def test_paging_keeps_the_class_of_the_memory(self):
+        generations = [0, 0]
+        memory = LockedMemory(START, [threading.RLock(), threading.RLock()], generations)
+        for index, word in enumerate(assembler.exit_program()):
+            memory.write_word(word, START + 4 * index)
+        map_page(memory, VIRTUAL, DATA, PTE_R | PTE_W)
+        cpu = machine(memory)
+        enable_paging(cpu, PRIVILEGE_SUPERVISOR)
+
+        self.assertIsInstance(memory, LockedMemory)
+        memory.read_word(VIRTUAL)  # Sets the accessed bit
+        before = list(generations)
+        memory.write_word(7, VIRTUAL + 4)  # The physical address is in the second stripe, the entry in the first
+        self.assertEqual(generations, [before[0] + 1, before[1] + 1])
+
+        cpu.privilege = PRIVILEGE_MACHINE
+        cpu.update_translation()
+        self.assertIs(type(memory), LockedMemory)
+        self.assertEqual(memory.read_word(DATA + 4), 7)
+
+
+if __name__ == "__main__":
+    unittest.main()
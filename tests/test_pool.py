@@ -0,0 +1,66 @@
+import io
+import unittest
+
+import assembler
+from pool import MachinePool
+from processor import STOP_EXIT
+from system import SYSCALL_WRITE
+
+START = 0x80000000
+DATA = 0x80010000  # A counter incremented by every run, then the bytes the runs write to stdout
+MESSAGE = b"run\n"
+
+
+def counting_image():  # Increments the counter, keeps it in x6, writes the message and exits
+    words = assembler.load_immediate(5, DATA) + [assembler.lw(6, 5, 0), assembler.addi(6, 6, 1),
+                                                  assembler.sw(6, 5, 0)]
+    words += [assembler.addi(17, 0, SYSCALL_WRITE), assembler.addi(10, 0, 1), assembler.addi(11, 5, 4),
+              assembler.addi(12, 0, len(MESSAGE)), assembler.ecall(), assembler.addi(17, 0, 0)]
+    memory = assembler.assemble(words + assembler.exit_program(), START)
+    memory.write_bytes(DATA + 4, MESSAGE)
+    return memory
+
+
+class MachinePoolTest(unittest.TestCase):
+    def setUp(self):
+        self.output = io.BytesIO()
+        self.streams = [io.BytesIO(), self.output, io.BytesIO()]
+        self.pool = MachinePool(counting_image(), 1, streams=self.streams)
+
+    def test_runs_start_from_the_pristine_image(self):
+        for _ in range(3):
+            machine = self.pool.acquire()
+            self.assertEqual(machine.run().reason, STOP_EXIT)
+            self.assertEqual(machine.memory.read_word(DATA), 1)
+            self.assertEqual(machine.cpu.registers[6], 1)
+            self.pool.release(machine)
+
+            self.assertEqual(machine.memory.read_word(DATA), 0)
+            self.assertEqual(machine.cpu.registers[6], 0)
+            self.assertEqual(machine.cpu.pc, START)
+            self.assertFalse(machine.system.terminate)
+        self.assertEqual(self.pool.stats()["runs"], 3)
+
+    def test_reset_reuses_the_streams_and_closes_the_guest_files(self):
+        opened = io.BytesIO()
+        machine = self.pool.acquire()
+        machine.system.files[3] = opened
+        machine.run()
+        self.pool.release(machine)
+        self.assertTrue(opened.closed)
+        self.assertEqual(machine.system.files, dict(enumerate(self.streams)))
+
+        self.pool.run()
+        self.assertEqual(self.output.getvalue(), MESSAGE * 2)
+
+    def test_host_streams_are_opened_once(self):
+        pool = MachinePool(counting_image(), 1)
+        machine = pool.acquire()
+        streams = dict(machine.system.files)
+        pool.release(machine)
+        for descriptor, stream in streams.items():
+            self.assertIs(machine.system.files[descriptor], stream)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,211 @@
+import unittest
+
+import assembler
+from memory import PAGE_SIZE
+from processor import (Processor, FusedInstruction, StopReason, execution_table, dispatch_key, STOP_EXIT, STOP_BUDGET,
+                       STOP_BREAKPOINT, STOP_FAULT, OP_OP, OP_STORE, STORE_FUNCT3_SH)
+from system import System
+from translator import Translator
+
+START = 0x80000000
+
+
+def machine(words=()):
+    memory = assembler.assemble(list(words) + assembler.exit_program(), START)
+    cpu = Processor(system=System(memory))
+    cpu.pc = START
+    return cpu
+
+
+def run(cpu, translated):
+    if translated:
+        Translator(cpu).run()
+    else:
+        stop = cpu.run()
+        if stop.reason != STOP_EXIT:
+            raise AssertionError(stop)
+
+
+# Runs the instruction at index 4 twice, storing the given word with the given store in between
+def self_modifying(store, value, offset=0):
+    words = assembler.load_immediate(5, value) + assembler.load_immediate(7, START + 16 + offset)
+    words += [assembler.addi(6, 6, 1),  # Index 4, patched
+              assembler.bne(8, 0, 16),
+              assembler.addi(8, 0, 1),
+              store(5, 7, 0),
+              assembler.jal(0, -16)]
+    return machine(words)
+
+
+class DispatchTest(unittest.TestCase):
+    def test_every_key_of_the_table_decodes_to_its_handler(self):
+        cpu = Processor(system=System())
+        for key, execute in execution_table.items():
+            word = (key & 0x7f) | ((key >> 7) & 7) << 12 | (key >> 10) << 25 | 1 << 7 | 2 << 15 | 3 << 20
+            self.assertIs(cpu.decode(word).execute, execute, hex(word))
+
+    def test_instructions_reach_their_handlers(self):
+        cpu = Processor(system=System())
+        handlers = {
+            assembler.add(1, 2, 3): Processor.execute_add,
+            assembler.sub(1, 2, 3): Processor.execute_sub,
+            assembler.mul(1, 2, 3): Processor.execute_mul,
+            assembler.rem(1, 2, 3): Processor.execute_rem,
+            assembler.slli(1, 2, 3): Processor.execute_slli,
+            assembler.lw(1, 2, -4): Processor.execute_lw,
+            assembler.sw(1, 2, 8): Processor.execute_sw,
+            assembler.ecall(): Processor.execute_system,
+            assembler.mret(): Processor.execute_mret,
+            assembler.sret(): Processor.execute_sret,
+            assembler.wfi(): Processor.execute_sret,  # Told apart by funct12 in the handler
+            assembler.sfence_vma(): Processor.execute_sfence_vma,
+            assembler.csrrw(1, 0x340, 2): Processor.execute_csrrw,
+            assembler.lr_w(1, 2) | 3 << 25: Processor.execute_lr_w,  # With the aq and rl bits
+            assembler.amoadd_w(1, 2, 3): Processor.execute_amoadd_w,
+            assembler.fence(): Processor.execute_fence,
+            assembler.fence_i(): Processor.execute_fence_i,
+            0: Processor.execute_empty,
+        }
+        for word, execute in handlers.items():
+            self.assertIs(cpu.decode(word).execute, execute, hex(word))
+
+    def test_unknown_operations_fail_when_executed(self):
+        cpu = machine()
+        decoded = cpu.decode(assembler.r_type(OP_OP, 0, 0b0000010, 1, 2, 3))
+        self.assertNotIn(dispatch_key(OP_OP, 0, 0b0000010), execution_table)
+        with self.assertRaises(NotImplementedError):
+            decoded.execute(cpu, decoded)
+        with self.assertRaises(NotImplementedError):
+            cpu.decode(0x7f)  # No decoder for the opcode
+
+
+class SelfModifyingCodeTest(unittest.TestCase):
+    def check(self, store, value, offset, expected):
+        for translated in (False, True):
+            cpu = self_modifying(store, value, offset)
+            run(cpu, translated)
+            self.assertEqual(cpu.registers[6], expected, "translated" if translated else "interpreted")
+
+    def test_word_store_over_a_decoded_instruction(self):
+        self.check(assembler.sw, assembler.addi(6, 6, 10), 0, 1 + 10)
+
+    def test_byte_store_into_a_decoded_instruction(self):
+        self.check(assembler.sb, assembler.addi(6, 6, 0x10) >> 24, 3, 1 + 0x11)  # The upper bits of the immediate
+
+    def test_misaligned_store_over_two_decoded_instructions(self):
+        store = lambda rs2, rs1, imm: assembler.s_type(OP_STORE, STORE_FUNCT3_SH, rs1, rs2, imm)
+        value = assembler.addi(6, 6, 0x10) >> 24 | (assembler.bne(8, 0, 16) & 0xff) << 8  # The BNE is unchanged
+        self.check(store, value, 3, 1 + 0x11)
+
+    def test_store_drops_the_pair_of_the_instruction(self):
+        cpu = machine([assembler.lui(5, 0x12345), assembler.addi(5, 5, 0x678)])
+        cpu.run(2)
+        memory = cpu.system.memory
+        self.assertIs(type(memory.decode_cache[START]), FusedInstruction)
+        memory.write_word(assembler.addi(5, 5, 1), START + 4)
+        self.assertNotIn(START, memory.decode_cache)
+        self.assertNotIn(START + 4, memory.decode_cache)
+
+        cpu.pc = START
+        cpu.run()
+        self.assertEqual(cpu.registers[5], 0x12345001)
+
+
+class FusionTest(unittest.TestCase):
+    def test_jump_into_the_middle_of_a_pair(self):
+        words = [assembler.lui(5, 0x12345), assembler.addi(5, 5, 0x678),  # A fused pair
+                 assembler.bne(6, 0, 12), assembler.addi(6, 0, 1), assembler.jal(0, -12)]
+        cpu = machine(words)
+        stop = cpu.run()
+
+        self.assertEqual(stop.reason, STOP_EXIT)
+        self.assertEqual(cpu.registers[5], 0x12345678 + 0x678)  # The second run starts at the ADDI
+        decode_cache = cpu.system.memory.decode_cache
+        self.assertIs(type(decode_cache[START]), FusedInstruction)
+        self.assertIs(decode_cache[START + 4].execute, Processor.execute_addi)
+        self.assertEqual(stop.executed, 5 + 2 + len(assembler.exit_program()))
+
+    def test_breakpoint_on_the_second_instruction_splits_the_pair(self):
+        cpu = machine([assembler.lui(5, 0x12345), assembler.addi(5, 5, 0x678)])
+        cpu.run(2)
+        cpu.pc = START
+        stop = cpu.run(breakpoints={START + 4})
+        self.assertEqual((stop.reason, stop.pc, stop.executed), (STOP_BREAKPOINT, START + 4, 1))
+        self.assertEqual(cpu.registers[5], 0x12345000)
+
+    def test_no_pair_across_pages(self):
+        memory = assembler.assemble([], START)
+        for index, word in enumerate([assembler.lui(5, 1), assembler.addi(5, 5, 1)] + assembler.exit_program()):
+            memory.write_word(word, START + PAGE_SIZE - 4 + 4 * index)
+        cpu = Processor(system=System(memory))
+        cpu.pc = START + PAGE_SIZE - 4
+        self.assertEqual(cpu.run().reason, STOP_EXIT)
+        self.assertEqual(cpu.registers[5], 0x1001)
+        self.assertIsNot(type(memory.decode_cache[START + PAGE_SIZE - 4]), FusedInstruction)
+
+
+class StopReasonTest(unittest.TestCase):
+    def test_exit(self):
+        cpu = machine([assembler.addi(5, 0, 1)])
+        stop = cpu.run()
+        self.assertEqual((stop.reason, stop.pc, stop.executed, stop.error), (STOP_EXIT, START + 12, 3, None))
+        self.assertEqual(cpu.run().executed, 0)  # The guest already exited
+
+    def test_budget(self):
+        cpu = machine([assembler.jal(0, 0)])
+        stop = cpu.run(100)
+        self.assertEqual((stop.reason, stop.pc, stop.executed), (STOP_BUDGET, START, 100))
+
+    def test_breakpoint_is_not_reported_on_the_first_instruction(self):
+        cpu = machine([assembler.addi(5, 0, 1), assembler.addi(6, 0, 2)])
+        stop = cpu.run(breakpoints={START, START + 4})
+        self.assertEqual((stop.reason, stop.pc, stop.executed), (STOP_BREAKPOINT, START + 4, 1))
+        stop = cpu.run(breakpoints={START + 4})
+        self.assertEqual(stop.reason, STOP_EXIT)
+
+    def test_fault_points_at_the_faulting_instruction(self):
+        cpu = machine([assembler.addi(5, 0, 1), assembler.r_type(OP_OP, 0, 0b0000010, 1, 2, 3)])
+        stop = cpu.run()
+        self.assertEqual((stop.reason, stop.pc, stop.executed), (STOP_FAULT, START + 4, 1))
+        self.assertIsInstance(stop.error, NotImplementedError)
+        self.assertIn("error=NotImplementedError", repr(stop))
+        self.assertEqual(repr(StopReason(STOP_BUDGET, START, 5)), f"StopReason(budget, pc={hex(START)}, executed=5)")
+
+
+class ZeroRunTest(unittest.TestCase):
+    def program(self):  # Code, a run of zero words up to the next page and over two pages never written, then code
+        memory = assembler.assemble([assembler.addi(5, 0, 1)], START)
+        for index, word in enumerate([assembler.addi(6, 0, 2)] + assembler.exit_program()):
+            memory.write_word(word, START + 3 * PAGE_SIZE + 8 + 4 * index)
+        cpu = Processor(system=System(memory))
+        cpu.pc = START
+        return cpu
+
+    def test_zero_words_are_skipped_in_one_step(self):
+        for translated in (False, True):
+            cpu = self.program()
+            run(cpu, translated)
+            self.assertEqual((cpu.registers[5], cpu.registers[6]), (1, 2))
+        self.assertEqual(cpu.system.memory.zero_runs, {START + 4: START + 3 * PAGE_SIZE + 8})
+        self.assertEqual(sorted(cpu.system.memory.pages), [START >> 12, (START >> 12) + 3])
+
+        cpu = self.program()
+        self.assertEqual(cpu.run().executed, 1 + 1 + 1 + len(assembler.exit_program()))
+
+    def test_write_into_a_run_drops_it(self):
+        for translated in (False, True):
+            cpu = self.program()
+            run(cpu, translated)
+            memory = cpu.system.memory
+            memory.write_word(assembler.addi(7, 0, 3), START + PAGE_SIZE + 4)  # In a page that was never written
+            self.assertEqual(memory.zero_runs, {})
+
+            cpu.pc = START
+            cpu.system.terminate = False
+            cpu.registers[7] = 0
+            run(cpu, translated)
+            self.assertEqual(cpu.registers[7], 3, "translated" if translated else "interpreted")
+
+
+if __name__ == "__main__":
+    unittest.main()
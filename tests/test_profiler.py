@@ -0,0 +1,72 @@
+import unittest
+from unittest import mock
+
+import assembler
+import profiler
+from processor import Processor, STOP_EXIT
+from profiler import Profiler
+from system import System
+
+START = 0x80000000
+OUTER = START + 0x100  # Calls INNER, saving ra in x8
+INNER = START + 0x200  # Counts x5 down, then returns
+LOOPS = 500
+
+
+def machine():
+    memory = assembler.assemble([assembler.jal(1, OUTER - START), assembler.addi(17, 0, 0)] +
+                                assembler.exit_program(), START)
+    outer = [assembler.addi(8, 1, 0), assembler.jal(1, INNER - OUTER - 4), assembler.addi(1, 8, 0),
+             assembler.jalr(0, 1, 0)]
+    inner = [assembler.addi(5, 0, LOOPS), assembler.addi(5, 5, -1), assembler.bne(5, 0, -4), assembler.jalr(0, 1, 0)]
+    for address, words in ((OUTER, outer), (INNER, inner)):
+        for index, word in enumerate(words):
+            memory.write_word(word, address + 4 * index)
+    cpu = Processor(system=System(memory))
+    cpu.pc = START
+    return cpu
+
+
+class ProfilerTest(unittest.TestCase):
+    def test_samples_hold_the_call_stack(self):
+        cpu = machine()
+        sampler = Profiler(cpu, period=10)
+        sampler.start()
+        self.assertEqual(cpu.run().reason, STOP_EXIT)
+        sampler.stop()
+
+        self.assertEqual(sampler.stack, [])  # Every call returned
+        inner = {stack: count for stack, count in sampler.samples.items() if INNER <= stack[-1] < INNER + 16}
+        self.assertGreater(sum(inner.values()), LOOPS * 2 // 10 - 5)
+        self.assertEqual({stack[:-1] for stack in inner}, {(START, OUTER + 4)})
+        self.assertNotIn("decode", vars(cpu))
+
+    def return_to(self, sampler, cpu, call):  # Executes a return to the instruction after the given call
+        cpu.registers[1] = call + 4
+        decoded = sampler.decode(assembler.jalr(0, 1, 0))
+        decoded.execute(cpu, decoded)
+
+    def test_return_past_calls_that_never_returned(self):
+        cpu = machine()
+        sampler = Profiler(cpu)
+        sampler.stack = [0x100, 0x200, 0x300]
+        self.return_to(sampler, cpu, 0x200)  # As after a longjmp
+        self.assertEqual(sampler.stack, [0x100])
+        self.return_to(sampler, cpu, 0x800)  # No call on the stack
+        self.assertEqual(sampler.stack, [0x100])
+        self.assertEqual(cpu.pc, 0x804)
+
+    def test_deep_stacks_drop_the_outermost_calls(self):
+        cpu = machine()
+        sampler = Profiler(cpu)
+        call = sampler.decode(assembler.jal(1, 16))
+        with mock.patch.object(profiler, "MAX_DEPTH", 2):
+            for pc in (0x100, 0x200, 0x300):
+                cpu.pc = pc
+                call.execute(cpu, call)
+        self.assertEqual(sampler.stack, [0x200, 0x300])
+        self.assertEqual((cpu.pc, cpu.registers[1]), (0x310, 0x304))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import os
+import time
+import unittest
+from unittest import mock
+
+import assembler
+import runner
+import system
+from runner import STATUS_ERROR, STATUS_PASSED, STATUS_TIMEOUT
+from system import SYSCALL_READ
+
+START = 0x80000000
+DATA = 0x80010000
+
+
+def reading_image():  # Reads its standard input until the end of file, then exits
+    words = assembler.load_immediate(11, DATA)
+    loop = len(words)
+    words += [assembler.addi(17, 0, SYSCALL_READ), assembler.addi(10, 0, 0), assembler.addi(12, 0, 16),
+              assembler.ecall()]
+    words.append(assembler.bne(10, 0, (loop - len(words)) * 4))
+    words += [assembler.addi(17, 0, 0)]
+    return assembler.assemble(words + assembler.exit_program(), START)
+
+
+def slow_load(path):  # An image that takes a while to load, then exits at once
+    time.sleep(0.2)
+    return assembler.assemble(assembler.exit_program(), START)
+
+
+def crash(path, *arguments):  # The worker of the test dies without a result
+    os._exit(1)
+
+
+class RunnerTest(unittest.TestCase):
+    def test_guest_reading_stdin_gets_the_end_of_file(self):
+        with mock.patch.object(runner.image, "load", return_value=reading_image()):
+            result = runner.run_test("reading.mc", timeout=10)
+        self.assertEqual(result["status"], STATUS_PASSED, result["reason"])
+
+    def test_timeout_stops_the_guest_inside_a_slice(self):
+        looping = assembler.assemble([assembler.jal(0, 0)], START)
+        begin = time.perf_counter()
+        with mock.patch.object(runner.image, "load", return_value=looping), \
+                mock.patch.object(runner, "SLICE_SIZE", 10 ** 9):
+            result = runner.run_test("looping.mc", timeout=0.2)
+        self.assertEqual(result["status"], STATUS_TIMEOUT)
+        self.assertLess(time.perf_counter() - begin, 5)
+
+    def test_mips_leave_out_the_load(self):
+        with mock.patch.object(runner.image, "load", slow_load):
+            result = runner.run_test("slow.mc")
+        self.assertEqual(result["status"], STATUS_PASSED, result["reason"])
+        self.assertGreaterEqual(result["seconds"], 0.2)
+        self.assertGreater(result["mips"], 10 * result["instructions"] / result["seconds"] / 1e6)
+
+    def test_tests_share_the_output_streams(self):
+        with mock.patch.object(system, "host_streams", []):
+            first, second = runner.test_streams(), runner.test_streams()
+        self.assertIsNot(first[0], second[0])  # A fresh empty input each
+        self.assertEqual(first[1:], second[1:])
+        self.assertIs(first[1], second[1])
+
+    def test_dead_worker_gives_error_results(self):
+        with mock.patch.object(runner, "run_test", crash):
+            results = runner.run_tests(["first.mc", "second.mc"], jobs=1)
+
+        self.assertEqual(sorted(result["path"] for result in results), ["first.mc", "second.mc"])
+        for result in results:
+            self.assertEqual(result["status"], STATUS_ERROR)
+            self.assertIn("BrokenProcessPool", result["reason"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import image
+from server import EmulationServer, submit
+
+TEST_PROGRAM = os.path.join(os.path.dirname(__file__), "rv32ui-v-addi.mc")
+
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.program = os.path.join(self.directory, "addi.mc")
+        shutil.copy(TEST_PROGRAM, self.program)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def submit(self, requests):  # Runs a server on a Unix socket, sends the requests and returns the results by id
+        path = os.path.join(self.directory, "server.sock")
+
+        async def exchange():
+            server = asyncio.create_task(EmulationServer().serve(path))
+            while not os.path.exists(path):
+                await asyncio.sleep(0.01)
+            try:
+                return await submit(requests, path)
+            finally:
+                server.cancel()
+
+        return {result["id"]: result for result in asyncio.run(exchange())}
+
+    def test_runs_a_job(self):
+        results = self.submit([{"id": 1, "image": self.program}])
+        self.assertEqual(results[1]["reason"], "exit")
+        self.assertEqual(results[1]["exit_code"], 0)
+
+    def test_invalid_requests_get_an_error_reply(self):
+        garbage = os.path.join(self.directory, "garbage.mc")
+        with open(garbage, "w") as file:
+            file.write("not a dump\n")
+
+        results = self.submit([{"id": 1, "image": self.program, "max_steps": "many"},
+                               {"id": 2, "image": self.program, "stdin": 5},
+                               {"id": 3, "image": 7},
+                               {"id": 4, "image": garbage},
+                               {"id": 5, "image": os.path.join(self.directory, "missing.mc")},
+                               {"id": 6, "image": self.program, "max_steps": None}])
+
+        for identifier in range(1, 6):
+            self.assertEqual(results[identifier]["reason"], "error", identifier)
+        self.assertEqual(results[6]["reason"], "exit")  # The connection still serves the jobs after the errors
+
+    def test_no_compiled_image_is_written(self):
+        self.submit([{"id": 1, "image": self.program}])
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "addi.img")))
+
+    def test_images_are_loaded_off_the_event_loop(self):
+        threads = []
+        original = image.load
+
+        def load(path, cache=True):
+            threads.append(threading.current_thread())
+            return original(path, cache)
+
+        with mock.patch.object(image, "load", load):
+            results = self.submit([{"id": 1, "image": self.program}])
+        self.assertEqual(results[1]["reason"], "exit")
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.main_thread())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,159 @@
+import multiprocessing
+import os
+import threading
+import unittest
+from unittest import mock
+
+import assembler
+import smp
+from processor import Processor, STOP_FAULT
+from smp import LockedMemory, SMPMachine, STOP_STOPPED
+from system import System
+
+START = 0x80000000
+DATA = 0x80010000
+LOCKS = 4
+
+
+def hart(words, hart_id=0):  # Returns a cpu over a locked memory, with its own locks and store generations
+    memory = assembler.assemble(list(words) + assembler.exit_program(), START)
+    memory.write_word(0, DATA)
+    locked = LockedMemory(START, [threading.RLock() for _ in range(LOCKS)], [0] * LOCKS)
+    for number, page in memory.pages.items():
+        locked.map_page(number, page.data)
+
+    cpu = Processor(hart_id, System(locked))
+    cpu.pc = START
+    cpu.atomic_locks = locked.locks
+    cpu.store_generations = locked.generations
+    return cpu
+
+
+def reserve_and_store(value):  # LR of the word at DATA into x11, then SC of the value, with its result in x13
+    return assembler.load_immediate(12, DATA) + assembler.load_immediate(14, value) + \
+        [assembler.lr_w(11, 12), assembler.sc_w(13, 12, 14)]
+
+
+def counter_program(harts, increments):  # Each hart adds increments to the word at DATA, half by AMO half by LR/SC
+    words = assembler.load_immediate(5, DATA) + assembler.load_immediate(6, DATA + 4) + \
+        assembler.load_immediate(7, increments) + [assembler.addi(8, 0, 1)]
+    loop = len(words)
+    words += [assembler.amoadd_w(0, 5, 8), assembler.lr_w(11, 5), assembler.addi(11, 11, 1),
+              assembler.sc_w(13, 5, 11), assembler.bne(13, 0, -12), assembler.addi(7, 7, -1)]
+    words.append(assembler.bne(7, 0, (loop - len(words)) * 4))
+    words += [assembler.amoadd_w(0, 6, 8), assembler.addi(14, 0, harts)]
+    words += [assembler.lw(9, 6, 0), assembler.bne(9, 14, -4)]  # The harts exit once all of them are done
+    return words
+
+
+run_hart = smp.run_hart
+
+
+def die(name, base, size, start, hart_id, *arguments):  # The second hart dies without a result
+    if hart_id == 1:
+        os._exit(3)
+    run_hart(name, base, size, start, hart_id, *arguments)
+
+
+class ReservationTest(unittest.TestCase):
+    def test_sc_succeeds_without_store_in_between(self):
+        cpu = hart(reserve_and_store(7))
+        cpu.run()
+        self.assertEqual(cpu.registers[13], 0)
+        self.assertEqual(cpu.system.memory.read_word(DATA), 7)
+
+    def test_store_of_the_loaded_value_breaks_the_reservation(self):
+        words = reserve_and_store(7)
+        cpu = hart(words)
+        cpu.run(len(words) - 1)  # Up to the LR
+
+        other = Processor(1, System(cpu.system.memory))  # Another hart stores A, B then A again
+        other.system.memory.write_word(5, DATA)
+        other.system.memory.write_word(0, DATA)
+
+        cpu.run()
+        self.assertEqual(cpu.registers[13], 1)
+        self.assertEqual(cpu.system.memory.read_word(DATA), 0)
+
+    def test_sc_to_another_address_fails(self):
+        words = reserve_and_store(7)
+        words[-1] = assembler.sc_w(13, 15, 14)
+        cpu = hart(assembler.load_immediate(15, DATA + 4) + words)
+        cpu.run()
+        self.assertEqual(cpu.registers[13], 1)
+        self.assertEqual(cpu.system.memory.read_word(DATA + 4), 0)
+
+    def test_amo_returns_the_old_value(self):
+        cpu = hart(assembler.load_immediate(12, DATA) + [assembler.addi(14, 0, 5), assembler.amoadd_w(11, 12, 14),
+                                                         assembler.amoswap_w(15, 12, 0)])
+        cpu.system.memory.write_word(3, DATA)
+        cpu.run()
+        self.assertEqual(cpu.registers[11], 3)
+        self.assertEqual(cpu.registers[15], 8)
+        self.assertEqual(cpu.system.memory.read_word(DATA), 0)
+
+
+class CodeTest(unittest.TestCase):
+    def test_code_of_another_hart_runs_after_fence_i(self):
+        cpu = hart([assembler.addi(5, 5, 1), assembler.jal(0, -4)])
+        memory = cpu.system.memory
+        other = LockedMemory(START, memory.locks, memory.generations)  # Another hart over the same pages
+        for number, page in memory.pages.items():
+            other.map_page(number, page.data)
+
+        cpu.run(1)
+        other.write_word(assembler.addi(5, 5, 10), START)
+        cpu.run(2)
+        self.assertEqual(cpu.registers[5], 2)  # The hart still runs the instruction it decoded
+
+        fence = cpu.decode(assembler.fence_i())
+        fence.execute(cpu, fence)
+        cpu.pc = START
+        cpu.run(1)
+        self.assertEqual(cpu.registers[5], 12)
+
+    def test_stores_release_the_lock_on_errors(self):
+        cpu = hart([])
+        memory = cpu.system.memory
+        memory.map_device(0x10000000, 4, None)  # A device without methods, its stores fail
+        with self.assertRaises(AttributeError):
+            memory.write_word(1, 0x10000000)
+        lock = memory.locks[(0x10000000 >> 2) % LOCKS]
+        acquired = []
+        thread = threading.Thread(target=lambda: acquired.append(lock.acquire(timeout=1)))  # As another hart
+        thread.start()
+        thread.join()
+        self.assertEqual(acquired, [True])
+
+
+class SMPMachineTest(unittest.TestCase):
+    def machine(self, harts, increments):
+        memory = assembler.assemble(counter_program(harts, increments) + assembler.exit_program(), START)
+        memory.write_word(0, DATA)
+        machine = SMPMachine(memory, harts, ram_size=0x20000)
+        self.addCleanup(machine.close)
+        return machine
+
+    def test_atomic_counter(self):
+        machine = self.machine(4, 200)
+        results = machine.run()
+        self.assertEqual([result["hart"] for result in results], [0, 1, 2, 3])
+        self.assertNotIn(STOP_FAULT, [result["reason"] for result in results])
+        self.assertEqual(machine.read_word(DATA), 4 * 200 * 2)
+        self.assertEqual(machine.read_word(DATA + 4), 4)
+
+    def test_dead_hart_faults(self):
+        if "fork" not in multiprocessing.get_all_start_methods():
+            self.skipTest("the harts must be forked to run the patched body")
+        machine = self.machine(2, 10 ** 6)
+        with mock.patch.object(smp, "run_hart", die), \
+                mock.patch.object(multiprocessing, "Process", multiprocessing.get_context("fork").Process):
+            results = machine.run()
+
+        self.assertEqual(results[1]["reason"], STOP_FAULT)
+        self.assertIn("exit code 3", results[1]["error"])
+        self.assertEqual(results[0]["reason"], STOP_STOPPED)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+import io
+import os
+import tempfile
+import threading
+import unittest
+
+import assembler
+from clint import Clint, CLINT_BASE, CLINT_MTIMECMP
+from mmu import VirtualMemory, PRIVILEGE_SUPERVISOR, PRIVILEGE_MACHINE, SATP_MODE_SV32
+from processor import Processor, CSR_MTVEC, CSR_MSCRATCH, CSR_MIP, CSR_SATP, MIP_MTIP
+from smp import LockedMemory
+from snapshot import Snapshot
+from system import System
+from uart import Uart, UART_BASE
+
+START = 0x80000000
+
+
+def machine(words=()):  # Returns a cpu running the given instructions, with a CLINT and a UART
+    memory = assembler.assemble(list(words) + assembler.exit_program(), START)
+    output = io.BytesIO()
+    system = System(memory, streams=[io.BytesIO(), output, io.BytesIO()])
+    cpu = Processor(system=system)
+    cpu.pc = START
+    clint = Clint(cpu)
+    uart = Uart(system)
+    return cpu, clint, uart, output
+
+
+class SnapshotTest(unittest.TestCase):
+    def test_restore_puts_back_the_csrs(self):
+        cpu, _, _, _ = machine()
+        cpu.csrs[CSR_MTVEC] = 0x80000100
+        snapshot = Snapshot.take(cpu)
+
+        cpu.csrs[CSR_MTVEC] = 0x80000200
+        cpu.csrs[CSR_MSCRATCH] = 7
+        cpu.reservation = (START, 1)
+        snapshot.restore(cpu)
+
+        self.assertEqual(cpu.csrs[CSR_MTVEC], 0x80000100)
+        self.assertEqual(cpu.csrs[CSR_MSCRATCH], 0)
+        self.assertIsNone(cpu.reservation)
+
+    def test_restore_puts_back_the_address_space(self):
+        cpu, _, _, _ = machine()
+        cpu.csrs[CSR_SATP] = SATP_MODE_SV32 | 0x80100
+        cpu.privilege = PRIVILEGE_SUPERVISOR
+        cpu.update_translation()
+        snapshot = Snapshot.take(cpu)
+
+        snapshot.restore(cpu)
+        self.assertIsInstance(cpu.system.memory, VirtualMemory)
+        self.assertEqual(cpu.system.memory.root, 0x80100000)
+
+    def test_restore_keeps_the_class_of_the_memory(self):
+        locks, generations = [threading.RLock()], [0]
+        memory = LockedMemory(START, locks, generations)
+        memory.write_bytes(START, assembler.assemble(assembler.exit_program(), START).read_bytes(START, 8))
+        cpu = Processor(system=System(memory, streams=[io.BytesIO(), io.BytesIO(), io.BytesIO()]))
+        cpu.csrs[CSR_SATP] = SATP_MODE_SV32 | 0x80100
+        cpu.privilege = PRIVILEGE_SUPERVISOR
+        cpu.update_translation()
+        snapshot = Snapshot.take(cpu)
+
+        snapshot.restore(cpu)
+        restored = cpu.system.memory
+        self.assertIsInstance(restored, VirtualMemory)
+        self.assertIsInstance(restored, LockedMemory)
+        self.assertIs(restored.locks, locks)
+        cpu.privilege = PRIVILEGE_MACHINE
+        cpu.update_translation()
+        self.assertIs(type(restored), LockedMemory)
+        restored.write_word(1, START)
+        self.assertEqual(generations, [1])
+
+    def test_restore_keeps_the_devices(self):
+        cpu, _, uart, output = machine()
+        snapshot = Snapshot.take(cpu)
+        snapshot.restore(cpu)
+
+        memory = cpu.system.memory
+        for byte in b"ok\n":
+            memory.write_byte(byte, UART_BASE)
+        self.assertEqual(output.getvalue(), b"ok\n")
+
+    def test_restore_reschedules_the_timer(self):
+        cpu, clint, _, _ = machine()
+        cpu.system.memory.write_word(500, CLINT_BASE + CLINT_MTIMECMP)
+        cpu.system.memory.write_word(0, CLINT_BASE + CLINT_MTIMECMP + 4)
+        snapshot = Snapshot.take(cpu)
+
+        clint.mtimecmp = 10 ** 9
+        cpu.scheduler.advance(1000)
+        snapshot.restore(cpu)
+
+        self.assertEqual(clint.mtimecmp, 500)
+        self.assertEqual(cpu.scheduler.now, 0)
+        self.assertFalse(cpu.csrs[CSR_MIP] & MIP_MTIP)
+        cpu.scheduler.advance(500)
+        self.assertTrue(cpu.csrs[CSR_MIP] & MIP_MTIP)
+
+    def test_save_and_load(self):
+        cpu, clint, _, _ = machine([assembler.addi(5, 0, 42)])
+        cpu.csrs[CSR_MTVEC] = 0x80000100
+        clint.mtimecmp = 1234
+        snapshot = Snapshot.take(cpu)
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "machine.snap")
+            snapshot.save(filename)
+            loaded = Snapshot.load(filename)
+
+            other, other_clint, _, _ = machine()
+            loaded.restore(other)
+            self.assertEqual(other.csrs[CSR_MTVEC], 0x80000100)
+            self.assertEqual(other_clint.mtimecmp, 1234)
+            other.run()
+            self.assertEqual(other.registers[5], 42)
+            self.assertTrue(other.system.terminate)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+import errno
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import assembler
+import system
+from processor import Processor, STOP_EXIT
+from system import (System, SYSCALL_OPENAT, SYSCALL_CLOSE, SYSCALL_READ, SYSCALL_WRITE, SYSCALL_BRK, AT_FDCWD,
+                    O_CREAT, O_TRUNC)
+
+START = 0x80000000
+DATA = 0x80010000
+STACK = 0xfffff000  # A stack page at the top of the address space
+
+
+class FlushedFile(io.BytesIO):  # Counts the flushes of a stream
+    flushes = 0
+
+    def flush(self):
+        self.flushes += 1
+
+
+def system_call(number, result, *arguments):  # The code of a system call, which copies its result into result
+    words = []
+    for index, value in enumerate(arguments):
+        words += assembler.load_immediate(10 + index, value & 0xffffffff)
+    return words + [assembler.addi(17, 0, number), assembler.ecall(), assembler.addi(result, 10, 0)]
+
+
+def machine(words, streams=None):
+    memory = assembler.assemble(list(words) + assembler.exit_program(), START)
+    cpu = Processor(system=System(memory, streams or [io.BytesIO(), io.BytesIO(), io.BytesIO()]))
+    cpu.pc = START
+    return cpu
+
+
+class SystemTest(unittest.TestCase):
+    def test_host_streams_are_opened_lazily_and_shared(self):
+        with mock.patch.object(system, "host_streams", []):
+            idle = System()
+            self.assertIsNone(idle.streams)
+            self.assertEqual(system.host_streams, [])
+
+            first = System(assembler.assemble([], START))
+            second = System(assembler.assemble([], START))
+            self.assertEqual(len(system.host_streams), 3)
+            for descriptor in range(3):
+                self.assertIs(first.files[descriptor], second.files[descriptor])
+                self.assertEqual(first.files[descriptor].fileno(), descriptor)
+
+    def test_riscv_tests_exit_flushes_the_output(self):
+        output = FlushedFile()
+        cpu = machine([assembler.addi(17, 0, 0)], [io.BytesIO(), output, io.BytesIO()])
+        self.assertEqual(cpu.run().reason, STOP_EXIT)
+        self.assertTrue(cpu.system.terminate)
+        self.assertGreater(output.flushes, 0)
+
+    def test_brk_starts_after_the_program_as_loaded(self):
+        cpu = machine([assembler.addi(17, 0, SYSCALL_BRK), assembler.addi(10, 0, 0), assembler.ecall(),
+                       assembler.addi(5, 10, 0), assembler.addi(17, 0, 0)])
+        cpu.system.memory.write_word(1, STACK)  # The stack is touched after the load
+
+        self.assertEqual(cpu.run().reason, STOP_EXIT)
+        self.assertEqual(cpu.registers[5], START + 0x1000)
+
+    def test_openat_of_a_name_that_is_not_utf8(self):
+        words = assembler.load_immediate(11, DATA) + [assembler.addi(17, 0, SYSCALL_OPENAT),
+                                                      assembler.addi(10, 0, AT_FDCWD), assembler.addi(12, 0, 0),
+                                                      assembler.ecall(), assembler.addi(5, 10, 0),
+                                                      assembler.addi(17, 0, 0)]
+        cpu = machine(words)
+        cpu.system.memory.write_bytes(DATA, b"missing-\xff\xfe\0")
+
+        self.assertEqual(cpu.run().reason, STOP_EXIT)
+        self.assertEqual(cpu.registers[5], -errno.ENOENT & 0xffffffff)
+
+
+class FileCallTest(unittest.TestCase):
+    def test_write_a_file_and_read_it_back(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "out.txt").encode()
+        buffer = DATA + 0x2000 - 3  # The bytes read cross into the next page
+
+        words = system_call(SYSCALL_OPENAT, 20, AT_FDCWD, DATA, 1 | O_CREAT | O_TRUNC, 0o644)  # Write only
+        words += system_call(SYSCALL_WRITE, 21, 3, DATA + 0x800, 10)
+        words += system_call(SYSCALL_CLOSE, 22, 3)
+        words += system_call(SYSCALL_OPENAT, 23, AT_FDCWD, DATA, 0, 0)
+        words += system_call(SYSCALL_READ, 24, 3, buffer, 64)  # A short read, the file holds 10 bytes
+        words += system_call(SYSCALL_CLOSE, 25, 3)
+        words += system_call(SYSCALL_CLOSE, 26, 3)  # Already closed
+        cpu = machine(words + [assembler.addi(17, 0, 0)])
+        cpu.system.memory.write_bytes(DATA, path + b"\0")
+        cpu.system.memory.write_bytes(DATA + 0x800, b"hello file")
+
+        self.assertEqual(cpu.run().reason, STOP_EXIT)
+        self.assertEqual(cpu.registers[20:27], [3, 10, 0, 3, 10, 0, -errno.EBADF & 0xffffffff])
+        self.assertEqual(bytes(cpu.system.memory.read_bytes(buffer, 11)), b"hello file\0")
+        with open(path, "rb") as file:
+            self.assertEqual(file.read(), b"hello file")
+        self.assertEqual(sorted(cpu.system.files), [0, 1, 2])
+
+    def test_standard_streams(self):
+        streams = [io.BytesIO(b"typed"), io.BytesIO(), io.BytesIO()]
+        words = system_call(SYSCALL_WRITE, 20, 1, DATA, 3) + system_call(SYSCALL_WRITE, 21, 2, DATA + 3, 2)
+        words += system_call(SYSCALL_READ, 22, 0, DATA + 0x100, 16)
+        words += system_call(SYSCALL_WRITE, 23, 7, DATA, 1)  # Not open
+        cpu = machine(words + [assembler.addi(17, 0, 0)], streams)
+        cpu.system.memory.write_bytes(DATA, b"outer")
+
+        self.assertEqual(cpu.run().reason, STOP_EXIT)
+        self.assertEqual(cpu.registers[20:24], [3, 2, 5, -errno.EBADF & 0xffffffff])
+        self.assertEqual((streams[1].getvalue(), streams[2].getvalue()), (b"out", b"er"))
+        self.assertEqual(bytes(cpu.system.memory.read_bytes(DATA + 0x100, 5)), b"typed")
+
+    def test_openat_without_host_files(self):
+        cpu = machine(system_call(SYSCALL_OPENAT, 20, AT_FDCWD, DATA, 0, 0) + [assembler.addi(17, 0, 0)])
+        cpu.system.host_files = False
+        cpu.system.memory.write_bytes(DATA, b"file\0")
+        self.assertEqual(cpu.run().reason, STOP_EXIT)
+        self.assertEqual(cpu.registers[20], -errno.EACCES & 0xffffffff)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import assembler
+import tracing
+from mmu import PRIVILEGE_USER
+from processor import Processor, CSR_MSCRATCH, CSR_MTVEC, OP_LOAD, STOP_EXIT, STOP_FAULT
+from system import System
+from tracing import Tracer, TraceException, FLAG_WRITE, FLAG_LOAD, FLAG_TRAP
+
+START = 0x80000000
+DATA = 0x80010000
+HANDLER = 0x80001000
+
+
+def machine(words):
+    memory = assembler.assemble(list(words) + assembler.exit_program(), START)
+    cpu = Processor(system=System(memory))
+    cpu.pc = START
+    return cpu
+
+
+class BrokenFile:  # A trace file whose writes fail, as on a full disk
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *unused):
+        return False
+
+    def write(self, data):
+        raise OSError(28, "No space left on device")
+
+
+class TracerTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.filename = os.path.join(directory.name, "run.trace")
+
+    def test_records_the_words_and_destinations(self):
+        words = [assembler.addi(5, 0, 7), assembler.csrrw(6, CSR_MSCRATCH, 5), assembler.csrr(7, CSR_MSCRATCH)]
+        cpu = machine(words)
+        tracer = Tracer(self.filename)
+        tracer.start(cpu)
+        cpu.run()
+        tracer.close()
+
+        records = list(tracing.read_trace(self.filename))
+        self.assertEqual([record[1] for record in records[:3]], words)
+        writes = [(record[5], record[2]) for record in records[:3] if record[6] & FLAG_WRITE]
+        self.assertEqual(writes, [(5, 7), (6, 0), (7, 7)])
+        self.assertFalse(records[-1][6] & FLAG_WRITE)  # The ECALL
+
+    def record(self, cpu):  # Runs the cpu to its exit and returns its records
+        tracer = Tracer(self.filename)
+        tracer.start(cpu)
+        self.assertEqual(cpu.run().reason, STOP_EXIT)
+        tracer.close()
+        self.assertNotIn("decode", vars(cpu))  # The cpu has its decoder back
+        return list(tracing.read_trace(self.filename))
+
+    def test_loads_record_the_memory_value(self):
+        words = assembler.load_immediate(5, DATA) + [assembler.i_type(OP_LOAD, 0, 6, 5, 0), assembler.lw(0, 5, 0)]
+        cpu = machine(words)
+        cpu.system.memory.write_word(0xffffff80, DATA)
+
+        records = self.record(cpu)
+        self.assertEqual(len(records), len(words) + len(assembler.exit_program()))  # No pair is fused
+        _, _, value, address, memory_value, rd, flags = records[2]
+        self.assertEqual((value, address, memory_value, rd, flags), (0xffffff80, DATA, 0x80, 6, FLAG_LOAD | FLAG_WRITE))
+        _, _, value, address, memory_value, rd, flags = records[3]
+        self.assertEqual((value, address, memory_value, rd, flags), (0, DATA, 0xffffff80, 0, FLAG_LOAD))
+
+    def test_trapping_instructions_are_recorded(self):
+        cpu = machine([])
+        for index, word in enumerate(assembler.exit_program()):
+            cpu.system.memory.write_word(word, HANDLER + 4 * index)
+        cpu.csrs[CSR_MTVEC] = HANDLER
+        cpu.privilege = PRIVILEGE_USER  # The ECALL of the user mode traps to the handler
+
+        records = self.record(cpu)
+        self.assertEqual([(record[0], record[6]) for record in records],
+                         [(START, FLAG_WRITE), (START + 4, FLAG_TRAP), (HANDLER, FLAG_WRITE), (HANDLER + 4, 0)])
+
+    def test_writer_failure_stops_the_run(self):
+        cpu = machine([assembler.addi(5, 5, 1)] * 64)
+        with mock.patch.object(tracing, "CHUNK_RECORDS", 4), mock.patch.object(tracing, "CHUNKS", 2):
+            tracer = Tracer(self.filename)
+        tracer.file.close()
+        tracer.file = BrokenFile()
+        tracer.start(cpu)
+
+        stop = cpu.run()
+        self.assertEqual(stop.reason, STOP_FAULT)
+        self.assertIsInstance(stop.error, TraceException)
+        self.assertIn("No space left", str(stop.error))
+        with self.assertRaises(TraceException):
+            tracer.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+
+import assembler
+from mmu import PRIVILEGE_SUPERVISOR, SATP_MODE_SV32
+from processor import Processor, CSR_SATP
+from system import System
+from translator import Translator
+
+START = 0x80000000
+
+
+def machine(words=()):
+    memory = assembler.assemble(list(words) + assembler.exit_program(), START)
+    cpu = Processor(system=System(memory))
+    cpu.pc = START
+    return cpu
+
+
+class TranslatorTest(unittest.TestCase):
+    def test_runs_a_bare_metal_guest(self):
+        cpu = machine([assembler.addi(5, 0, 42)])
+        Translator(cpu).run()
+        self.assertEqual(cpu.registers[5], 42)
+        self.assertTrue(cpu.system.terminate)
+
+    def test_address_space_change_drops_the_blocks(self):
+        cpu = machine([assembler.addi(5, 0, 42)])
+        translator = Translator(cpu)
+        translator.run()
+        self.assertTrue(translator.blocks)
+
+        cpu.write_csr(CSR_SATP, 0)
+        self.assertEqual(translator.blocks, {})
+        self.assertEqual(cpu.system.memory.decode_cache, {})
+
+    def test_refuses_a_guest_with_paging_on(self):
+        cpu = machine([assembler.addi(5, 0, 42)])
+        translator = Translator(cpu)
+        cpu.csrs[CSR_SATP] = SATP_MODE_SV32 | (START >> 12)
+        cpu.privilege = PRIVILEGE_SUPERVISOR
+        cpu.update_translation()
+
+        with self.assertRaises(NotImplementedError):
+            translator.run()
+        self.assertEqual(cpu.registers[5], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,271 @@
+import argparse
+import gzip
+import queue
+import struct
+import sys
+import threading
+
+from mmu import Trap
+from processor import Processor, OP_BRANCH, OP_LOAD, OP_STORE, OP_SYSTEM, OP_EMPTY, WORD_MASK, mnemonics
+
+# A trace file is a header followed by fixed-size records, one for every executed instruction.
+# Compressed traces are the same stream written through gzip.
+TRACE_MAGIC = b"RVTR"
+TRACE_VERSION = 1
+
+# magic, version, size of a record
+header_format = struct.Struct("<4sHH")
+
+# pc, raw instruction, new value of rd, memory address, memory value, rd, flags
+record_format = struct.Struct("<IIIIIBBxx")
+
+FLAG_WRITE = 1  # The instruction wrote rd
+FLAG_LOAD = 2
+FLAG_STORE = 4
+FLAG_TRAP = 8  # The instruction trapped, it wrote nothing
+
+# The opcodes that do not write rd. Of the system instructions, only ECALL, EBREAK, the returns, WFI and
+# SFENCE.VMA, the ones with a zero funct3, do not: the CSR instructions write the old value of the CSR into rd.
+NO_DESTINATION = (OP_BRANCH, OP_STORE, OP_EMPTY)
+
+CHUNK_RECORDS = 16384  # The records of a chunk of the ring buffer, the writer thread writes whole chunks
+CHUNKS = 8  # The chunks of the ring buffer
+WRITER_POLL_INTERVAL = 0.1  # The seconds the cpu waits for a free chunk before it checks that the writer is alive
+
+
+class TraceException(Exception):  # Throw when a trace file is invalid
+    pass
+
+
+# Records an execution trace. It is started on a cpu with tracer.start(cpu), and packs a record of every
+# executed instruction into a ring of preallocated chunks. Full chunks are handed to a background thread
+# that writes, and optionally compresses, them. When the writer falls behind, the cpu waits for a free chunk.
+# When the writer fails, the error is raised as a TraceException by the next wait for a chunk and by close.
+class Tracer:
+    def __init__(self, filename, compress=None):
+        if compress is None:
+            compress = filename.endswith(".gz")
+        self.file = gzip.open(filename, "wb", compresslevel=1) if compress else open(filename, "wb")
+        self.file.write(header_format.pack(TRACE_MAGIC, TRACE_VERSION, record_format.size))
+
+        self.free = queue.Queue()  # Chunks ready to be filled
+        self.full = queue.Queue()  # Chunks waiting to be written, and the number of records they hold
+        for _ in range(CHUNKS):
+            self.free.put(bytearray(CHUNK_RECORDS * record_format.size))
+
+        self.chunk = self.free.get()
+        self.offset = 0  # The offset of the next record in the chunk
+        self.end = len(self.chunk)
+        self.pack = record_format.pack_into
+
+        self.cpu = None  # The cpu being recorded, see start
+        self.previous = None
+        self.decode_next = None
+        self.error = None  # The exception that stopped the writer thread
+
+        self.writer = threading.Thread(target=self.write_chunks, daemon=True)
+        self.writer.start()
+
+    # Starts recording the instructions run by the cpu. The decoder of the cpu is wrapped, so each decoded instruction
+    # gets a handler that runs it and packs its record, and the run loop keeps its pace. The recording handlers are
+    # never fused, so every instruction has its own record, and the handler of ECALL is handed to the cpu as its
+    # system handler, so the run loop still stops at the exit. The decoded instructions are dropped, so they are
+    # decoded again with the recording handlers.
+    def start(self, cpu):
+        self.cpu = cpu
+        self.previous = vars(cpu).get("decode")  # The decoder of the cpu when it is not the one of the class
+        self.decode_next = cpu.decode
+        cpu.decode = self.decode
+        cpu.system_handler = self.record_system
+        cpu.system.memory.flush_code()
+
+    def stop(self):  # Gives the cpu back its decoder, the decoded instructions are dropped again
+        cpu = self.cpu
+        if cpu is None:
+            return
+        self.cpu = None
+        if self.previous is None:
+            del cpu.decode
+        else:
+            cpu.decode = self.previous
+        cpu.system_handler = Processor.execute_system
+        cpu.system.memory.flush_code()
+
+    def decode(self, instruction):
+        decoded = self.decode_next(instruction)
+        if decoded.execute is Processor.execute_system:
+            decoded.execute = self.cpu.system_handler
+        else:
+            decoded.execute = self.recorder(decoded.execute, decoded)
+        return decoded
+
+    # Returns the handler that runs execute and records the decoded instruction. The operands of the record that do
+    # not change are bound once, when the instruction is decoded. A load records the value it read from memory,
+    # taken from rd right after the handler, before the run loop zeroes x0. An instruction that traps has a record
+    # with FLAG_TRAP and without a destination, the trap is then delivered as usual.
+    def recorder(self, execute, decoded):
+        add = self.add
+        word, opcode, rd = decoded.word, decoded.opcode, decoded.rd
+        rs1, rs2, imm = decoded.rs1, decoded.rs2, decoded.imm
+        if opcode == OP_LOAD or opcode == OP_STORE:
+            mask = (1 << (8 << (decoded.funct3 & 3))) - 1
+
+        if opcode == OP_LOAD:
+            flags = FLAG_LOAD | (FLAG_WRITE if rd else 0)
+
+            def record_load(cpu, decoded):
+                pc = cpu.pc
+                address = (cpu.registers[rs1] + imm) & WORD_MASK
+                try:
+                    execute(cpu, decoded)
+                except Trap:
+                    add(pc, word, 0, address, 0, 0, FLAG_LOAD | FLAG_TRAP)
+                    raise
+                value = cpu.registers[rd]
+                add(pc, word, value if rd else 0, address, value & mask, rd, flags)
+
+            return record_load
+
+        if opcode == OP_STORE:
+            def record_store(cpu, decoded):
+                pc = cpu.pc
+                registers = cpu.registers
+                address = (registers[rs1] + imm) & WORD_MASK
+                value = registers[rs2] & mask
+                try:
+                    execute(cpu, decoded)
+                except Trap:
+                    add(pc, word, 0, address, value, 0, FLAG_STORE | FLAG_TRAP)
+                    raise
+                add(pc, word, 0, address, value, 0, FLAG_STORE)
+
+            return record_store
+
+        if rd != 0 and opcode not in NO_DESTINATION and (opcode != OP_SYSTEM or decoded.funct3):
+            def record_write(cpu, decoded):
+                pc = cpu.pc
+                try:
+                    execute(cpu, decoded)
+                except Trap:
+                    add(pc, word, 0, 0, 0, 0, FLAG_TRAP)
+                    raise
+                add(pc, word, cpu.registers[rd], 0, 0, rd, FLAG_WRITE)
+
+            return record_write
+
+        def record(cpu, decoded):
+            pc = cpu.pc
+            try:
+                execute(cpu, decoded)
+            except Trap:
+                add(pc, word, 0, 0, 0, 0, FLAG_TRAP)
+                raise
+            add(pc, word, 0, 0, 0, rd, 0)
+
+        return record
+
+    def record_system(self, cpu, decoded):  # Runs and records an ECALL
+        pc = cpu.pc
+        try:
+            Processor.execute_system(cpu, decoded)
+        except Trap:
+            self.add(pc, decoded.word, 0, 0, 0, 0, FLAG_TRAP)
+            raise
+        self.add(pc, decoded.word, 0, 0, 0, decoded.rd, 0)
+
+    def add(self, pc, word, value, address, memory_value, rd, flags):  # Packs a record into the current chunk
+        self.pack(self.chunk, self.offset, pc, word, value, address, memory_value, rd, flags)
+        self.offset += record_format.size
+        if self.offset == self.end:
+            self.flush()
+
+    def flush(self):  # Hands the current chunk to the writer thread and takes a free one
+        if self.offset:
+            self.full.put((self.chunk, self.offset))
+            self.chunk = self.free_chunk()
+            self.offset = 0
+
+    def free_chunk(self):  # Waits for a chunk written by the writer thread
+        while True:
+            try:
+                return self.free.get(timeout=WRITER_POLL_INTERVAL)
+            except queue.Empty:
+                if not self.writer.is_alive():
+                    self.check()
+                    raise TraceException("The trace writer stopped")
+
+    def check(self):  # Raises the error of the writer thread
+        if self.error is not None:
+            raise TraceException(f"Cannot write the trace: {self.error}") from self.error
+
+    def write_chunks(self):  # The body of the writer thread
+        try:
+            with self.file:
+                while True:
+                    chunk, length = self.full.get()
+                    if chunk is None:
+                        break
+                    self.file.write(memoryview(chunk)[:length])
+                    self.free.put(chunk)
+        except Exception as error:
+            self.error = error
+
+    def close(self):  # Stops the recording, writes the remaining records and waits for the writer thread
+        self.stop()
+        if self.writer.is_alive():
+            self.flush()
+        self.full.put((None, 0))
+        self.writer.join()
+        self.check()
+
+
+def read_trace(filename):  # Yields the records of a trace file as tuples
+    with open(filename, "rb") as file:
+        compressed = file.read(2) == b"\x1f\x8b"
+    with (gzip.open(filename, "rb") if compressed else open(filename, "rb")) as file:
+        magic, version, size = header_format.unpack(file.read(header_format.size))
+        if magic != TRACE_MAGIC or version != TRACE_VERSION or size != record_format.size:
+            raise TraceException(f"Not a trace: {filename}")
+
+        while True:
+            data = file.read(size * CHUNK_RECORDS)
+            if not data:
+                break
+            yield from record_format.iter_unpack(data[:len(data) - len(data) % size])
+
+
+def format_record(decoder, record):  # Returns a record as a line of text
+    pc, word, value, address, memory_value, rd, flags = record
+    try:
+        name = decoder.decode(word).execute.__name__.replace("execute_", "")
+    except NotImplementedError:
+        name = "unknown"
+
+    line = f"{pc:08x}: {word:08x} {name:8}"
+    if flags & FLAG_WRITE:
+        line += f" {mnemonics[rd]}={value:#x}"
+    if flags & FLAG_LOAD:
+        line += f" load [{address:#010x}]={memory_value:#x}"
+    if flags & FLAG_STORE:
+        line += f" store [{address:#010x}]={memory_value:#x}"
+    if flags & FLAG_TRAP:
+        line += " trap"
+    return line
+
+
+def main(arguments=None):
+    arguments_parser = argparse.ArgumentParser(description="Decodes an execution trace to text")
+    arguments_parser.add_argument("trace", help="the trace file, compressed or not")
+    arguments_parser.add_argument("--limit", type=int, default=None, help="the number of records to print")
+    arguments = arguments_parser.parse_args(arguments)
+
+    decoder = Processor()
+    for index, record in enumerate(read_trace(arguments.trace)):
+        if index == arguments.limit:
+            break
+        print(format_record(decoder, record))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,412 @@
+from mmu import VirtualMemory
+from processor import (Processor, OP_JAL, OP_JALR, OP_BRANCH, OP_SYSTEM, OP_EMPTY, SYSTEM_FUNCT12_ECALL,
+                       bit_mask_prefix, get_two_complement, ignore_overflow, unfused)
+
+# The opcodes that end a basic block
+BLOCK_TERMINATORS = (OP_JAL, OP_JALR, OP_BRANCH, OP_SYSTEM, OP_EMPTY)
+
+# The maximum number of instructions translated into a single block
+MAX_BLOCK_SIZE = 64
+
+# Masks a python integer to a 32-bit register value
+MASK = bit_mask_prefix(32)
+
+
+def signed_division(dividend, divisor):  # Computes the RISC-V DIV of two 32-bit register values
+    dividend = get_two_complement(dividend, 32)
+    divisor = get_two_complement(divisor, 32)
+    if divisor == 0:
+        return MASK
+
+    quotient = abs(dividend) // abs(divisor)  # Rounds towards zero
+    if (dividend < 0) != (divisor < 0):
+        quotient = -quotient
+    return quotient & MASK
+
+
+def signed_remainder(dividend, divisor):  # Computes the RISC-V REM of two 32-bit register values
+    dividend = get_two_complement(dividend, 32)
+    divisor = get_two_complement(divisor, 32)
+    if divisor == 0:
+        return dividend & MASK
+
+    remainder = abs(dividend) % abs(divisor)  # The remainder takes the sign of the dividend
+    if dividend < 0:
+        remainder = -remainder
+    return remainder & MASK
+
+
+# This class implements a second execution engine. Instead of decoding and executing one instruction
+# per cycle, it translates straight-line basic blocks of guest code into python functions.
+# A block ends at a JAL, JALR, BRANCH, ECALL or empty word. Inside a block the registers are kept
+# in locals and they are written back to the register file only at the block exit.
+# Each block returns the next block to execute, so blocks chain to each other directly.
+class Translator:
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.memory = cpu.system.memory
+
+        self.blocks = {}  # the translated blocks, by start address
+        self.generation = [0]  # bumped every time a store into guest code flushes the translated blocks
+
+        self.memory.code_listeners.append(self.invalidate)
+
+    # Drops every translated block. Called by the memory when a store lands in guest code, and when the address
+    # space changes. Blocks still running notice the new generation after the store and return to the dispatcher.
+    def invalidate(self, address):
+        self.blocks = {}
+        self.generation[0] += 1
+
+    # Returns the block starting at pc, translating it if needed. The blocks call the accessors of the plain memory
+    # and the translator does not deliver traps, so a guest with paging on stops at its first block.
+    def lookup(self, pc):
+        block = self.blocks.get(pc)
+        if block is None:
+            if isinstance(self.memory, VirtualMemory):
+                return self.fault(pc, NotImplementedError("The translator cannot run with paging on"))
+            try:
+                block = self.translate(pc)
+            except NotImplementedError as error:
+                return self.fault(pc, error)  # The error is raised only if the guest actually gets here
+            self.blocks[pc] = block
+        return block
+
+    def fault(self, pc, error):  # Returns a block that stops the guest at pc with the given error
+        cpu = self.cpu
+
+        def block(regs):
+            cpu.pc = pc
+            raise error
+
+        block.pc = pc
+        block.size = 0
+        return block
+
+    # Runs the guest until it terminates or until at least max_instructions instructions were executed.
+    # Returns the number of executed instructions, empty words skipped over are counted as well.
+    def run(self, max_instructions=None):
+        cpu = self.cpu
+        regs = cpu.registers
+        executed = 0
+
+        cpu.pc = ignore_overflow(cpu.pc, cpu.architecture)
+        block = self.lookup(cpu.pc)
+        while block is not None:
+            if max_instructions is not None and executed >= max_instructions:
+                cpu.pc = block.pc
+                break
+
+            executed += block.size
+            block = block(regs)  # An exit that terminates the guest returns None and sets the pc itself
+
+        return executed
+
+    # Decodes up to MAX_BLOCK_SIZE instructions starting at pc and compiles them into a python function
+    def translate(self, pc):
+        decode_cache = self.memory.decode_cache
+        start = pc
+        instructions = []
+
+        while len(instructions) < MAX_BLOCK_SIZE:
+            decoded = decode_cache.get(pc)
+            if decoded is not None:
+                decoded = unfused(decoded)  # The second instruction of a fused pair is translated on its own
+            else:
+                try:
+                    decoded = self.cpu.decode(self.memory.fetch_word(pc))
+                except NotImplementedError:
+                    if instructions:  # End the block here, the error is raised once the guest reaches it
+                        break
+                    raise
+
+                decode_cache[pc] = decoded  # Stores into this address will now flush the blocks
+
+            instructions.append((pc, decoded))
+            pc = ignore_overflow(pc + 4, 32)
+            if decoded.opcode in BLOCK_TERMINATORS:
+                break
+
+        return BlockBuilder(self, start, instructions).build()
+
+
+# Generates the source code of a single block
+class BlockBuilder:
+
+    def __init__(self, translator, start, instructions):
+        self.translator = translator
+        self.start = start
+        self.instructions = instructions
+
+        self.generation = translator.generation[0]  # the generation the block is translated in
+        self.lines = []  # the body of the generated function
+        self.used = set()  # registers that are read or written inside the block
+        self.written = set()  # registers that must be written back at the block exits
+        self.exits = []  # the constant target addresses of the chained block exits
+        self.namespace = {
+            "cpu": translator.cpu,
+            "system": translator.cpu.system,
+            "read_byte": translator.memory.read_byte,
+            "read_halfword": translator.memory.read_halfword,
+            "read_word": translator.memory.read_word,
+            "write_byte": translator.memory.write_byte,
+            "write_halfword": translator.memory.write_halfword,
+            "write_word": translator.memory.write_word,
+            "lookup": translator.lookup,
+            "zero_run_end": translator.memory.zero_run_end,
+            "generation": translator.generation,
+            "signed_division": signed_division,
+            "signed_remainder": signed_remainder,
+        }
+
+    def read(self, register):  # Returns the expression that reads a register
+        if register == 0:
+            return "0"
+        self.used.add(register)
+        return f"x{register}"
+
+    def write(self, register, expression):  # Emits an assignment to a register, writes to x0 are dropped
+        if register == 0:
+            return
+        self.used.add(register)
+        self.written.add(register)
+        self.emit(f"x{register} = {expression}")
+
+    def constant(self, value):  # Returns the name of a new global of the block holding the value
+        name = f"constant_{len(self.namespace)}"
+        self.namespace[name] = value
+        return name
+
+    def emit(self, line, indent=1):
+        self.lines.append("    " * indent + line)
+
+    def write_back(self, indent):  # Emits the stores of the modified registers into the register file
+        for register in sorted(self.written):
+            self.emit(f"regs[{register}] = x{register}", indent)
+
+    def exit_to(self, target, indent=1):  # Emits a chained exit to a constant address
+        index = len(self.exits)
+        self.exits.append(target)
+        self.write_back(indent)
+        self.emit(f"return exit_{index} or link_{index}()", indent)
+
+    def build(self):
+        for index, (pc, decoded) in enumerate(self.instructions):
+            next_pc = ignore_overflow(pc + 4, 32)
+            try:
+                generator = generators.get(decoded.execute, translate_interpreted)
+                generator(self, pc, next_pc, decoded)
+                if generator is translate_interpreted:  # The block ends, the interpreter has set the next pc
+                    self.instructions = self.instructions[:index + 1]
+                    break
+            except NotImplementedError:
+                if index == 0:
+                    raise
+                # End the block here, the error is raised once the guest reaches this instruction
+                self.instructions = self.instructions[:index]
+                self.exit_to(pc)
+                break
+        else:
+            if decoded.opcode not in BLOCK_TERMINATORS:  # The block was cut, fall through
+                self.exit_to(next_pc)
+
+        # Any exception raised by the guest code leaves the registers and the pc at the faulting instruction
+        prologue = ["def block(regs):", f"    at = {hex(self.start)}"]
+        prologue += [f"    x{register} = regs[{register}]" for register in sorted(self.used)]
+        prologue.append("    try:")
+        body = ["    " + line for line in self.lines]
+        epilogue = ["    except Exception:", "        cpu.pc = at"]
+        epilogue += [f"        regs[{register}] = x{register}" for register in sorted(self.written)]
+        epilogue.append("        raise")
+
+        source = "\n".join(prologue + body + epilogue)
+        namespace = self.namespace
+        for index, target in enumerate(self.exits):
+            namespace[f"exit_{index}"] = None
+            namespace[f"link_{index}"] = self.make_link(namespace, index, target)
+
+        exec(compile(source, f"<block {hex(self.start)}>", "exec"), namespace)
+        block = namespace["block"]
+        block.pc = self.start
+        block.size = len(self.instructions)
+        return block
+
+    # Returns a function that resolves an exit of the block the first time it is taken
+    # and patches it, so later executions return the next block directly
+    def make_link(self, namespace, index, target):
+        lookup = self.translator.lookup
+
+        def link():
+            block = lookup(target)
+            namespace[f"exit_{index}"] = block
+            return block
+
+        return link
+
+
+# The code generators of the instructions. Each one emits the python code of a decoded instruction
+# into the block being built. They are keyed by the interpreter handler of the instruction,
+# the instructions found in the execution table without a generator fall back to the interpreter.
+
+# There is no instruction at this address, skip over it and the zero words following it
+def translate_empty(builder, pc, next_pc, decoded):
+    builder.write_back(1)
+    builder.emit(f"return lookup(zero_run_end({hex(pc)}))")
+
+
+# The instructions without a code generator are executed by the interpreter handler, through the
+# register file, and end the block
+def translate_interpreted(builder, pc, next_pc, decoded):
+    builder.write_back(1)
+    builder.emit(f"at = {hex(pc)}")
+    builder.emit(f"cpu.pc = {hex(pc)}")
+    instruction = builder.constant(decoded)
+    builder.emit(f"{instruction}.execute(cpu, {instruction})")
+    builder.emit("regs[0] = 0")
+    builder.emit("return lookup(cpu.pc)")
+
+
+def translate_lui(builder, pc, next_pc, decoded):
+    builder.write(decoded.rd, hex(decoded.imm))
+
+
+def translate_auipc(builder, pc, next_pc, decoded):  # The pc is known, so the result is a constant
+    builder.write(decoded.rd, hex(ignore_overflow(pc + decoded.imm, 32)))
+
+
+def translate_fence(builder, pc, next_pc, decoded):  # The accesses of a block already run in program order
+    pass
+
+
+def translate_jal(builder, pc, next_pc, decoded):
+    builder.write(decoded.rd, hex(next_pc))
+    builder.exit_to(ignore_overflow(pc + decoded.imm, 32))
+
+
+def translate_jalr(builder, pc, next_pc, decoded):  # The target is only known at runtime, so it is looked up
+    builder.emit(f"target = (({builder.read(decoded.rs1)} + {decoded.imm}) & {MASK}) & ~1")
+    builder.write(decoded.rd, hex(next_pc))
+    builder.write_back(1)
+    builder.emit("return lookup(target)")
+
+
+def branch(condition):  # Returns the code generator of a branch taken when the condition holds
+    def translate_branch(builder, pc, next_pc, decoded):
+        a = builder.read(decoded.rs1)
+        b = builder.read(decoded.rs2)
+        builder.emit("if " + condition.format(a=a, b=b) + ":")
+        builder.exit_to(ignore_overflow(pc + decoded.imm, 32), 2)
+        builder.exit_to(next_pc)
+
+    return translate_branch
+
+
+def register_operation(expression):  # Returns the code generator of an operation writing rd
+    def translate_operation(builder, pc, next_pc, decoded):
+        a = builder.read(decoded.rs1)
+        b = builder.read(decoded.rs2)
+        builder.write(decoded.rd, expression.format(a=a, b=b, imm=decoded.imm, unsigned_imm=decoded.imm & MASK,
+                                                    shamt=decoded.imm & bit_mask_prefix(5)))
+
+    return translate_operation
+
+
+def translate_system(builder, pc, next_pc, decoded):
+    funct12 = decoded.imm & bit_mask_prefix(12)
+    if funct12 != SYSTEM_FUNCT12_ECALL:
+        raise NotImplementedError(f"Cannot execute funct12: {funct12}")
+
+    builder.write_back(1)
+    builder.emit(f"at = {hex(pc)}")
+    builder.emit("system.call(regs)")  # The number is passed in a7 and the parameters in a0 to a5
+    builder.emit(f"cpu.pc = {hex(next_pc)}")
+    builder.emit("if system.terminate:")
+    builder.emit("return None", 2)
+    builder.emit(f"return lookup({hex(next_pc)})")
+
+
+def load(expression):  # Returns the code generator of a load, the expression converts the loaded value
+    def translate_load(builder, pc, next_pc, decoded):
+        builder.emit(f"at = {hex(pc)}")
+        address = f"({builder.read(decoded.rs1)} + {decoded.imm}) & {MASK}"
+        if decoded.rd == 0:  # The load still happens, it may fail
+            builder.emit(expression.format(address=address))
+        else:
+            builder.write(decoded.rd, expression.format(address=address))
+
+    return translate_load
+
+
+def store(function):  # Returns the code generator of a store done by the given memory function
+    def translate_store(builder, pc, next_pc, decoded):
+        builder.emit(f"at = {hex(pc)}")
+        builder.emit(f"{function}({builder.read(decoded.rs2)}, ({builder.read(decoded.rs1)} + {decoded.imm}) & {MASK})")
+        builder.emit(f"if generation[0] != {builder.generation}:")  # The store overwrote translated code
+        builder.write_back(2)
+        builder.emit(f"return lookup({hex(next_pc)})", 2)
+
+    return translate_store
+
+
+# Comparing two 32-bit values as signed integers is the same as comparing them as unsigned
+# integers after flipping their sign bits
+SIGNED = "({} ^ 0x80000000)"
+SIGN_EXTEND = "(({} ^ 0x80000000) - 0x80000000)"
+
+generators = {
+    Processor.execute_empty: translate_empty,
+    Processor.execute_lui: translate_lui,
+    Processor.execute_auipc: translate_auipc,
+    Processor.execute_jal: translate_jal,
+    Processor.execute_jalr: translate_jalr,
+
+    Processor.execute_beq: branch("{a} == {b}"),
+    Processor.execute_bne: branch("{a} != {b}"),
+    Processor.execute_blt: branch(SIGNED.format("{a}") + " < " + SIGNED.format("{b}")),
+    Processor.execute_bge: branch(SIGNED.format("{a}") + " >= " + SIGNED.format("{b}")),
+    Processor.execute_bltu: branch("{a} < {b}"),
+    Processor.execute_bgeu: branch("{a} >= {b}"),
+
+    Processor.execute_addi: register_operation(f"({{a}} + {{imm}}) & {MASK}"),
+    Processor.execute_slti: register_operation("1 if " + SIGN_EXTEND.format("{a}") + " < {imm} else 0"),
+    Processor.execute_sltiu: register_operation("1 if {a} < {unsigned_imm} else 0"),
+    Processor.execute_xori: register_operation("{a} ^ {unsigned_imm}"),
+    Processor.execute_ori: register_operation("{a} | {unsigned_imm}"),
+    Processor.execute_andi: register_operation("{a} & {unsigned_imm}"),
+    Processor.execute_slli: register_operation(f"({{a}} << {{shamt}}) & {MASK}"),
+    Processor.execute_srli: register_operation("{a} >> {shamt}"),
+    Processor.execute_srai: register_operation(f"({SIGN_EXTEND.format('{a}')} >> {{shamt}}) & {MASK}"),
+
+    Processor.execute_add: register_operation(f"({{a}} + {{b}}) & {MASK}"),
+    Processor.execute_sub: register_operation(f"({{a}} - {{b}}) & {MASK}"),
+    Processor.execute_sll: register_operation(f"({{a}} << ({{b}} & 31)) & {MASK}"),
+    Processor.execute_slt: register_operation("1 if " + SIGNED.format("{a}") + " < " + SIGNED.format("{b}") + " else 0"),
+    Processor.execute_sltu: register_operation("1 if {a} < {b} else 0"),
+    Processor.execute_xor: register_operation("{a} ^ {b}"),
+    Processor.execute_srl: register_operation("{a} >> ({b} & 31)"),
+    Processor.execute_sra: register_operation(f"({SIGN_EXTEND.format('{a}')} >> ({{b}} & 31)) & {MASK}"),
+    Processor.execute_or: register_operation("{a} | {b}"),
+    Processor.execute_and: register_operation("{a} & {b}"),
+    Processor.execute_mul: register_operation(f"({{a}} * {{b}}) & {MASK}"),
+    Processor.execute_mulh: register_operation(
+        f"(({SIGN_EXTEND.format('{a}')} * {SIGN_EXTEND.format('{b}')}) >> 32) & {MASK}"),
+    Processor.execute_mulhsu: register_operation(f"(({SIGN_EXTEND.format('{a}')} * {{b}}) >> 32) & {MASK}"),
+    Processor.execute_mulhu: register_operation("({a} * {b}) >> 32"),
+    Processor.execute_div: register_operation("signed_division({a}, {b})"),
+    Processor.execute_divu: register_operation(f"({{a}} // {{b}} if {{b}} else {MASK})"),
+    Processor.execute_rem: register_operation("signed_remainder({a}, {b})"),
+    Processor.execute_remu: register_operation("({a} % {b} if {b} else {a})"),
+
+    Processor.execute_system: translate_system,
+    Processor.execute_fence: translate_fence,
+
+    Processor.execute_lb: load("((read_byte({address}) ^ 0x80) - 0x80) & " + str(MASK)),
+    Processor.execute_lh: load("((read_halfword({address}) ^ 0x8000) - 0x8000) & " + str(MASK)),
+    Processor.execute_lw: load("read_word({address})"),
+    Processor.execute_lbu: load("read_byte({address})"),
+    Processor.execute_lhu: load("read_halfword({address})"),
+
+    Processor.execute_sb: store("write_byte"),
+    Processor.execute_sh: store("write_halfword"),
+    Processor.execute_sw: store("write_word"),
+}
@@ -0,0 +1,91 @@
+from collections import deque
+
+# The address of the UART in the memory of the guest, as on the QEMU virt board, and its registers, one per byte
+UART_BASE = 0x10000000
+UART_SIZE = 8
+UART_RBR = 0  # Receive buffer when read, transmit holding register when written, divisor latch low with DLAB set
+UART_IER = 1  # Interrupt enable, divisor latch high with DLAB set
+UART_IIR = 2  # Interrupt identification when read, FIFO control when written
+UART_LCR = 3
+UART_MCR = 4
+UART_LSR = 5
+UART_MSR = 6
+UART_SCR = 7
+
+LCR_DLAB = 1 << 7  # Switches the first two registers to the divisor latch
+FCR_CLEAR_RECEIVE = 1 << 1
+IIR_NO_INTERRUPT = 0x01
+IIR_FIFO_ENABLED = 0xc0
+LSR_DATA_READY = 0x01
+LSR_TRANSMIT_EMPTY = 0x60  # The holding register and the shift register are both empty, a write never waits
+MSR_CONNECTED = 0xb0  # The modem lines read as carrier detect, data set ready and clear to send
+
+UART_BUFFER_SIZE = 4096  # The output of the guest is handed to its stdout file in chunks of at most this many bytes
+
+
+# A 16550 UART whose transmitter writes to the stdout file of the guest. The written bytes are kept in a buffer
+# and handed to the file at the end of each line, when the buffer is full and when the system flushes its files,
+# so a guest printing one byte per store costs a bytearray append per byte. The bytes received are the ones given
+# to receive. The line is always ready, the divisor and the line settings are kept but change nothing, and the
+# UART raises no interrupts.
+class Uart:
+    def __init__(self, system, base=UART_BASE):
+        self.system = system
+        self.output = bytearray()
+        self.input = deque()
+        self.registers = bytearray(UART_SIZE)  # The values written to the registers that only hold a setting
+        self.divisor = 0
+
+        system.memory.map_device(base, UART_SIZE, self)
+        system.devices.append(self)
+
+    def receive(self, data):  # Queues bytes for the guest to read
+        self.input.extend(data)
+
+    def flush(self):  # Hands the buffered output to the stdout file of the guest
+        if self.output:
+            file = self.system.files.get(1)
+            if file is not None:
+                file.write(self.output)
+            self.output = bytearray()
+
+    def state(self):  # The settings and the input not read yet, for the snapshots
+        return {"registers": list(self.registers), "divisor": self.divisor, "input": list(self.input)}
+
+    def load_state(self, state):
+        self.registers = bytearray(state["registers"])
+        self.divisor = state["divisor"]
+        self.input = deque(state["input"])
+        self.output = bytearray()
+
+    def read(self, offset, size):
+        if offset == UART_LSR:
+            return LSR_TRANSMIT_EMPTY | (LSR_DATA_READY if self.input else 0)
+        if offset == UART_RBR:
+            if self.registers[UART_LCR] & LCR_DLAB:
+                return self.divisor & 0xff
+            return self.input.popleft() if self.input else 0
+        if offset == UART_IER and self.registers[UART_LCR] & LCR_DLAB:
+            return self.divisor >> 8
+        if offset == UART_IIR:
+            return IIR_FIFO_ENABLED | IIR_NO_INTERRUPT
+        if offset == UART_MSR:
+            return MSR_CONNECTED
+        return self.registers[offset] if offset < UART_SIZE else 0
+
+    def write(self, offset, size, value):
+        value &= 0xff
+        if offset == UART_RBR and not self.registers[UART_LCR] & LCR_DLAB:
+            output = self.output
+            output.append(value)
+            if value == 0x0a or len(output) >= UART_BUFFER_SIZE:
+                self.flush()
+        elif offset == UART_RBR:
+            self.divisor = (self.divisor & 0xff00) | value
+        elif offset == UART_IER and self.registers[UART_LCR] & LCR_DLAB:
+            self.divisor = (self.divisor & 0xff) | (value << 8)
+        elif offset == UART_IIR:
+            if value & FCR_CLEAR_RECEIVE:
+                self.input.clear()
+        elif offset < UART_SIZE and offset != UART_LSR and offset != UART_MSR:
+            self.registers[offset] = value